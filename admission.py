@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Admission control and load shedding for the classify endpoints
+Each server admits a bounded number of requests at a time. Requests beyond
+that wait in per-client queues served round-robin, so one busy client cannot
+starve the others. When the queues are full the server answers 503 with
+Retry-After at once. A request whose deadline has passed, or will pass
+before it could finish, is dropped without doing the work.
+"""
+
+import functools
+import math
+import os
+import statistics
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import Response, g, request, jsonify
+
+from deadline import Deadline, DeadlineExceeded
+
+CLIENT_HEADER = 'X-Client-Id'
+
+QUEUED = "queued"
+ADMITTED = "admitted"
+DROPPED = "dropped"
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed because the server is saturated."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server overloaded, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def client_key(req):
+    """Fair-queuing key: the X-Client-Id header, else the remote address."""
+    return req.headers.get(CLIENT_HEADER) or req.remote_addr or 'unknown'
+
+
+class _Waiter:
+    __slots__ = ('client', 'deadline', 'event', 'state')
+
+    def __init__(self, client, deadline):
+        self.client = client
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.state = QUEUED
+
+
+class AdmissionController:
+    """
+    Bounded in-flight limit with per-client fair queuing.
+
+    At most max_in_flight requests run at once. Others wait in a FIFO per
+    client; when a slot frees, clients take turns, one request each. A
+    request is shed with Overloaded when the queue (or its client's share of
+    it) is full or it waited queue_timeout seconds, and dropped with
+    DeadlineExceeded once its deadline leaves less time than a typical
+    (median) request takes.
+    """
+
+    def __init__(self, name, max_in_flight=4, max_queue=32, max_queue_per_client=8,
+                 queue_timeout=5.0, default_timeout=12.0):
+        """
+        Args:
+            name (str): Server name, shown in /health
+            max_in_flight (int): Requests processed concurrently
+            max_queue (int): Requests allowed to wait in total
+            max_queue_per_client (int): Requests one client may have waiting
+            queue_timeout (float): Longest a request waits for a slot
+            default_timeout (float): Deadline for requests without X-Request-Timeout-Ms
+        """
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.queue_timeout = queue_timeout
+        self.default_timeout = default_timeout
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queues = OrderedDict()  # client -> deque of _Waiter, in round-robin order
+        self._queued = 0
+        self._service_ms = deque(maxlen=100)
+        self._counters = {"admitted": 0, "shed": 0, "expired": 0, "completed": 0}
+
+    @classmethod
+    def from_env(cls, name, max_in_flight=4):
+        """
+        Build a controller from ADMISSION_* environment variables.
+
+        Args:
+            name (str): Server name
+            max_in_flight (int): Default concurrency for this server (CPU-bound
+                servers want about one per core, upstream-bound ones more)
+        """
+        return cls(
+            name,
+            max_in_flight=int(os.getenv('ADMISSION_MAX_IN_FLIGHT', max_in_flight)),
+            max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', '32')),
+            max_queue_per_client=int(os.getenv('ADMISSION_MAX_QUEUE_PER_CLIENT', '8')),
+            queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '5')),
+            default_timeout=float(os.getenv('ADMISSION_DEFAULT_TIMEOUT', '12'))
+        )
+
+    def _typical_service(self):
+        """Median seconds per admitted request over the recent window."""
+        if not self._service_ms:
+            return 0.0
+        # Median, not mean: one request stuck on a slow download should not
+        # make every short-budget request look hopeless
+        return statistics.median(self._service_ms) / 1000
+
+    def _retry_after(self):
+        # Time for the current backlog to drain, in whole seconds
+        backlog = (self._queued + 1) * self._typical_service() / self.max_in_flight
+        return max(1, math.ceil(backlog))
+
+    def _dispatch(self):
+        """Hand free slots to waiting clients in turn (lock held)."""
+        now = time.monotonic()
+        while self._in_flight < self.max_in_flight and self._queued:
+            client, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+
+            if waiter.deadline - now <= self._typical_service():
+                # Would finish after the client gave up: skip it, keep the slot
+                waiter.state = DROPPED
+            else:
+                waiter.state = ADMITTED
+                self._in_flight += 1
+            waiter.event.set()
+
+    def acquire(self, client, deadline=None):
+        """
+        Wait for a processing slot.
+
+        Args:
+            client (str): Fair-queuing key
+            deadline (float): Absolute time.monotonic() deadline
+
+        Returns:
+            float: Ticket to pass to release()
+
+        Raises:
+            Overloaded: if the request is shed
+            DeadlineExceeded: if the deadline passed or cannot be met
+        """
+        now = time.monotonic()
+        deadline = deadline if deadline is not None else now + self.default_timeout
+
+        with self._lock:
+            if deadline - now <= self._typical_service():
+                self._counters["expired"] += 1
+                raise DeadlineExceeded("Request deadline already passed")
+
+            if self._in_flight < self.max_in_flight and not self._queued:
+                self._in_flight += 1
+                self._counters["admitted"] += 1
+                return time.perf_counter()
+
+            waiters = self._queues.get(client)
+            if self._queued >= self.max_queue or (waiters and len(waiters) >= self.max_queue_per_client):
+                self._counters["shed"] += 1
+                raise Overloaded(self._retry_after())
+
+            waiter = _Waiter(client, deadline)
+            self._queues.setdefault(client, deque()).append(waiter)
+            self._queued += 1
+            wait_until = min(deadline - self._typical_service(), now + self.queue_timeout)
+
+        waiter.event.wait(timeout=max(0.0, wait_until - time.monotonic()))
+
+        with self._lock:
+            if waiter.state == ADMITTED:
+                self._counters["admitted"] += 1
+                return time.perf_counter()
+
+            if waiter.state == QUEUED:
+                # Timed out while still queued
+                waiters = self._queues[client]
+                waiters.remove(waiter)
+                self._queued -= 1
+                if not waiters:
+                    del self._queues[client]
+
+            if waiter.state == DROPPED or time.monotonic() >= deadline - self._typical_service():
+                self._counters["expired"] += 1
+                raise DeadlineExceeded("Request deadline passed while queued")
+            self._counters["shed"] += 1
+            raise Overloaded(self._retry_after())
+
+    def release(self, ticket):
+        """Free the slot taken by acquire() and admit the next waiter."""
+        with self._lock:
+            self._service_ms.append((time.perf_counter() - ticket) * 1000)
+            self._in_flight -= 1
+            self._counters["completed"] += 1
+            self._dispatch()
+
+    def limit(self, view):
+        """
+        Decorator for a Flask view: admit the request or answer 503/504.
+
+        The request's Deadline is available to the view as flask.g.deadline.
+        Overload gets 503 with Retry-After; a request whose deadline passed,
+        in the queue or in the view, gets 504 (the client has already
+        stopped waiting for it). A streamed response keeps its slot until
+        the stream is closed.
+        """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.deadline = Deadline.from_request(request, self.default_timeout)
+            try:
+                ticket = self.acquire(client_key(request), g.deadline.expires_at)
+            except Overloaded as e:
+                return jsonify({"error": str(e), "overloaded": True}), 503, {"Retry-After": str(e.retry_after)}
+            except DeadlineExceeded as e:
+                return jsonify({"error": str(e), "deadline_exceeded": True}), 504
+            streamed = False
+            try:
+                response = view(*args, **kwargs)
+                if isinstance(response, Response) and response.is_streamed:
+                    # The work happens as the body is sent, after the view returns
+                    response.call_on_close(lambda: self.release(ticket))
+                    streamed = True
+                return response
+            except DeadlineExceeded as e:
+                return jsonify({"error": str(e), "deadline_exceeded": True, "stage": e.stage}), 504
+            finally:
+                if not streamed:
+                    self.release(ticket)
+        return wrapper
+
+    def snapshot(self):
+        """Admission state for /health."""
+        with self._lock:
+            return dict(self._counters,
+                        in_flight=self._in_flight,
+                        queued=self._queued,
+                        queued_clients=len(self._queues),
+                        max_in_flight=self.max_in_flight,
+                        median_service_ms=round(self._typical_service() * 1000, 1))
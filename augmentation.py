@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Batched training-time augmentation
+Augments whole batches with TensorFlow ops inside a tf.data input pipeline,
+in parallel with the training step, instead of image by image in the Python
+generator. Covers random resized crops, horizontal flips, resize-resample
+(downscale and back up), Gaussian blur and JPEG re-encoding at a random
+quality: the ways images are degraded on their way across the web, which a
+detector should not mistake for a real/AI signal.
+
+Every random draw is a stateless op seeded by (run seed, global step), so
+a run is reproducible and a run resumed from a checkpoint (see
+training_checkpoint.py) augments its remaining batches exactly as the
+uninterrupted run would have.
+
+`python augmentation.py` measures the stage's own throughput and its effect
+on training steps per second.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Probabilities are per image; ranges are (low, high) for uniform draws.
+# A probability of 0 disables that augmentation.
+DEFAULT_AUGMENTATION = {
+    "crop_prob": 0.5,
+    "crop_area": (0.6, 1.0),         # fraction of the image kept
+    "crop_aspect": (0.75, 1.33),
+    "flip_prob": 0.5,
+    "resample_prob": 0.3,
+    "resample_scale": (0.4, 0.9),    # one scale per batch
+    "blur_prob": 0.3,
+    "blur_sigma": (0.3, 1.5),        # pixels
+    "jpeg_prob": 0.5,
+    "jpeg_quality": (40, 95),
+}
+
+_MAX_BLUR_RADIUS = 5
+
+def load_augmentation_config(path=None, **overrides):
+    """
+    DEFAULT_AUGMENTATION updated from a JSON file and keyword overrides.
+
+    Raises:
+        ValueError: for unknown keys
+    """
+    config = dict(DEFAULT_AUGMENTATION)
+    updates = {}
+    if path:
+        with open(path) as f:
+            updates.update(json.load(f))
+    updates.update(overrides)
+    unknown = set(updates) - set(config)
+    if unknown:
+        raise ValueError(f"Unknown augmentation settings: {', '.join(sorted(unknown))}")
+    config.update(updates)
+    return config
+
+# ============================================================================
+# 1. BATCH OPS
+# ============================================================================
+# Each op takes a float32 batch in [0, 1] of shape (B, H, W, 3), a stateless
+# seed of shape (2,), and transforms a random subset of the batch at once.
+
+def _chosen(seed, batch, prob):
+    """Boolean mask selecting each image with probability prob."""
+    return tf.random.stateless_uniform([batch], seed) < prob
+
+
+def random_resized_crop(images, seed, prob, area, aspect):
+    """Crop a random box from each chosen image and resize it back to full size."""
+    batch = tf.shape(images)[0]
+    height, width = tf.shape(images)[1], tf.shape(images)[2]
+    seeds = tf.random.experimental.stateless_split(seed, 4)
+
+    scale = tf.random.stateless_uniform([batch], seeds[0], area[0], area[1])
+    ratio = tf.exp(tf.random.stateless_uniform([batch], seeds[1], np.log(aspect[0]), np.log(aspect[1])))
+    box_h = tf.minimum(tf.sqrt(scale / ratio), 1.0)
+    box_w = tf.minimum(tf.sqrt(scale * ratio), 1.0)
+    offsets = tf.random.stateless_uniform([batch, 2], seeds[2])
+    top = offsets[:, 0] * (1.0 - box_h)
+    left = offsets[:, 1] * (1.0 - box_w)
+
+    # Images that are not chosen get the whole-image box (an exact copy)
+    boxes = tf.stack([top, left, top + box_h, left + box_w], axis=1)
+    boxes = tf.where(_chosen(seeds[3], batch, prob)[:, None], boxes, tf.constant([[0.0, 0.0, 1.0, 1.0]]))
+    return tf.image.crop_and_resize(images, boxes, tf.range(batch), tf.stack([height, width]))
+
+
+def random_flip(images, seed, prob):
+    """Mirror each chosen image left to right."""
+    mask = _chosen(seed, tf.shape(images)[0], prob)
+    return tf.where(mask[:, None, None, None], tf.reverse(images, axis=[2]), images)
+
+
+def random_resample(images, seed, prob, scale):
+    """Downscale the chosen images by a random factor and scale them back up."""
+    seeds = tf.random.experimental.stateless_split(seed, 2)
+    size = tf.shape(images)[1:3]
+    factor = tf.random.stateless_uniform([], seeds[0], scale[0], scale[1])
+    small = tf.maximum(tf.cast(tf.cast(size, tf.float32) * factor, tf.int32), 1)
+    # One size per batch keeps this a single resize over the whole batch
+    resampled = tf.image.resize(tf.image.resize(images, small, method='area'), size, method='bilinear')
+    mask = _chosen(seeds[1], tf.shape(images)[0], prob)
+    return tf.where(mask[:, None, None, None], resampled, images)
+
+
+def random_blur(images, seed, prob, sigma):
+    """
+    Gaussian-blur the chosen images, each with its own sigma.
+
+    Per-image kernels are applied in one separable depthwise convolution by
+    folding the batch into the channel axis.
+    """
+    batch = tf.shape(images)[0]
+    height, width = tf.shape(images)[1], tf.shape(images)[2]
+    seeds = tf.random.experimental.stateless_split(seed, 2)
+
+    sigmas = tf.random.stateless_uniform([batch], seeds[0], sigma[0], sigma[1])
+    # A tiny sigma makes a delta kernel: unchosen images pass through unchanged
+    sigmas = tf.where(_chosen(seeds[1], batch, prob), sigmas, 1e-3)
+    offsets = tf.range(-_MAX_BLUR_RADIUS, _MAX_BLUR_RADIUS + 1, dtype=tf.float32)
+    kernels = tf.exp(-tf.square(offsets)[None, :] / (2.0 * tf.square(sigmas)[:, None]))
+    kernels = kernels / tf.reduce_sum(kernels, axis=1, keepdims=True)   # (B, K)
+    kernels = tf.repeat(kernels, 3, axis=0)                             # (B*3, K)
+
+    # (B, H, W, 3) -> (1, H, W, B*3): channel b*3+c is image b, colour c
+    folded = tf.reshape(tf.transpose(images, [1, 2, 0, 3]), [1, height, width, batch * 3])
+    padded = tf.pad(folded, [[0, 0], [_MAX_BLUR_RADIUS] * 2, [_MAX_BLUR_RADIUS] * 2, [0, 0]], mode='REFLECT')
+    horizontal = tf.transpose(kernels)[None, :, :, None]                # (1, K, B*3, 1)
+    vertical = tf.transpose(kernels)[:, None, :, None]                  # (K, 1, B*3, 1)
+    blurred = tf.nn.depthwise_conv2d(padded, horizontal, [1, 1, 1, 1], 'VALID')
+    blurred = tf.nn.depthwise_conv2d(blurred, vertical, [1, 1, 1, 1], 'VALID')
+    return tf.transpose(tf.reshape(blurred, [height, width, batch, 3]), [2, 0, 1, 3])
+
+
+def random_jpeg(images, seed, prob, quality):
+    """Re-encode the chosen images as JPEG at a random quality."""
+    seeds = tf.random.experimental.stateless_split(seed, 2)
+    batch = tf.shape(images)[0]
+    qualities = tf.random.stateless_uniform([batch], seeds[0], quality[0], quality[1] + 1, dtype=tf.int32)
+    mask = _chosen(seeds[1], batch, prob)
+
+    # The JPEG codec works on one image at a time; map_fn keeps the loop in
+    # the graph and only encodes the chosen images
+    def encode(args):
+        image, image_quality, apply = args
+        return tf.cond(apply, lambda: tf.image.adjust_jpeg_quality(image, image_quality), lambda: image)
+
+    return tf.map_fn(encode, (images, qualities, mask), fn_output_signature=tf.float32,
+                     parallel_iterations=8)
+
+# ============================================================================
+# 2. AUGMENTER
+# ============================================================================
+
+class BatchAugmenter:
+    """
+    Applies the configured augmentations to a batch.
+
+    Call it with (images, labels, step): images are float32 in [0, 1] (as
+    the training generators yield them), step is the batch's global index,
+    which together with the run seed fixes every random draw.
+    """
+
+    def __init__(self, config=None, seed=0):
+        """
+        Args:
+            config (dict): Settings (see DEFAULT_AUGMENTATION)
+            seed (int): Run seed
+        """
+        self.config = load_augmentation_config(**(config or {}))
+        self.seed = int(seed)
+        self._augment = tf.function(self._augment_batch, reduce_retracing=True)
+
+    def _augment_batch(self, images, step):
+        c = self.config
+        seed = tf.stack([tf.constant(self.seed % 2 ** 31, tf.int64), tf.cast(step, tf.int64)])
+        seeds = tf.random.experimental.stateless_split(seed, 5)
+        if c["crop_prob"] > 0:
+            images = random_resized_crop(images, seeds[0], c["crop_prob"], c["crop_area"], c["crop_aspect"])
+        if c["flip_prob"] > 0:
+            images = random_flip(images, seeds[1], c["flip_prob"])
+        if c["resample_prob"] > 0:
+            images = random_resample(images, seeds[2], c["resample_prob"], c["resample_scale"])
+        if c["blur_prob"] > 0:
+            images = random_blur(images, seeds[3], c["blur_prob"], c["blur_sigma"])
+        if c["jpeg_prob"] > 0:
+            images = random_jpeg(images, seeds[4], c["jpeg_prob"], c["jpeg_quality"])
+        return tf.clip_by_value(images, 0.0, 1.0)
+
+    def __call__(self, images, labels, step):
+        # Tensors (not numpy arrays or ints) so every call reuses one trace
+        images = tf.convert_to_tensor(images, tf.float32)
+        return self._augment(images, tf.convert_to_tensor(step, tf.int64)), labels
+
+
+def augment_batches(batches, augmenter, start=0, image_size=(224, 224)):
+    """
+    Wrap a generator of (images, labels) batches in a tf.data pipeline that
+    augments each batch on TensorFlow's threads and prefetches ahead of the
+    training step.
+
+    Args:
+        batches: Generator of (float images, int labels) numpy batches
+        augmenter (BatchAugmenter): Augmentation to apply
+        start (int): Global step of the first batch (seeds continue from it)
+        image_size (tuple): (height, width) of the images
+
+    Returns:
+        tf.data.Dataset: Infinite if `batches` is; pass to model.fit with
+            steps_per_epoch
+    """
+    signature = (tf.TensorSpec((None, image_size[0], image_size[1], 3), tf.float32),
+                 tf.TensorSpec((None,), tf.int64))
+    dataset = tf.data.Dataset.from_generator(lambda: batches, output_signature=signature)
+    dataset = dataset.enumerate(start).map(lambda step, batch: augmenter(batch[0], batch[1], step),
+                                           num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def augmented(train_batches, config=None):
+    """
+    Add augmentation to a fit_resumable data factory.
+
+    Args:
+        train_batches (callable): (seed, start) -> generator of batches
+        config (dict): Augmentation settings (None for the defaults)
+
+    Returns:
+        callable: (seed, start) -> augmented tf.data.Dataset
+    """
+    def factory(seed, start):
+        return augment_batches(train_batches(seed, start), BatchAugmenter(config, seed), start)
+    return factory
+
+# ============================================================================
+# 3. BENCHMARK
+# ============================================================================
+
+def _synthetic_batches(batch_size, image_size, seed=0):
+    rng = np.random.default_rng(seed)
+    images = rng.random((batch_size, image_size[0], image_size[1], 3), dtype=np.float32)
+    labels = rng.integers(0, 2, batch_size)
+    while True:
+        yield images, labels
+
+
+def _steps_per_second(model, dataset, steps, warmup=3):
+    iterator = iter(dataset)
+    for _ in range(warmup):
+        model.train_on_batch(*next(iterator))
+    started = time.perf_counter()
+    for _ in range(steps):
+        model.train_on_batch(*next(iterator))
+    return steps / (time.perf_counter() - started)
+
+
+def benchmark_augmentation(config=None, batch_size=16, steps=20, image_size=(224, 224)):
+    """
+    Measure the augmentation stage alone and its effect on training steps.
+
+    Returns:
+        dict: Augmented images/sec for the stage alone, and training
+            steps/sec without augmentation, with the pipelined stage and
+            with the stage run inline before each step
+    """
+    from ml_model_example import create_cnn_model
+
+    augmenter = BatchAugmenter(config, seed=0)
+    images, labels = next(_synthetic_batches(batch_size, image_size))
+    augmenter(images, labels, 0)
+    started = time.perf_counter()
+    for step in range(steps):
+        augmenter(images, labels, step)
+    stage_seconds = time.perf_counter() - started
+
+    model = create_cnn_model(input_shape=image_size + (3,))
+    plain = tf.data.Dataset.from_generator(
+        lambda: _synthetic_batches(batch_size, image_size),
+        output_signature=(tf.TensorSpec((None,) + image_size + (3,), tf.float32), tf.TensorSpec((None,), tf.int64)))
+    baseline = _steps_per_second(model, plain.prefetch(tf.data.AUTOTUNE), steps)
+    pipelined = _steps_per_second(model, augment_batches(_synthetic_batches(batch_size, image_size), augmenter,
+                                                         image_size=image_size), steps)
+    inline = _steps_per_second(model, (augmenter(x, y, i) for i, (x, y) in
+                                       enumerate(_synthetic_batches(batch_size, image_size))), steps)
+    return {
+        "config": augmenter.config,
+        "batch_size": batch_size,
+        "augment_images_per_second": round(steps * batch_size / stage_seconds, 1),
+        "augment_ms_per_batch": round(stage_seconds / steps * 1000, 2),
+        "train_steps_per_second": {
+            "no_augmentation": round(baseline, 3),
+            "pipelined": round(pipelined, 3),
+            "inline": round(inline, 3),
+        },
+        "pipelined_slowdown": round(1 - pipelined / baseline, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the batched augmentation stage')
+    parser.add_argument('--config', help='JSON file with augmentation settings')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args()
+
+    report = benchmark_augmentation(load_augmentation_config(args.config), args.batch_size, args.steps)
+    print(f"Augmentation alone: {report['augment_images_per_second']} images/s "
+          f"({report['augment_ms_per_batch']} ms per batch of {args.batch_size})")
+    for mode, rate in report["train_steps_per_second"].items():
+        print(f"  {mode:<16} {rate} steps/s")
+    print(f"Pipelined augmentation costs {report['pipelined_slowdown']:.1%} of step throughput")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
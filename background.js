@@ -18,22 +18,31 @@ async function fetchWithTimeout(url, options = {}, timeoutMs = FETCH_TIMEOUT_MS)
     clearTimeout(timeoutId);
   }
 }
+// When the server sheds load (503 + Retry-After), skip it until then
+let apiBackoffUntil = 0;
+
 async function classifyImageByUrl(imageUrl) {
   const defaultLocalApi = 'http://localhost:5001/classify';
   const options = await chrome.storage.sync.get({ apiUrl: defaultLocalApi, apiKey: '' });
   const apiUrl = (options.apiUrl?.trim() || defaultLocalApi);
   const apiKey = options.apiKey?.trim();
 
-  if (apiUrl) {
+  if (apiUrl && Date.now() >= apiBackoffUntil) {
     try {
       const response = await fetchWithTimeout(apiUrl, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          // Lets the server drop work we will have stopped waiting for
+          'X-Request-Timeout-Ms': String(FETCH_TIMEOUT_MS),
           ...(apiKey ? { Authorization: `Bearer ${apiKey}` } : {})
         },
         body: JSON.stringify({ imageUrl })
       });
+      if (response.status === 503) {
+        const retryAfter = Number(response.headers.get('Retry-After'));
+        if (retryAfter > 0) apiBackoffUntil = Date.now() + retryAfter * 1000;
+      }
       if (!response.ok) throw new Error(`API ${response.status}`);
       const data = await response.json();
       // Expected shape: { label: 'ai'|'real', confidence: 0-1 }
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+Offline bulk scoring for moderation backfills
+Scores a manifest of image URLs or local files with AIImageDetector without
+going through /classify. Fetch, decode and inference run as pipelined
+stages connected by bounded queues: many fetch threads wait on the network,
+decode threads (or the cpu_pool worker processes) prepare model inputs, and
+a single inference thread batches them into forward passes. Results are
+appended to JSONL or written as Parquet parts; images already in the output
+are skipped, so a killed job picks up where it stopped.
+
+    python bulk_score.py manifest.jsonl results.jsonl --model best_model.h5
+"""
+
+import argparse
+import json
+import os
+import queue
+import signal
+import threading
+import time
+
+import numpy as np
+
+from cpu_pool import PreprocessPool
+from image_probe import fetch_image_bytes, sniff_image_header, check_limits, ImageRejected, DEFAULT_LIMITS
+from model_registry import serve_from_registry
+from model_serving import TFLiteModel, apply_thread_config, load_thread_config
+
+# End-of-stream marker passed between stages
+_DONE = object()
+
+# ============================================================================
+# 1. MANIFEST
+# ============================================================================
+
+def read_manifest(path):
+    """
+    Yield {"id", "source"} for each image in a manifest.
+
+    A manifest is either a plain list (one URL or file path per line) or JSONL
+    with "url", "imageUrl" or "path" and an optional "id". Without an id the
+    source itself identifies the image in the output.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                record = json.loads(line)
+                source = record.get('url') or record.get('imageUrl') or record.get('path')
+                if not source:
+                    continue
+                yield {"id": str(record.get('id', source)), "source": source}
+            else:
+                yield {"id": line, "source": line}
+
+# ============================================================================
+# 2. OUTPUT WRITERS
+# ============================================================================
+
+class JsonlWriter:
+    """Appends one JSON line per result; fsyncs at every checkpoint."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def done_ids(self, retry_errors=False):
+        """
+        Ids already in the output. A torn last line from a killed run is
+        truncated away so the file stays valid JSONL.
+        """
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+
+        good_bytes = 0
+        with open(self.path, 'rb') as f:
+            for raw in f:
+                try:
+                    row = json.loads(raw)
+                except ValueError:
+                    break
+                good_bytes += len(raw)
+                if not (retry_errors and row.get('error')):
+                    done.add(row['id'])
+        if good_bytes < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_bytes)
+        return done
+
+    def write(self, rows):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        for row in rows:
+            self._file.write(json.dumps(row) + '\n')
+        self._file.flush()
+
+    def checkpoint(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.checkpoint()
+            self._file.close()
+            self._file = None
+
+
+class ParquetWriter:
+    """
+    Buffers results and writes a Parquet part file per checkpoint into the
+    output directory (requires pyarrow). Parts are written under a temporary
+    name and renamed, so a part is either complete or absent.
+    """
+
+    COLUMNS = ['id', 'source', 'label', 'confidence', 'ai_probability', 'patches',
+               'features', 'model_version', 'error', 'rejected']
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output requires pyarrow (pip install pyarrow)")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self._rows = []
+        self._schema = pyarrow.schema([
+            ('id', pyarrow.string()), ('source', pyarrow.string()), ('label', pyarrow.string()),
+            ('confidence', pyarrow.float64()), ('ai_probability', pyarrow.float64()),
+            ('patches', pyarrow.int64()), ('features', pyarrow.string()),
+            ('model_version', pyarrow.string()), ('error', pyarrow.string()), ('rejected', pyarrow.string())
+        ])
+
+    def _parts(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if name.startswith('part-') and name.endswith('.parquet'))
+
+    def done_ids(self, retry_errors=False):
+        done = set()
+        for name in self._parts():
+            table = self._pq.read_table(os.path.join(self.path, name), columns=['id', 'error'])
+            for row_id, error in zip(table.column('id').to_pylist(), table.column('error').to_pylist()):
+                if not (retry_errors and error):
+                    done.add(row_id)
+        return done
+
+    def write(self, rows):
+        for row in rows:
+            row = dict(row)
+            if row.get('features') is not None:
+                row['features'] = json.dumps(row['features'])
+            self._rows.append({column: row.get(column) for column in self.COLUMNS})
+
+    def checkpoint(self):
+        if not self._rows:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        parts = self._parts()
+        index = int(parts[-1][5:10]) + 1 if parts else 0
+        final = os.path.join(self.path, f'part-{index:05d}.parquet')
+        table = self._pa.Table.from_pylist(self._rows, schema=self._schema)
+        self._pq.write_table(table, final + '.tmp')
+        os.replace(final + '.tmp', final)
+        self._rows = []
+
+    def close(self):
+        self.checkpoint()
+
+
+def open_writer(path, output_format=None):
+    """JSONL unless the format (or the path's extension) says Parquet."""
+    output_format = output_format or ('parquet' if path.rstrip('/').endswith('.parquet') else 'jsonl')
+    return ParquetWriter(path) if output_format == 'parquet' else JsonlWriter(path)
+
+# ============================================================================
+# 3. PIPELINE
+# ============================================================================
+
+def _run_stage(func, inbox, outbox, workers, name):
+    """
+    Apply func to every item from inbox on `workers` threads. outbox gets
+    _DONE once inbox is exhausted and all of them have finished.
+    """
+    def work():
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                inbox.put(_DONE)  # let the stage's other threads see it too
+                return
+            outbox.put(func(item))
+
+    threads = [threading.Thread(target=work, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    def close():
+        for thread in threads:
+            thread.join()
+        outbox.put(_DONE)
+    threading.Thread(target=close, name=f'{name}-close', daemon=True).start()
+
+
+class BulkScorer:
+    """
+    Fetch -> decode -> batched inference over a manifest, writing results as
+    it goes. Failed images are written with an "error" (and "rejected" when
+    a probe limit refused them) instead of stopping the job.
+    """
+
+    def __init__(self, detector, writer, fetch_workers=16, decode_workers=4, batch_size=32,
+                 batch_wait=0.05, multi_crop=False, aggregate='mean', timeout=10,
+                 checkpoint_every=1000, report_every=10.0, limits=None):
+        """
+        Args:
+            detector (AIImageDetector): Model and preprocessing to use
+            writer (JsonlWriter or ParquetWriter): Output
+            fetch_workers (int): Concurrent downloads / file reads
+            decode_workers (int): Concurrent decodes (threads, or calls into
+                the detector's cpu_pool when it has one)
+            batch_size (int): Model inputs per forward pass (patches count
+                individually in multi-crop mode)
+            batch_wait (float): Longest the inference stage waits to fill a batch
+            multi_crop (bool): Score native-resolution patches
+            aggregate (str): Patch score aggregation ('mean' or 'max')
+            timeout (float): Per-download timeout
+            checkpoint_every (int): Results between checkpoints
+            report_every (float): Seconds between throughput reports
+            limits (dict): image_probe limits for downloads and files
+
+        Raises:
+            ValueError: multi_crop with a detector that decodes in a cpu_pool,
+                whose fixed-size slots cannot hold native-resolution patches
+        """
+        if multi_crop and getattr(detector, 'cpu_pool', None) is not None:
+            raise ValueError("multi-crop scoring cannot use the cpu_pool; drop one of the two")
+        self.detector = detector
+        self.writer = writer
+        self.fetch_workers = fetch_workers
+        self.decode_workers = decode_workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.multi_crop = multi_crop
+        self.aggregate = aggregate
+        self.timeout = timeout
+        self.checkpoint_every = checkpoint_every
+        self.report_every = report_every
+        self.limits = limits
+
+        # Bounded so a fast stage cannot run arbitrarily far ahead of a slow one
+        self._to_fetch = queue.Queue(maxsize=fetch_workers * 4)
+        self._to_decode = queue.Queue(maxsize=decode_workers * 4)
+        self._to_predict = queue.Queue(maxsize=batch_size * 4)
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.counters = {"skipped": 0, "scored": 0, "errors": 0, "batches": 0}
+
+    # -- stages ---------------------------------------------------------------
+
+    def _read(self, manifest, done):
+        try:
+            for item in manifest:
+                if self._stop.is_set():
+                    break
+                if item["id"] in done:
+                    self.counters["skipped"] += 1
+                    continue
+                self._to_fetch.put(item)
+        finally:
+            self._to_fetch.put(_DONE)
+
+    def _fetch(self, item):
+        source = item["source"]
+        try:
+            if source.startswith(('http://', 'https://')):
+                item["bytes"], _ = fetch_image_bytes(source, self.limits, timeout=self.timeout)
+            else:
+                limits = dict(DEFAULT_LIMITS, **(self.limits or {}))
+                if os.path.getsize(source) > limits["max_bytes"]:
+                    raise ImageRejected("too_large", f"File exceeds {limits['max_bytes']:,} bytes")
+                with open(source, 'rb') as f:
+                    data = f.read()
+                check_limits(sniff_image_header(data, complete=True) or
+                             {"format": None, "width": 0, "height": 0}, limits)
+                item["bytes"] = data
+        except ImageRejected as e:
+            item.update(error=str(e), rejected=e.reason)
+        except Exception as e:
+            item["error"] = str(e)
+        return item
+
+    def _decode(self, item):
+        image_bytes = item.pop("bytes", None)
+        if image_bytes is None:
+            return item
+        model_input, image, features = self.detector._prepare_input(image_bytes, self.multi_crop)
+        if model_input is None:
+            item["error"] = "Failed to decode image"
+        else:
+            item.update(model_input=model_input, image=image, features=features)
+        return item
+
+    def _next_batch(self):
+        """Items for one forward pass, or None once the pipeline is drained."""
+        item = self._to_predict.get()
+        if item is _DONE:
+            return None
+        batch, rows = [item], len(item.get("model_input", ()))
+        flush_at = time.monotonic() + self.batch_wait
+        while rows < self.batch_size:
+            try:
+                item = self._to_predict.get(timeout=max(0.0, flush_at - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                self._to_predict.put(_DONE)  # end the loop after this batch
+                break
+            batch.append(item)
+            rows += len(item.get("model_input", ()))
+        return batch
+
+    def _predict(self, batch):
+        """Run one forward pass and return the output rows, in batch order."""
+        scored = [item for item in batch if "model_input" in item]
+        if scored:
+            try:
+                with self.detector.serving.acquire() as served:
+                    predictions = served.model.predict(
+                        np.concatenate([item["model_input"] for item in scored]), verbose=0)
+                splits = np.cumsum([len(item["model_input"]) for item in scored])[:-1]
+                for item, prediction in zip(scored, np.split(predictions, splits)):
+                    item["result"] = self.detector._build_result(
+                        prediction, item["image"], self.multi_crop, self.aggregate, item["features"])
+                    item["result"]["model_version"] = served.version
+            except Exception as e:
+                # One bad batch is recorded as errors; the job carries on
+                for item in scored:
+                    item.setdefault("error", f"Inference failed: {e}")
+
+        rows = []
+        for item in batch:
+            row = {"id": item["id"], "source": item["source"]}
+            if "result" in item:
+                row.update(item["result"])
+            else:
+                row["error"] = item.get("error", "Failed to process image")
+                if item.get("rejected"):
+                    row["rejected"] = item["rejected"]
+            rows.append(row)
+        return rows
+
+    def _infer(self):
+        since_checkpoint = 0
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            rows = self._predict(batch)
+            self.writer.write(rows)
+            with self._lock:
+                self.counters["batches"] += 1
+                self.counters["scored"] += len(rows)
+                self.counters["errors"] += sum(1 for row in rows if row.get("error"))
+            since_checkpoint += len(rows)
+            if since_checkpoint >= self.checkpoint_every:
+                self.writer.checkpoint()
+                since_checkpoint = 0
+        self.writer.close()
+
+    # -- driver ---------------------------------------------------------------
+
+    def _report(self, started, last):
+        now = time.monotonic()
+        with self._lock:
+            scored, errors = self.counters["scored"], self.counters["errors"]
+        last_time, last_scored = last
+        recent = (scored - last_scored) / max(now - last_time, 1e-9)
+        print(f"[bulk] {scored:,} scored ({errors:,} errors, {self.counters['skipped']:,} already done) | "
+              f"{scored / max(now - started, 1e-9):.1f} img/s overall, {recent:.1f} img/s recent | "
+              f"queued fetch={self._to_fetch.qsize()} decode={self._to_decode.qsize()} "
+              f"predict={self._to_predict.qsize()}", flush=True)
+        return now, scored
+
+    def stop(self):
+        """Stop reading the manifest; images already in the pipeline are finished."""
+        self._stop.set()
+
+    def run(self, manifest, retry_errors=False):
+        """
+        Score every image in manifest that is not already in the output.
+
+        Args:
+            manifest (iterable): {"id", "source"} dicts (see read_manifest)
+            retry_errors (bool): Score again images whose earlier result was an error
+
+        Returns:
+            dict: Final counters plus elapsed seconds and images per second
+        """
+        done = self.writer.done_ids(retry_errors)
+        if done:
+            print(f"[bulk] Resuming: {len(done):,} images already in the output", flush=True)
+
+        started = time.monotonic()
+        reader = threading.Thread(target=self._read, args=(manifest, done), name='bulk-read', daemon=True)
+        reader.start()
+        _run_stage(self._fetch, self._to_fetch, self._to_decode, self.fetch_workers, 'bulk-fetch')
+        _run_stage(self._decode, self._to_decode, self._to_predict, self.decode_workers, 'bulk-decode')
+        inference = threading.Thread(target=self._infer, name='bulk-infer', daemon=True)
+        inference.start()
+
+        last = (started, 0)
+        while inference.is_alive():
+            inference.join(timeout=self.report_every)
+            last = self._report(started, last)
+
+        elapsed = time.monotonic() - started
+        return dict(self.counters, elapsed_s=round(elapsed, 1),
+                    images_per_second=round(self.counters["scored"] / max(elapsed, 1e-9), 1))
+
+# ============================================================================
+# 4. COMMAND LINE
+# ============================================================================
+
+def load_detector(model_path=None, cpu_workers=0, threads=None):
+    """
+    AIImageDetector for bulk scoring.
+
+    Args:
+        model_path (str): Keras weights (.h5) or a .tflite flatbuffer; by
+            default the model registry's active version (see
+            model_registry.py), else best_model.h5 when it exists, else an
+            untrained CNN
+        cpu_workers (int): Decode in a PreprocessPool of this many processes
+        threads (int): TFLite interpreter threads
+    """
+    from ml_model_example import AIImageDetector
+
+    serving = serve_from_registry(threads=threads) if model_path is None else None
+    if model_path is None and os.path.exists('best_model.h5'):
+        model_path = 'best_model.h5'
+    if serving is not None:
+        detector = AIImageDetector(serving=serving)
+    elif model_path and model_path.endswith('.tflite'):
+        detector = AIImageDetector()
+        detector.model = TFLiteModel(model_path, num_threads=threads or 1)
+    else:
+        detector = AIImageDetector(model_path)
+        if not model_path:
+            print("WARNING: No model weights, scores come from an untrained CNN")
+    if cpu_workers:
+        detector.cpu_pool = PreprocessPool(workers=cpu_workers)
+    return detector
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score a manifest of image URLs or files offline")
+    parser.add_argument('manifest', help="Text file of URLs/paths, or JSONL with url|imageUrl|path and optional id")
+    parser.add_argument('output', help="results.jsonl, or a directory for --format parquet")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'],
+                        help="Output format (default: from the output name)")
+    parser.add_argument('--model', help="Keras weights (.h5) or .tflite model (default: best_model.h5)")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--fetch-workers', type=int, default=16)
+    parser.add_argument('--decode-workers', type=int, default=4)
+    parser.add_argument('--cpu-workers', type=int, default=0,
+                        help="Decode in this many worker processes (cpu_pool) instead of threads; "
+                             "not with --multi-crop")
+    parser.add_argument('--multi-crop', action='store_true', help="Score native-resolution patches")
+    parser.add_argument('--aggregate', choices=['mean', 'max'], default='mean')
+    parser.add_argument('--timeout', type=float, default=10.0, help="Per-download timeout in seconds")
+    parser.add_argument('--checkpoint-every', type=int, default=1000, help="Results between checkpoints")
+    parser.add_argument('--report-every', type=float, default=10.0, help="Seconds between progress lines")
+    parser.add_argument('--retry-errors', action='store_true',
+                        help="Score again images whose earlier result was an error")
+    args = parser.parse_args()
+    if args.multi_crop and args.cpu_workers:
+        # Pool workers return fixed-size 224x224 arrays, not native-resolution patches
+        parser.error("--multi-crop cannot be combined with --cpu-workers")
+
+    thread_config = apply_thread_config(load_thread_config())
+    detector = load_detector(args.model, args.cpu_workers, thread_config['intra_op'])
+    scorer = BulkScorer(
+        detector,
+        open_writer(args.output, args.format),
+        fetch_workers=args.fetch_workers,
+        decode_workers=max(args.decode_workers, args.cpu_workers),
+        batch_size=args.batch_size,
+        multi_crop=args.multi_crop,
+        aggregate=args.aggregate,
+        timeout=args.timeout,
+        checkpoint_every=args.checkpoint_every,
+        report_every=args.report_every
+    )
+
+    def interrupt(signum, frame):
+        print("[bulk] Stopping: finishing images in flight, then checkpointing", flush=True)
+        scorer.stop()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)  # a second Ctrl-C exits at once
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+
+    summary = scorer.run(read_manifest(args.manifest), retry_errors=args.retry_errors)
+    if detector.cpu_pool is not None:
+        detector.cpu_pool.close()
+    print(f"[bulk] Done: {json.dumps(summary)}")
@@ -0,0 +1,615 @@
+#!/usr/bin/env python3
+"""
+Early-exit cascade for AI image detection
+Runs cheap checks first (metadata, header-only signals), then statistical
+features, and only pays for the CNN when the earlier stages are unsure.
+
+The statistical stage abstains until it is fitted on a labeled directory
+laid out like train_model.py's data/ (real/ and ai/):
+
+    python cascade_detector.py fit data --config cascade.json
+    CASCADE_CONFIG=cascade.json python cascade_detector.py
+"""
+
+import argparse
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from flask import Flask, g, request, jsonify
+from PIL import Image
+
+from image_probe import fetch_image_bytes, decode_first_frame, images_from_request, ImageRejected
+from ml_model_example import (
+    get_detector,
+    extract_statistical_features
+)
+from model_registry import HotModel
+from model_serving import apply_thread_config, available_cores, load_thread_config
+from admission import AdmissionController
+from response_codec import install_codec
+from deadline import DeadlineExceeded, deadline_stats, stage
+
+app = install_codec(Flask(__name__))
+
+# CPU-bound: about one request per core, the rest wait or are shed
+admission = AdmissionController.from_env('cascade', max_in_flight=available_cores())
+
+# ============================================================================
+# 1. CONFIGURATION
+# ============================================================================
+
+# Order matters: stages run left to right and the last one always answers.
+# A stage exits early when its confidence reaches its threshold.
+DEFAULT_CASCADE_CONFIG = {
+    "stages": ["metadata", "statistical", "cnn"],
+    "thresholds": {
+        "metadata": 0.9,
+        "statistical": 0.9,
+        "cnn": 0.0
+    },
+    # Logistic regression over STATISTICAL_FEATURE_NAMES, written by
+    # `cascade_detector.py fit`. With no weights the statistical stage abstains.
+    "statistical_weights": [],
+    "statistical_bias": 0.0
+}
+
+# Same feature order as the stats branch of create_ensemble_model
+STATISTICAL_FEATURE_NAMES = [
+    'mean_intensity', 'std_intensity', 'skewness', 'kurtosis',
+    'edge_density', 'lbp_variance',
+    'red_mean', 'red_std', 'green_mean', 'green_std', 'blue_mean', 'blue_std'
+]
+
+# Keywords that image generators write into PNG text chunks, EXIF or XMP
+GENERATOR_KEYWORDS = [
+    'stable diffusion', 'midjourney', 'dall-e', 'dall·e', 'novelai',
+    'comfyui', 'automatic1111', 'invokeai', 'firefly', 'imagen',
+    'negative prompt:', 'sampler:', 'cfg scale:'
+]
+
+# PNG text chunks that only generator front-ends write
+GENERATOR_PNG_KEYS = ['parameters', 'prompt', 'workflow', 'invokeai_metadata', 'sd-metadata']
+
+# IPTC digital source types for AI-generated media (found in XMP)
+IPTC_AI_SOURCE_TYPES = ['trainedalgorithmicmedia', 'compositewithtrainedalgorithmicmedia']
+
+# Native output sizes of popular generators; only a weak prior
+GENERATOR_SIZES = {
+    (512, 512), (768, 768), (1024, 1024), (512, 768), (768, 512),
+    (832, 1216), (1216, 832), (896, 1152), (1152, 896),
+    (1024, 1792), (1792, 1024), (1344, 768), (768, 1344)
+}
+
+EXIF_MAKE = 271
+EXIF_MODEL = 272
+EXIF_SOFTWARE = 305
+EXIF_IMAGE_DESCRIPTION = 270
+
+
+def load_cascade_config(path=None):
+    """
+    Load cascade configuration, overlaying a JSON file on the defaults.
+
+    Args:
+        path (str): Path to a JSON config file (defaults to $CASCADE_CONFIG)
+
+    Returns:
+        dict: Cascade configuration
+    """
+    config = json.loads(json.dumps(DEFAULT_CASCADE_CONFIG))
+    path = path or os.getenv('CASCADE_CONFIG')
+    if not path:
+        return config
+
+    with open(path) as f:
+        overrides = json.load(f)
+
+    thresholds = overrides.pop('thresholds', {})
+    config.update(overrides)
+    config['thresholds'].update(thresholds)
+    return config
+
+# ============================================================================
+# 2. CASCADE INPUT
+# ============================================================================
+
+class CascadeInput:
+    """
+    Image bytes plus lazily computed views of them.
+
+    Every view is computed at most once, so a later stage reuses whatever an
+    earlier stage already decoded.
+    """
+
+    def __init__(self, image_bytes):
+        self.image_bytes = image_bytes
+        self._header = None
+        self._array = None
+
+    @property
+    def header(self):
+        """PIL image opened lazily: size, format and metadata, no pixel decode."""
+        if self._header is None:
+            self._header = Image.open(io.BytesIO(self.image_bytes))
+        return self._header
+
+    @property
+    def array(self):
+        """224x224 RGB array in [0, 1], the same input download_and_preprocess_image gives."""
+        if self._array is None:
+            image = decode_first_frame(self.image_bytes)
+            self._array = np.array(image.resize((224, 224))) / 255.0
+        return self._array
+
+# ============================================================================
+# 3. STAGES
+# ============================================================================
+#
+# A stage is a callable taking a CascadeInput and returning either None
+# (abstain) or a dict with at least "label", "confidence" and "analysis".
+
+def _metadata_text(img):
+    """Collect the metadata strings a generator might have written."""
+    texts = {}
+
+    for key, value in img.info.items():
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', errors='ignore')
+        if isinstance(value, str):
+            texts[str(key).lower()] = value
+
+    exif = img.getexif()
+    for tag in (EXIF_SOFTWARE, EXIF_IMAGE_DESCRIPTION):
+        if exif.get(tag):
+            texts[f'exif_{tag}'] = str(exif.get(tag))
+
+    return texts, exif
+
+
+def metadata_stage(cascade_input):
+    """
+    Stage 1: metadata and header-only signals.
+
+    Reads PNG text chunks, EXIF and XMP without decoding any pixels.
+    Generator fingerprints and IPTC AI source types point to "ai", camera
+    make/model points to "real". Typical generator output sizes are only a
+    weak prior that never clears the default threshold on its own.
+    """
+    img = cascade_input.header
+    width, height = img.size
+    texts, exif = _metadata_text(img)
+
+    for key in GENERATOR_PNG_KEYS:
+        if key in texts:
+            return {"label": "ai", "confidence": 0.97,
+                    "analysis": f"Generator metadata chunk '{key}'"}
+
+    blob = " ".join(texts.values()).lower()
+    for source_type in IPTC_AI_SOURCE_TYPES:
+        if source_type in blob:
+            return {"label": "ai", "confidence": 0.99,
+                    "analysis": "IPTC digital source type marks AI-generated media"}
+    for keyword in GENERATOR_KEYWORDS:
+        if keyword in blob:
+            return {"label": "ai", "confidence": 0.95,
+                    "analysis": f"Generator keyword '{keyword}' in metadata"}
+
+    make, model = exif.get(EXIF_MAKE), exif.get(EXIF_MODEL)
+    if make and model:
+        return {"label": "real", "confidence": 0.92,
+                "analysis": f"Camera EXIF: {str(make).strip()} {str(model).strip()}"}
+    if make or model:
+        return {"label": "real", "confidence": 0.8,
+                "analysis": f"Partial camera EXIF: {str(make or model).strip()}"}
+
+    if (width, height) in GENERATOR_SIZES:
+        return {"label": "ai", "confidence": 0.6,
+                "analysis": f"Typical generator size {width}x{height}"}
+
+    return None
+
+
+def make_statistical_stage(weights, bias=0.0):
+    """
+    Stage 2: logistic regression over the statistical features.
+
+    Args:
+        weights (list): One weight per STATISTICAL_FEATURE_NAMES entry
+        bias (float): Intercept
+
+    Returns:
+        callable: Stage function (abstains when no weights are configured)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+
+    def statistical_stage(cascade_input):
+        if weights.size != len(STATISTICAL_FEATURE_NAMES):
+            return None
+
+        features = extract_statistical_features(cascade_input.array)
+        x = np.array([features[name] for name in STATISTICAL_FEATURE_NAMES], dtype=np.float64)
+        if not np.all(np.isfinite(x)):
+            return None
+
+        ai_probability = float(1.0 / (1.0 + np.exp(-(x @ weights + bias))))
+        label = "ai" if ai_probability > 0.5 else "real"
+        return {
+            "label": label,
+            "confidence": ai_probability if label == "ai" else 1 - ai_probability,
+            "analysis": f"Statistical features, AI probability {ai_probability:.2f}"
+        }
+
+    return statistical_stage
+
+
+def statistical_feature_matrix(paths, workers=8):
+    """
+    STATISTICAL_FEATURE_NAMES for each image file, from the same 224x224
+    [0, 1] array the cascade computes them on.
+
+    Returns:
+        np.ndarray: (n, features); rows of NaN for files that fail to decode
+    """
+    from evaluate import load_image
+
+    def features(path):
+        try:
+            array = load_image(path) / 255.0
+        except Exception:
+            return np.full(len(STATISTICAL_FEATURE_NAMES), np.nan)
+        values = extract_statistical_features(array)
+        return np.array([values[name] for name in STATISTICAL_FEATURE_NAMES], dtype=np.float64)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return np.stack(list(pool.map(features, paths)))
+
+
+def fit_statistical_weights(features, labels, threshold=0.9, validation=0.2, seed=0):
+    """
+    Fit the statistical stage's logistic regression.
+
+    Newton's method on the L2-regularized log loss (C=1, as scikit-learn's
+    default). Features are standardized for the fit and the scaling is
+    folded back into the weights, so the stage keeps working on raw
+    features. A seeded,
+    stratified share of the images is held out to report how the stage
+    would do at its threshold.
+
+    Args:
+        features (np.ndarray): (n, features) from statistical_feature_matrix
+        labels (np.ndarray): 0 (real) / 1 (ai) per row
+        threshold (float): The stage's exit threshold, for the report
+        validation (float): Held-out fraction
+
+    Returns:
+        tuple: (weights list, bias, report dict)
+    """
+    finite = np.all(np.isfinite(features), axis=1)
+    features, labels = features[finite], np.asarray(labels)[finite]
+    rng = np.random.default_rng(seed)
+    held_out = np.zeros(len(labels), dtype=bool)
+    for label in (0, 1):
+        rows = rng.permutation(np.flatnonzero(labels == label))
+        held_out[rows[:int(round(len(rows) * validation))]] = True
+    train = ~held_out
+    if len(np.unique(labels[train])) < 2:
+        raise ValueError("Fitting needs decodable images of both classes (real/ and ai/)")
+
+    mean = features[train].mean(axis=0)
+    std = features[train].std(axis=0)
+    std[std == 0] = 1.0
+    x = np.hstack([(features[train] - mean) / std, np.ones((int(train.sum()), 1))])
+    y = labels[train].astype(np.float64)
+    penalty = np.eye(x.shape[1])
+    penalty[-1, -1] = 0.0  # the intercept is not regularized
+    theta = np.zeros(x.shape[1])
+    for _ in range(50):
+        p = 1.0 / (1.0 + np.exp(-(x @ theta)))
+        gradient = x.T @ (p - y) + penalty @ theta
+        hessian = (x * (p * (1 - p))[:, None]).T @ x + penalty
+        step = np.linalg.solve(hessian, gradient)
+        theta -= step
+        if np.abs(step).max() < 1e-8:
+            break
+    weights = theta[:-1] / std
+    bias = float(theta[-1] - np.sum(weights * mean))
+
+    report = {"train": int(train.sum()), "validation": int(held_out.sum()), "skipped": int((~finite).sum())}
+    if held_out.any():
+        ai_probability = 1.0 / (1.0 + np.exp(-(features[held_out] @ weights + bias)))
+        predicted = (ai_probability > 0.5).astype(labels.dtype)
+        correct = predicted == labels[held_out]
+        exits = np.maximum(ai_probability, 1 - ai_probability) >= threshold
+        report.update(
+            validation_accuracy=round(float(correct.mean()), 4),
+            exit_rate=round(float(exits.mean()), 4),
+            exit_accuracy=round(float(correct[exits].mean()), 4) if exits.any() else None
+        )
+    return weights.tolist(), bias, report
+
+
+def make_cnn_stage(serving):
+    """
+    Stage 3: the CNN from ml_model_example.
+
+    Args:
+        serving (HotModel): Model returning [real, ai] probabilities; each
+            call pins the current version, so registry swaps take effect
+
+    Returns:
+        callable: Stage function
+    """
+    def cnn_stage(cascade_input):
+        with serving.acquire() as served:
+            prediction = served.model.predict(np.expand_dims(cascade_input.array, axis=0), verbose=0)
+        ai_probability = float(prediction[0][1])
+        label = "ai" if ai_probability > 0.5 else "real"
+        return {
+            "label": label,
+            "confidence": ai_probability if label == "ai" else 1 - ai_probability,
+            "analysis": f"CNN AI probability {ai_probability:.2f}",
+            "model_version": served.version
+        }
+
+    return cnn_stage
+
+# ============================================================================
+# 4. CASCADE
+# ============================================================================
+
+class CascadeDetector:
+    """
+    Runs stages in order and stops at the first confident answer.
+
+    Keeps per-stage counters so the hit rate of each stage and the latency
+    saved by exiting early can be reported.
+    """
+
+    def __init__(self, stages):
+        """
+        Args:
+            stages (list): (name, stage_fn, threshold) tuples in run order
+        """
+        if not stages:
+            raise ValueError("cascade needs at least one stage")
+        self.stages = stages
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._stats = {
+            name: {"runs": 0, "exits": 0, "skipped": 0, "total_ms": 0.0}
+            for name, _, _ in stages
+        }
+
+    def _mean_ms(self, name):
+        stats = self._stats[name]
+        return stats["total_ms"] / stats["runs"] if stats["runs"] else 0.0
+
+    def classify(self, image_bytes, deadline=None):
+        """
+        Classify raw image bytes.
+
+        Each stage is checked against the request deadline before it runs,
+        so an expensive late stage is never started for a client that has
+        already given up.
+
+        Returns:
+            dict: label, confidence, source, the stage that answered and
+            per-stage timings
+
+        Raises:
+            DeadlineExceeded: if the deadline passed
+        """
+        cascade_input = CascadeInput(image_bytes)
+        timings = {}
+        result, exit_index = None, len(self.stages) - 1
+
+        for index, (name, stage_fn, threshold) in enumerate(self.stages):
+            start = time.perf_counter()
+            with stage(deadline, name):
+                stage_result = stage_fn(cascade_input)
+            timings[name] = (time.perf_counter() - start) * 1000
+
+            if stage_result is None:
+                continue
+            # Keep the most confident answer so far in case nobody clears a threshold
+            if result is None or stage_result["confidence"] > result["confidence"]:
+                result = dict(stage_result, stage=name)
+
+            is_last = index == len(self.stages) - 1
+            if is_last or stage_result["confidence"] >= threshold:
+                result = dict(stage_result, stage=name)
+                exit_index = index
+                break
+
+        with self._lock:
+            self._requests += 1
+            for name, elapsed in timings.items():
+                self._stats[name]["runs"] += 1
+                self._stats[name]["total_ms"] += elapsed
+            if result is not None:
+                self._stats[result["stage"]]["exits"] += 1
+            for name, _, _ in self.stages[exit_index + 1:]:
+                self._stats[name]["skipped"] += 1
+
+        if result is None:
+            return {"error": "no cascade stage could classify the image"}
+
+        result["source"] = f"cascade_{result['stage']}"
+        result["stage_latency_ms"] = {k: round(v, 2) for k, v in timings.items()}
+        return result
+
+    def classify_url(self, image_url, deadline=None):
+        """Download an image and classify it; a rejected image is reported with "rejected"."""
+        try:
+            image_bytes, _ = fetch_image_bytes(image_url, timeout=10, deadline=deadline)
+            return self.classify(image_bytes, deadline)
+        except DeadlineExceeded:
+            raise
+        except ImageRejected as e:
+            return {"error": str(e), "rejected": e.reason}
+        except Exception as e:
+            return {"error": str(e)}
+
+    def stats(self):
+        """
+        Per-stage hit rates and mean latency, plus total latency saved.
+
+        Saved latency is estimated as the number of times each stage was
+        skipped times its mean latency over the requests where it did run.
+        """
+        with self._lock:
+            stages = {}
+            saved_ms = 0.0
+            for name, _, threshold in self.stages:
+                s = self._stats[name]
+                stages[name] = {
+                    "threshold": threshold,
+                    "runs": s["runs"],
+                    "exits": s["exits"],
+                    "hit_rate": s["exits"] / s["runs"] if s["runs"] else 0.0,
+                    "skipped": s["skipped"],
+                    "mean_ms": round(self._mean_ms(name), 2)
+                }
+                saved_ms += s["skipped"] * self._mean_ms(name)
+            return {
+                "requests": self._requests,
+                "stages": stages,
+                "latency_saved_ms": round(saved_ms, 2),
+                "latency_saved_per_request_ms": round(saved_ms / self._requests, 2) if self._requests else 0.0
+            }
+
+
+def build_cascade(config=None, model=None):
+    """
+    Build a CascadeDetector from configuration.
+
+    Args:
+        config (dict): Cascade configuration (see DEFAULT_CASCADE_CONFIG)
+        model (tf.keras.Model): Fixed CNN for the last stage (defaults to
+            the ml_model_example detector's HotModel, which follows the
+            model registry)
+
+    Returns:
+        CascadeDetector: Configured cascade
+    """
+    config = config or load_cascade_config()
+    factories = {
+        "metadata": lambda: metadata_stage,
+        "statistical": lambda: make_statistical_stage(
+            config.get("statistical_weights", []), config.get("statistical_bias", 0.0)),
+        "cnn": lambda: make_cnn_stage(HotModel.fixed(model, 'custom') if model is not None
+                                      else get_detector().serving)
+    }
+
+    stages = []
+    for name in config["stages"]:
+        if name not in factories:
+            raise ValueError(f"Unknown cascade stage: {name}")
+        stages.append((name, factories[name](), config["thresholds"].get(name, 1.0)))
+
+    return CascadeDetector(stages)
+
+# ============================================================================
+# 5. FLASK API SERVER
+# ============================================================================
+
+# Built on first use, so `fit` runs without a trained CNN
+cascade = None
+_cascade_lock = threading.Lock()
+
+
+def get_cascade():
+    """The served cascade, built from $CASCADE_CONFIG on first use."""
+    global cascade
+    with _cascade_lock:
+        if cascade is None:
+            # Size TensorFlow/OpenCV thread pools before the CNN stage starts the runtime
+            apply_thread_config(load_thread_config())
+            cascade = build_cascade()
+        return cascade
+
+@app.route('/classify', methods=['POST'])
+@admission.limit
+def classify_image():
+    """Flask endpoint for image classification"""
+    try:
+        # Image bytes uploaded by the client skip the server-side refetch
+        uploads = images_from_request(request)
+        if uploads is not None:
+            if len(uploads) != 1:
+                return jsonify({"error": "exactly one image required"}), 400
+            result = get_cascade().classify(uploads[0][0], g.deadline)
+        else:
+            data = request.get_json()
+            image_url = data.get('imageUrl')
+
+            if not image_url:
+                return jsonify({"error": "imageUrl required"}), 400
+
+            result = get_cascade().classify_url(image_url, g.deadline)
+
+        if result.get('rejected'):
+            return jsonify(result), 400
+        if result.get('error'):
+            return jsonify(result), 502
+        return jsonify(result)
+
+    except ImageRejected as e:
+        return jsonify({"error": str(e), "rejected": e.reason}), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint, includes per-stage cascade statistics"""
+    return jsonify({
+        "status": "healthy",
+        "cascade": get_cascade().stats(),
+        "admission": admission.snapshot(),
+        "deadlines": deadline_stats()
+    })
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cascade AI detection server")
+    commands = parser.add_subparsers(dest='command')
+    fit = commands.add_parser('fit', help="Fit the statistical stage on a labeled directory")
+    fit.add_argument('dataset', help="Directory with real/ and ai/ subdirectories")
+    fit.add_argument('--config', default=os.getenv('CASCADE_CONFIG') or 'cascade.json',
+                     help="Cascade config JSON the weights are written into (created if missing)")
+    fit.add_argument('--workers', type=int, default=8, help="Decode threads")
+    fit.add_argument('--validation', type=float, default=0.2, help="Held-out fraction")
+    args = parser.parse_args()
+
+    if args.command == 'fit':
+        from evaluate import list_labeled_files
+
+        paths, labels = list_labeled_files(args.dataset)
+        overrides = {}
+        if os.path.exists(args.config):
+            with open(args.config) as f:
+                overrides = json.load(f)
+        threshold = overrides.get('thresholds', {}).get('statistical',
+                                                        DEFAULT_CASCADE_CONFIG['thresholds']['statistical'])
+        weights, bias, report = fit_statistical_weights(
+            statistical_feature_matrix(paths, args.workers), labels, threshold, args.validation)
+        overrides.update(statistical_weights=weights, statistical_bias=bias)
+        with open(args.config, 'w') as f:
+            json.dump(overrides, f, indent=2)
+        print(f"Fitted on {report['train']} images ({report['skipped']} could not be used)")
+        if report['validation']:
+            print(f"Held out {report['validation']}: accuracy {report['validation_accuracy']}, "
+                  f"{report['exit_rate']:.0%} exit at threshold {threshold} "
+                  f"with accuracy {report['exit_accuracy']}")
+        print(f"Weights written to {args.config}; serve with CASCADE_CONFIG={args.config}")
+        raise SystemExit(0)
+
+    get_cascade()
+    print("Starting cascade AI Detection API on http://localhost:5002")
+    app.run(debug=True, port=5002, host='0.0.0.0')
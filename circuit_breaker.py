@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Circuit breakers and hedged requests for upstream classifier backends
+A breaker per upstream tracks failure rate and slow calls over a sliding
+window. When it trips, calls fail fast instead of waiting out timeouts, and
+after a cool-down a few half-open probes decide whether to close it again.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+
+from deadline import DeadlineExceeded
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def _percentile(values, percentile):
+    """Percentile of a non-empty list, interpolated linearly like numpy's default."""
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percentile / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"Upstream '{name}' unavailable (circuit open, retry in {retry_in:.0f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Failure-rate and latency circuit breaker for one upstream.
+
+    Closed: calls go through and outcomes are recorded in a sliding window.
+    Open: calls fail fast with CircuitOpenError for open_seconds.
+    Half-open: up to half_open_probes calls go through; a success closes the
+    breaker, a failure opens it again.
+    """
+
+    def __init__(self, name, failure_rate_threshold=0.5, slow_call_ms=8000,
+                 slow_rate_threshold=0.8, window_size=20, min_calls=5,
+                 open_seconds=30, half_open_probes=1):
+        """
+        Args:
+            name (str): Upstream name, shown in /health
+            failure_rate_threshold (float): Failed fraction of the window that trips the breaker
+            slow_call_ms (float): Calls slower than this count as slow
+            slow_rate_threshold (float): Slow fraction of the window that trips the breaker
+            window_size (int): Number of recent calls considered
+            min_calls (int): Calls needed in the window before it can trip
+            open_seconds (float): How long to fail fast before probing
+            half_open_probes (int): Concurrent probe calls allowed while half-open
+        """
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_ms = slow_call_ms
+        self.slow_rate_threshold = slow_rate_threshold
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self._lock = threading.Lock()
+        self._window = deque(maxlen=window_size)  # (failed, latency_ms)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._rejected = 0
+        self._trips = 0
+
+    def _rates(self):
+        calls = len(self._window)
+        if not calls:
+            return 0.0, 0.0
+        failures = sum(1 for failed, _ in self._window if failed)
+        slow = sum(1 for _, latency in self._window if latency >= self.slow_call_ms)
+        return failures / calls, slow / calls
+
+    def _trip(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probes_in_flight = 0
+        self._trips += 1
+
+    def allow(self):
+        """Return True if a call may go through now (reserves a probe slot when half-open)."""
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self._rejected += 1
+                    return False
+                self._state = HALF_OPEN
+                self._probes_in_flight = 0
+
+            if self._state == HALF_OPEN:
+                if self._probes_in_flight >= self.half_open_probes:
+                    self._rejected += 1
+                    return False
+                self._probes_in_flight += 1
+
+            return True
+
+    def record(self, failed, latency_ms):
+        """Record the outcome of a call that allow() let through."""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed or latency_ms >= self.slow_call_ms:
+                    self._trip()
+                else:
+                    self._state = CLOSED
+                    self._window.clear()
+                self._window.append((failed, latency_ms))
+                return
+
+            self._window.append((failed, latency_ms))
+            if self._state == CLOSED and len(self._window) >= self.min_calls:
+                failure_rate, slow_rate = self._rates()
+                if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_rate_threshold:
+                    self._trip()
+
+    def release(self):
+        """Give back a call allow() let through without recording an outcome."""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def latency_percentile(self, percentile=95):
+        """Latency percentile in ms over the window, or None before min_calls successes."""
+        with self._lock:
+            latencies = [latency for failed, latency in self._window if not failed]
+        if len(latencies) < self.min_calls:
+            return None
+        return float(_percentile(latencies, percentile))
+
+    def call(self, fn, *args, hedge=False, is_failure=None, **kwargs):
+        """
+        Call fn through the breaker.
+
+        Exceptions raised by fn count as failures and are re-raised, except
+        DeadlineExceeded (the caller's own deadline says nothing about the
+        upstream) and CircuitOpenError from a nested breaker.
+
+        Args:
+            fn (callable): Upstream call
+            hedge (bool): Fire a second attempt if the first is slower than
+                the window's p95 latency
+            is_failure (callable): Takes an exception raised by fn and says
+                whether it counts against the upstream (all do by default);
+                the others are recorded as successful calls, e.g. a 4xx
+                answer, which shows the upstream is up
+
+        Raises:
+            CircuitOpenError: if the breaker is open
+        """
+        if not self.allow():
+            with self._lock:
+                retry_in = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+            raise CircuitOpenError(self.name, retry_in)
+
+        start = time.perf_counter()
+        try:
+            hedge_delay = self.latency_percentile(95) if hedge else None
+            if hedge_delay is not None:
+                result = hedged_call(fn, hedge_delay / 1000, *args, **kwargs)
+            else:
+                result = fn(*args, **kwargs)
+        except (DeadlineExceeded, CircuitOpenError):
+            self.release()
+            raise
+        except Exception as e:
+            self.record(is_failure is None or is_failure(e), (time.perf_counter() - start) * 1000)
+            raise
+
+        self.record(False, (time.perf_counter() - start) * 1000)
+        return result
+
+    def snapshot(self):
+        """Breaker state for /health."""
+        with self._lock:
+            failure_rate, slow_rate = self._rates()
+            state = self._state
+            if state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                state = HALF_OPEN
+            return {
+                "state": state,
+                "calls_in_window": len(self._window),
+                "failure_rate": round(failure_rate, 3),
+                "slow_rate": round(slow_rate, 3),
+                "trips": self._trips,
+                "rejected": self._rejected
+            }
+
+# ============================================================================
+# HEDGED REQUESTS
+# ============================================================================
+
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+
+
+def hedged_call(fn, hedge_delay, *args, **kwargs):
+    """
+    Run fn, and run it a second time if the first attempt is still pending
+    after hedge_delay seconds. Returns whichever succeeds first.
+
+    A first attempt that fails before the delay is not hedged; its error is
+    raised as is. The losing attempt is left to finish in the background.
+    """
+    first = _HEDGE_EXECUTOR.submit(fn, *args, **kwargs)
+    try:
+        return first.result(timeout=hedge_delay)
+    except FutureTimeout:
+        pass
+
+    second = _HEDGE_EXECUTOR.submit(fn, *args, **kwargs)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+# ============================================================================
+# REGISTRY
+# ============================================================================
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(name, **options):
+    """Return the process-wide breaker for an upstream, creating it on first use."""
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, **options)
+            _BREAKERS[name] = breaker
+        return breaker
+
+
+def breaker_states():
+    """Snapshot of every breaker, keyed by upstream name."""
+    with _BREAKERS_LOCK:
+        breakers = list(_BREAKERS.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Process-pool CPU offload for decode, preprocessing and feature extraction
+PIL decode, resizing and the statistical features run in worker processes so
+they do not contend for the GIL with request handling. Preprocessed arrays
+come back through shared-memory slots instead of being pickled; model
+inference stays in the parent process.
+"""
+
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from deadline import DeadlineExceeded
+from image_features import extract_statistical_features
+from image_probe import decode_first_frame
+
+# Modules preloaded by the fork server; none of them import TensorFlow
+_PRELOAD = ['image_probe', 'image_features', 'numpy', 'PIL.Image', 'cv2']
+
+# ============================================================================
+# 1. WORKER SIDE
+# ============================================================================
+
+def _preprocess_task(image_bytes, shm_name, target_size, with_features, limits):
+    """
+    Decode, resize and normalize one image into a shared-memory slot.
+
+    Returns:
+        tuple: (original size, features dict or None); the pixels are in the slot
+    """
+    image = decode_first_frame(image_bytes, limits)
+    original_size = image.size
+    image = image.resize(target_size)
+
+    # Workers share the parent's resource tracker, which keeps ownership of
+    # the segment; attaching here does not transfer it
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray((target_size[1], target_size[0], 3), dtype=np.float32, buffer=shm.buf)
+        np.divide(np.asarray(image, dtype=np.float32), 255.0, out=out)
+        features = extract_statistical_features(out) if with_features else None
+        del out
+    finally:
+        shm.close()
+
+    if features is not None:
+        features = {k: float(v) for k, v in features.items()}
+    return original_size, features
+
+
+class _Abandoned(DeadlineExceeded):
+    """The deadline passed while the task ran; its slot is freed when it finishes or is killed."""
+
+# ============================================================================
+# 2. PARENT SIDE
+# ============================================================================
+
+class PreprocessPool:
+    """
+    Pool of worker processes for decode + preprocessing + features.
+
+    Each in-flight task owns one preallocated shared-memory slot sized for a
+    target_size float32 image, so there are at most `slots` tasks in flight.
+    A crashed worker breaks the executor; it is rebuilt and the task retried
+    once. A task that exceeds task_timeout has its workers terminated and the
+    pool rebuilt, so a wedged decode cannot pin a worker forever. That also
+    holds for tasks whose request gave up on them earlier: they may finish,
+    but not run past task_timeout while holding their slot.
+    """
+
+    def __init__(self, workers=None, task_timeout=10.0, target_size=(224, 224), slots=None, limits=None):
+        """
+        Args:
+            workers (int): Worker processes (defaults to the CPU count)
+            task_timeout (float): Seconds before a task is abandoned
+            target_size (tuple): (width, height) of the preprocessed image
+            slots (int): Shared-memory slots, i.e. max tasks in flight (defaults to 2 x workers)
+            limits (dict): image_probe limits applied when decoding
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.task_timeout = task_timeout
+        self.target_size = tuple(target_size)
+        self.limits = limits
+
+        # fork() after TensorFlow has started threads is unsafe, so workers
+        # come from a fork server (or spawn where that does not exist)
+        if sys.platform != 'win32':
+            self._context = multiprocessing.get_context('forkserver')
+            self._context.set_forkserver_preload(_PRELOAD)
+        else:
+            self._context = multiprocessing.get_context('spawn')
+
+        slot_bytes = self.target_size[0] * self.target_size[1] * 3 * np.dtype(np.float32).itemsize
+        self._segments = [shared_memory.SharedMemory(create=True, size=slot_bytes)
+                          for _ in range(slots or 2 * self.workers)]
+        self._free = queue.Queue()
+        for index in range(len(self._segments)):
+            self._free.put(index)
+
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+        self._counters = {"tasks": 0, "failures": 0, "timeouts": 0, "restarts": 0, "abandoned": 0}
+
+    @classmethod
+    def from_env(cls):
+        """Build a pool from CPU_POOL_WORKERS / CPU_POOL_TIMEOUT, or None if disabled."""
+        workers = int(os.getenv('CPU_POOL_WORKERS', '0'))
+        if workers <= 0:
+            return None
+        return cls(workers=workers, task_timeout=float(os.getenv('CPU_POOL_TIMEOUT', '10')))
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context)
+
+    def _restart(self, executor, kill=False):
+        """Replace a broken or wedged executor (only once per failure)."""
+        with self._lock:
+            if kill:
+                # A running task cannot be cancelled, so stop its processes
+                # (even if another failure already replaced the executor)
+                for process in list((getattr(executor, '_processes', None) or {}).values()):
+                    process.terminate()
+            if self._executor is not executor:
+                return
+            executor.shutdown(wait=False)
+            self._executor = self._new_executor()
+            self._counters["restarts"] += 1
+
+    def _abandon(self, executor, future, slot, submitted):
+        """
+        Hand a task's slot back once its worker can no longer write to it:
+        when the task finishes, or when it is killed at task_timeout.
+        """
+        released = threading.Event()
+
+        def release(_=None):
+            with self._lock:
+                if released.is_set():
+                    return
+                released.set()
+            self._free.put(slot)
+
+        def watchdog():
+            if future.done():
+                return
+            with self._lock:
+                self._counters["timeouts"] += 1
+            self._restart(executor, kill=True)
+            release()
+
+        future.add_done_callback(release)
+        timer = threading.Timer(max(0.0, submitted + self.task_timeout - time.monotonic()), watchdog)
+        timer.daemon = True
+        timer.start()
+
+    def _run(self, slot, image_bytes, with_features, deadline=None):
+        name = self._segments[slot].name
+        for attempt in range(2):
+            executor = self._executor
+            timeout = self.task_timeout
+            if deadline is not None:
+                timeout = deadline.timeout(timeout, 'preprocess')
+            try:
+                submitted = time.monotonic()
+                future = executor.submit(_preprocess_task, image_bytes, name,
+                                         self.target_size, with_features, self.limits)
+                return future.result(timeout=timeout)
+            except BrokenProcessPool:
+                # A worker died (segfault in a decoder, OOM kill...): rebuild and retry once
+                self._restart(executor)
+                if attempt == 1:
+                    raise
+            except FutureTimeout:
+                if timeout < self.task_timeout:
+                    # The request ran out of time, the worker is probably fine:
+                    # let the task finish (up to task_timeout) and only then
+                    # hand its slot to someone else
+                    with self._lock:
+                        self._counters["abandoned"] += 1
+                    self._abandon(executor, future, slot, submitted)
+                    raise _Abandoned(stage='preprocess')
+                with self._lock:
+                    self._counters["timeouts"] += 1
+                self._restart(executor, kill=True)
+                raise TimeoutError(f"preprocessing exceeded {self.task_timeout}s")
+
+    def preprocess(self, image_bytes, with_features=False, deadline=None):
+        """
+        Decode and preprocess one image in a worker process.
+
+        Args:
+            image_bytes (bytes): Encoded image
+            with_features (bool): Also compute the statistical features
+            deadline (Deadline): Request deadline; bounds the wait for the worker
+
+        Returns:
+            tuple: (array of shape (H, W, 3) in [0, 1], features dict or None)
+
+        Raises:
+            TimeoutError: if the task exceeded task_timeout
+            ImageRejected: if the decoded image breaks a limit
+            DeadlineExceeded: if the deadline passed first, including while
+                waiting for a free slot
+        """
+        try:
+            slot = self._free.get(timeout=max(0.0, deadline.remaining()) if deadline is not None else None)
+        except queue.Empty:
+            raise DeadlineExceeded(stage='preprocess')
+        release = True
+        try:
+            with self._lock:
+                self._counters["tasks"] += 1
+            try:
+                _, features = self._run(slot, image_bytes, with_features, deadline)
+            except _Abandoned:
+                release = False
+                raise
+            except Exception:
+                with self._lock:
+                    self._counters["failures"] += 1
+                raise
+
+            shape = (self.target_size[1], self.target_size[0], 3)
+            view = np.ndarray(shape, dtype=np.float32, buffer=self._segments[slot].buf)
+            # One memcpy out of the slot so it can be reused immediately
+            return np.array(view), features
+        finally:
+            if release:
+                self._free.put(slot)
+
+    def stats(self):
+        """Task, failure, timeout and restart counters."""
+        with self._lock:
+            return dict(self._counters, workers=self.workers, slots=len(self._segments))
+
+    def close(self):
+        """Stop the workers and release the shared-memory slots."""
+        self._executor.shutdown(wait=True)
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+End-to-end request deadlines
+A Deadline is created once per request (from the client's
+X-Request-Timeout-Ms header or a default) and handed down through download,
+decode, features, inference and upstream calls. Each stage checks it before
+starting, bounds its own timeouts by what is left, and is cancelled once it
+runs out, so no work continues after the client has stopped waiting.
+Per-stage timings, including the time spent on cancelled work, are kept for
+/health.
+"""
+
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Clients send their remaining budget; the extension aborts after 12 s
+TIMEOUT_HEADER = 'X-Request-Timeout-Ms'
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's deadline passes (or cannot be met)."""
+
+    def __init__(self, message="Request deadline exceeded", stage=None):
+        super().__init__(message if stage is None else f"{message} during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Absolute time.monotonic() deadline for one request."""
+
+    def __init__(self, timeout):
+        """
+        Args:
+            timeout (float): Seconds from now
+        """
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + timeout
+
+    @classmethod
+    def from_request(cls, req, default_timeout):
+        """Deadline from X-Request-Timeout-Ms, else default_timeout seconds from now."""
+        timeout = default_timeout
+        header = req.headers.get(TIMEOUT_HEADER)
+        if header:
+            try:
+                timeout = max(0.0, float(header) / 1000)
+            except ValueError:
+                pass
+        return cls(timeout)
+
+    def remaining(self):
+        """Seconds left (negative once expired)."""
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, stage=None):
+        """Raise DeadlineExceeded if the deadline has passed."""
+        if self.expired():
+            raise DeadlineExceeded(stage=stage)
+
+    def timeout(self, cap, stage=None):
+        """A timeout for a blocking call: cap, or less if less time remains."""
+        self.check(stage)
+        return min(cap, self.remaining())
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Run one stage of the request against the deadline.
+
+        The stage is skipped if the deadline already passed. An error raised
+        after the deadline passed (a timeout bounded by timeout(), an explicit
+        check()) becomes DeadlineExceeded, and a stage that finishes late
+        raises it too so nothing further runs. Either way the time spent is
+        recorded as cancelled work.
+        """
+        if self.expired():
+            _record(name, "skipped", 0.0)
+            raise DeadlineExceeded(stage=name)
+
+        start = time.perf_counter()
+        try:
+            yield self
+        except Exception as e:
+            if not isinstance(e, DeadlineExceeded) and not self.expired():
+                raise
+            _record(name, "cancelled", (time.perf_counter() - start) * 1000)
+            if isinstance(e, DeadlineExceeded):
+                raise
+            raise DeadlineExceeded(stage=name) from e
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if self.expired():
+            _record(name, "cancelled", elapsed_ms)
+            raise DeadlineExceeded(stage=name)
+        _record(name, "completed", elapsed_ms)
+
+
+def stage(deadline, name):
+    """deadline.stage(name), or a no-op context when there is no deadline."""
+    return deadline.stage(name) if deadline is not None else nullcontext()
+
+
+def bounded_timeout(deadline, cap, stage=None):
+    """deadline.timeout(cap), or cap when there is no deadline."""
+    return deadline.timeout(cap, stage) if deadline is not None else cap
+
+# ============================================================================
+# METRICS
+# ============================================================================
+
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+
+
+def _record(name, outcome, elapsed_ms):
+    with _METRICS_LOCK:
+        metrics = _METRICS.setdefault(name, {
+            "completed": 0, "completed_ms": 0.0,
+            "cancelled": 0, "cancelled_ms": 0.0,
+            "skipped": 0
+        })
+        metrics[outcome] += 1
+        if outcome != "skipped":
+            metrics[f"{outcome}_ms"] += elapsed_ms
+
+
+def deadline_stats():
+    """
+    Per-stage outcome counts and time spent, for /health.
+
+    cancelled_ms is work that was thrown away because the deadline passed
+    while it ran; skipped stages never started.
+    """
+    with _METRICS_LOCK:
+        return {
+            name: dict(metrics,
+                       completed_ms=round(metrics["completed_ms"], 1),
+                       cancelled_ms=round(metrics["cancelled_ms"], 1))
+            for name, metrics in _METRICS.items()
+        }
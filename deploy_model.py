@@ -7,7 +7,7 @@ This uses the CNN model from ml_model_example.py
 import os
 import numpy as np
 import tensorflow as tf
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 import requests
 from PIL import Image
 from io import BytesIO
@@ -19,36 +19,97 @@ from ml_model_example import (
     extract_statistical_features,
     create_cnn_model
 )
+from image_probe import fetch_image_bytes, decode_first_frame, images_from_request, ImageRejected
+from cpu_pool import PreprocessPool
+from admission import AdmissionController
+from response_codec import install_codec
+from deadline import DeadlineExceeded, deadline_stats, stage
+from model_registry import HotModel, file_version, serve_from_registry
+from model_serving import (
+    TFLiteModel,
+    apply_thread_config,
+    available_cores,
+    configure_tf_threads,
+    load_thread_config,
+    threads_from_env
+)
+
+app = install_codec(Flask(__name__))
 
-app = Flask(__name__)
+# CPU-bound: about one request per core, the rest wait or are shed
+admission = AdmissionController.from_env('custom_model', max_in_flight=available_cores())
 
-# Global model variable
+# The served model (a HotModel: swapped in place when the registry changes)
 model = None
 
+# Decode/preprocessing worker pool (enabled with CPU_POOL_WORKERS)
+cpu_pool = None
+
 def load_or_create_model():
-    """Load pre-trained model or create a new one"""
+    """
+    Load pre-trained model or create a new one
+    
+    When a model registry exists (MODEL_REGISTRY, default models/; see
+    model_registry.py) its active version is served and later versions are
+    hot-swapped in without a restart. Otherwise trained_model.h5 is loaded
+    once.
+    
+    With SERVING_BACKEND=tflite the model is the flatbuffer at
+    MODEL_TFLITE_PATH, mmap'd so that pre-forked workers share its weights
+    (see gunicorn.conf.py). Thread counts come from TF_INTRA_OP_THREADS /
+    TF_INTER_OP_THREADS when set.
+    """
     global model
     
     model_path = 'trained_model.h5'
+    threads = threads_from_env()
+    
+    if threads and os.getenv('SERVING_BACKEND', 'keras') != 'tflite':
+        configure_tf_threads(*threads)
+    
+    model = serve_from_registry(threads=threads[0] if threads else None)
+    if model is not None:
+        return model
+    
+    if os.getenv('SERVING_BACKEND', 'keras') == 'tflite':
+        tflite_path = os.getenv('MODEL_TFLITE_PATH', 'trained_model.tflite')
+        print(f"Mapping TFLite model {tflite_path}...")
+        tflite_model = TFLiteModel(tflite_path, num_threads=threads[0] if threads else 1,
+                                   use_xnnpack=os.getenv('TFLITE_XNNPACK', '0') == '1')
+        tflite_model.warmup()
+        model = HotModel.fixed(tflite_model, file_version(tflite_path))
+        return model
     
     if os.path.exists(model_path):
         print("Loading pre-trained model...")
-        model = tf.keras.models.load_model(model_path)
+        model = HotModel.fixed(tf.keras.models.load_model(model_path), file_version(model_path))
     else:
         print("Creating new model (untrained)...")
-        model = create_cnn_model()
+        model = HotModel.fixed(create_cnn_model(), 'untrained')
         # Note: This model won't be accurate without training data
         print("WARNING: Model is untrained and will give random predictions")
     
     return model
 
-def classify_image_with_model(image_url):
+def classify_image_with_model(image_url, image_bytes=None, deadline=None):
     """
     Classify image using the loaded model
+    
+    Uploaded image_bytes, when given, are decoded directly instead of
+    downloading image_url. DeadlineExceeded propagates once the request
+    deadline passes.
     """
     try:
-        # Download and preprocess image
-        image_array = download_and_preprocess_image(image_url)
+        # Download (or decode the upload) and preprocess image
+        if cpu_pool is not None:
+            if image_bytes is None:
+                image_bytes, _ = fetch_image_bytes(image_url, deadline=deadline)
+            with stage(deadline, 'preprocess'):
+                image_array, _ = cpu_pool.preprocess(image_bytes, deadline=deadline)
+        elif image_bytes is not None:
+            image_array = np.array(decode_first_frame(image_bytes, deadline=deadline).resize((224, 224))) / 255.0
+        else:
+            image_array = download_and_preprocess_image(image_url, deadline=deadline)
         
         if image_array is None:
             return {"error": "Failed to process image"}
@@ -56,8 +117,9 @@ def classify_image_with_model(image_url):
         # Reshape for model input
         image_input = np.expand_dims(image_array, axis=0)
         
-        # Get model prediction
-        prediction = model.predict(image_input, verbose=0)
+        # Get model prediction (a swap to a new version waits for this one)
+        with stage(deadline, 'predict'), model.acquire() as served:
+            prediction = served.model.predict(image_input, verbose=0)
         
         # Extract results
         ai_probability = prediction[0][1]  # Assuming index 1 is AI class
@@ -76,36 +138,61 @@ def classify_image_with_model(image_url):
             "confidence": confidence,
             "source": "custom_model",
             "ai_prob": float(ai_probability),
-            "real_prob": float(real_probability)
+            "real_prob": float(real_probability),
+            "model_version": served.version
         }
         
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
 @app.route('/classify', methods=['POST'])
+@admission.limit
 def classify_image():
     """Flask endpoint for image classification"""
     try:
+        # Image bytes uploaded by the client skip the server-side refetch
+        uploads = images_from_request(request)
+        if uploads is not None:
+            if len(uploads) != 1:
+                return jsonify({"error": "exactly one image required"}), 400
+            result = classify_image_with_model(None, image_bytes=uploads[0][0], deadline=g.deadline)
+            return jsonify(result)
+        
         data = request.get_json()
         image_url = data.get('imageUrl')
         
         if not image_url:
             return jsonify({"error": "imageUrl required"}), 400
         
-        result = classify_image_with_model(image_url)
+        result = classify_image_with_model(image_url, deadline=g.deadline)
         return jsonify(result)
         
+    except ImageRejected as e:
+        return jsonify({"error": str(e), "rejected": e.reason}), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "model_loaded": model is not None})
+    return jsonify({
+        "status": "healthy",
+        "model_loaded": model is not None,
+        "model": model.stats() if model is not None else None,
+        "cpu_pool": cpu_pool.stats() if cpu_pool is not None else None,
+        "admission": admission.snapshot(),
+        "deadlines": deadline_stats()
+    })
 
 if __name__ == '__main__':
-    # Load model on startup
+    # Size TensorFlow/OpenCV thread pools (SERVING_THREADS_CONFIG), then load model on startup
+    apply_thread_config(load_thread_config())
     load_or_create_model()
+    cpu_pool = PreprocessPool.from_env()
     
     # Run the Flask app
     print("Starting AI Detection API on http://localhost:5000")
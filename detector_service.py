@@ -0,0 +1,980 @@
+#!/usr/bin/env python3
+"""
+Unified AI detection service
+One Flask app in front of every detector backend. Each request picks a
+backend with "backend" in the JSON body (or ?backend= for uploads), or
+gets the configured default. All backends share:
+
+- one image fetcher: header-probed downloads on a shared thread pool,
+  each URL fetched once per request
+- one result cache, keyed by backend, backend version and image (URL and
+  content hash), so an upload and a URL of the same image share an entry
+- one micro-batcher per batch-capable backend: concurrent single-image
+  requests are merged into one classify_batch call
+- one set of metrics, CORS headers, admission control and error codes
+- optionally, a perceptual-hash index (phash_index.py): a resized,
+  cropped or re-compressed copy of an image classified before gets the
+  earlier verdict without running the backend
+- optionally, an embedding index (embedding_index.py): the CNN's image
+  embeddings are stored with their verdicts, and a request can ask for
+  the most similar images seen before
+
+A backend implements Backend (classify, optionally classify_batch) and is
+registered by name in BACKEND_CLASSES. Backends are built on first use, so
+a service configured with several backends only loads the ones asked for.
+
+    DETECTOR_CONFIG=service.json python detector_service.py --port 5000
+"""
+
+import argparse
+import atexit
+import functools
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import numpy as np
+import requests
+from flask import Flask, g, request, jsonify, make_response
+
+from admission import AdmissionController
+from response_codec import install_codec
+from deadline import DeadlineExceeded, deadline_stats, stage
+from image_probe import fetch_image_bytes, images_from_request, ImageRejected, MAX_UPLOAD_IMAGES
+from embedding_index import EmbeddingIndex
+from phash_index import HashIndex, image_hash
+
+app = install_codec(Flask(__name__))
+
+# Mixed CPU-bound (cnn) and upstream-bound (huggingface, google) work
+admission = AdmissionController.from_env('detector_service', max_in_flight=16)
+
+# ============================================================================
+# 1. CONFIGURATION
+# ============================================================================
+
+DEFAULT_SERVICE_CONFIG = {
+    "backends": ["cnn", "heuristic", "huggingface", "google"],
+    "default_backend": "cnn",
+    "cache_size": 2048,        # results kept in the shared LRU cache
+    "fetch_workers": 8,        # shared download pool (batch requests)
+    "max_batch": 16,           # images per merged classify_batch call
+    "batch_wait_ms": 5.0,      # how long a batch waits for more requests
+    "near_duplicates": False,  # reuse verdicts of perceptually similar images
+    "near_duplicate_index": "near_duplicates.npz",
+    "near_duplicate_distance": 6,       # max Hamming distance of 64-bit hashes
+    "near_duplicate_method": "phash",   # or "dhash"
+    "near_duplicate_save_interval": 60, # seconds between index saves
+    "embedding_index": None,   # directory of a CNN embedding index (off when None)
+    "embedding_nprobe": 8,     # inverted lists searched once the index is trained
+    "embedding_flat_max": 100000,       # largest untrained index searched (a full scan per request)
+    "embedding_flush_interval": 60,     # seconds between writes of the entry count
+    "max_neighbors": 20        # cap on "neighbors" per request
+}
+
+
+def load_service_config(path=None):
+    """
+    Load service configuration, overlaying a JSON file on the defaults.
+
+    Args:
+        path (str): Path to a JSON config file (defaults to $DETECTOR_CONFIG)
+
+    Returns:
+        dict: Service configuration
+    """
+    config = json.loads(json.dumps(DEFAULT_SERVICE_CONFIG))
+    path = path or os.getenv('DETECTOR_CONFIG')
+    if not path:
+        return config
+
+    with open(path) as f:
+        config.update(json.load(f))
+    return config
+
+# ============================================================================
+# 2. BACKENDS
+# ============================================================================
+
+class BackendUnavailable(Exception):
+    """The backend cannot serve requests (e.g. its API key is not set)."""
+
+
+class UnknownBackend(ValueError):
+    """The requested backend does not exist or is not enabled in this service."""
+
+    def __init__(self, name):
+        super().__init__(f"Unknown or disabled backend: {name}")
+        self.name = name
+
+
+class Backend:
+    """
+    A detector the service can route to.
+
+    classify() takes an image that is already in memory, plus its header
+    info from image_probe, and returns a result dict with "label" and
+    "confidence", or with "error". Backends that can score several images
+    in one call set max_batch above 1 and override classify_batch().
+    """
+
+    name = None
+    max_batch = 1
+
+    def classify(self, image_bytes, info, deadline=None, options=None):
+        raise NotImplementedError
+
+    def classify_batch(self, images, deadline=None, options=None):
+        """One result per (image_bytes, info) pair, in order."""
+        return [self.classify(image_bytes, info, deadline, options) for image_bytes, info in images]
+
+    @property
+    def version(self):
+        """Identifies the model behind the results; part of the cache key."""
+        return self.name
+
+    def health(self):
+        return {}
+
+
+class CNNBackend(Backend):
+    """The trained CNN (ml_model_example), hot-swapped from the model registry."""
+
+    name = 'cnn'
+    max_batch = 32
+    with_embedding = False  # set by the service when it keeps an embedding index
+
+    def __init__(self):
+        from ml_model_example import get_detector
+        self.detector = get_detector()
+
+    def classify(self, image_bytes, info, deadline=None, options=None):
+        multi_crop = bool((options or {}).get('multiCrop'))
+        return self.detector.predict(image_bytes, multi_crop=multi_crop, deadline=deadline,
+                                     with_embedding=self.with_embedding)
+
+    def classify_batch(self, images, deadline=None, options=None):
+        multi_crop = bool((options or {}).get('multiCrop'))
+        return self.detector.predict_batch([image_bytes for image_bytes, _ in images],
+                                           multi_crop=multi_crop, deadline=deadline,
+                                           with_embedding=self.with_embedding)
+
+    @property
+    def version(self):
+        return f"cnn:{self.detector.model_version}"
+
+    def health(self):
+        return {"model": self.detector.serving.stats()}
+
+
+class DeployModelBackend(Backend):
+    """deploy_model's CNN: the registry's active version, else trained_model.h5 (or its TFLite build)."""
+
+    name = 'deploy_model'
+
+    def __init__(self):
+        import deploy_model
+        if deploy_model.model is None:
+            deploy_model.load_or_create_model()
+        self._module = deploy_model
+
+    def classify(self, image_bytes, info, deadline=None, options=None):
+        return self._module.classify_image_with_model(None, image_bytes=image_bytes, deadline=deadline)
+
+    @property
+    def version(self):
+        return f"deploy_model:{self._module.model.version}"
+
+    def health(self):
+        return {"model": self._module.model.stats()}
+
+
+class HeuristicBackend(Backend):
+    """simple_ai_detector's header heuristic; no model, no upstream."""
+
+    name = 'heuristic'
+
+    def __init__(self):
+        from simple_ai_detector import analyze_image_bytes
+        self._analyze = analyze_image_bytes
+
+    def classify(self, image_bytes, info, deadline=None, options=None):
+        return self._analyze(image_bytes, info)
+
+
+class HuggingFaceBackend(Backend):
+    """The Hugging Face vision-language model, through the pooled client."""
+
+    name = 'huggingface'
+    max_batch = MAX_UPLOAD_IMAGES
+
+    def __init__(self):
+        import huggingface_detector
+        self.api_key = os.getenv('HF_API_KEY')
+        if not self.api_key:
+            raise BackendUnavailable("HF_API_KEY environment variable required")
+        self._module = huggingface_detector
+
+    def classify(self, image_bytes, info, deadline=None, options=None):
+        return self._module.classify_image_bytes(image_bytes, self.api_key, deadline)
+
+    def classify_batch(self, images, deadline=None, options=None):
+        return self._module.classify_images_batch([image_bytes for image_bytes, _ in images],
+                                                  self.api_key, deadline)
+
+    @property
+    def version(self):
+        return f"huggingface:{self._module.HF_MODEL_NAME}"
+
+    def health(self):
+        from circuit_breaker import breaker_states
+        return {"circuit_breakers": breaker_states()}
+
+
+class GoogleBackend(Backend):
+    """The Google generative vision API."""
+
+    name = 'google'
+
+    def __init__(self):
+        from google_ai_detector import detect_ai_with_google
+        self.api_key = os.getenv('GOOGLE_API_KEY')
+        if not self.api_key:
+            raise BackendUnavailable("GOOGLE_API_KEY environment variable required")
+        self._detect = detect_ai_with_google
+
+    def classify(self, image_bytes, info, deadline=None, options=None):
+        return self._detect(None, self.api_key, image_bytes=image_bytes, deadline=deadline,
+                            image_format=(info or {}).get("format"))
+
+    def health(self):
+        from circuit_breaker import breaker_states
+        return {"circuit_breakers": breaker_states()}
+
+
+class CascadeBackend(Backend):
+    """cascade_detector's metadata → statistical → CNN cascade."""
+
+    name = 'cascade'
+
+    def __init__(self):
+        from cascade_detector import get_cascade
+        from ml_model_example import get_detector
+        self.cascade = get_cascade()
+        self.detector = get_detector()
+
+    def classify(self, image_bytes, info, deadline=None, options=None):
+        return self.cascade.classify(image_bytes, deadline)
+
+    @property
+    def version(self):
+        # The CNN stage serves the detector's HotModel
+        return f"cascade:{self.detector.model_version}"
+
+    def health(self):
+        return {"cascade": self.cascade.stats()}
+
+
+BACKEND_CLASSES = {
+    "cnn": CNNBackend,
+    "deploy_model": DeployModelBackend,
+    "heuristic": HeuristicBackend,
+    "huggingface": HuggingFaceBackend,
+    "google": GoogleBackend,
+    "cascade": CascadeBackend,
+}
+
+# ============================================================================
+# 3. SHARED CACHE, BATCHER AND METRICS
+# ============================================================================
+
+class ResultCache:
+    """Thread-safe LRU of result dicts."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MicroBatcher:
+    """
+    Merges concurrent single-image requests into classify_batch calls.
+
+    A dispatcher thread takes the first waiting request, collects more for
+    up to max_wait seconds (or until max_batch), and runs them as one call.
+    Each caller waits only as long as its own deadline allows; a request
+    whose caller has given up is dropped before the batch runs.
+    """
+
+    def __init__(self, backend, max_batch, max_wait):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.batched_images = 0
+        self._thread = threading.Thread(target=self._dispatch, name=f'batch-{backend.name}', daemon=True)
+        self._thread.start()
+
+    def classify(self, image_bytes, info, deadline=None):
+        future = Future()
+        self._queue.put((image_bytes, info, deadline, future))
+        timeout = max(0.0, deadline.remaining()) if deadline is not None else None
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise DeadlineExceeded(stage='batch')
+
+    def _collect(self):
+        items = [self._queue.get()]
+        flush_at = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch:
+            remaining = flush_at - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return [item for item in items if item[3].set_running_or_notify_cancel()]
+
+    def _dispatch(self):
+        while True:
+            items = self._collect()
+            if not items:
+                continue
+            self.batches += 1
+            self.batched_images += len(items)
+            # Run against the most generous deadline; each caller enforces its own
+            deadlines = [deadline for _, _, deadline, _ in items]
+            deadline = None if None in deadlines else max(deadlines, key=lambda d: d.expires_at)
+            try:
+                results = self.backend.classify_batch([(image_bytes, info) for image_bytes, info, _, _ in items],
+                                                      deadline)
+            except Exception as e:
+                for item in items:
+                    item[3].set_exception(e)
+                continue
+            for item, result in zip(items, results):
+                item[3].set_result(result)
+
+
+class BackendMetrics:
+    """Request, cache, batch and latency counters for one backend."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {"images": 0, "errors": 0, "cache_hits": 0, "near_duplicate_hits": 0,
+                         "batches": 0, "batched_images": 0}
+        self.latencies_ms = deque(maxlen=1000)
+
+    def record(self, images, errors, cache_hits, elapsed_ms=None, batched=0, near_duplicates=0):
+        with self.lock:
+            self.counters["images"] += images
+            self.counters["errors"] += errors
+            self.counters["cache_hits"] += cache_hits
+            self.counters["near_duplicate_hits"] += near_duplicates
+            if batched:
+                self.counters["batches"] += 1
+                self.counters["batched_images"] += batched
+            if elapsed_ms is not None:
+                self.latencies_ms.append(elapsed_ms)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.array(self.latencies_ms) if self.latencies_ms else None
+            counters = dict(self.counters)
+        counters["cache_hit_rate"] = round(counters["cache_hits"] / counters["images"], 4) if counters["images"] else None
+        counters["p50_ms"] = round(float(np.percentile(latencies, 50)), 1) if latencies is not None else None
+        counters["p95_ms"] = round(float(np.percentile(latencies, 95)), 1) if latencies is not None else None
+        return counters
+
+# ============================================================================
+# 4. SERVICE
+# ============================================================================
+
+def _image_digest(image_bytes):
+    return 'sha256:' + hashlib.sha256(image_bytes).hexdigest()
+
+
+def _options_key(options):
+    return json.dumps(options, sort_keys=True) if options else ''
+
+
+class DetectorService:
+    """Routes requests to backends through the shared fetcher, cache and batchers."""
+
+    def __init__(self, config=None):
+        self.config = config or load_service_config()
+        unknown = set(self.config["backends"]) - set(BACKEND_CLASSES)
+        if unknown:
+            raise ValueError(f"Unknown backends: {', '.join(sorted(unknown))}")
+        if self.config["default_backend"] not in self.config["backends"]:
+            raise ValueError(f"Default backend {self.config['default_backend']} is not enabled")
+        self.cache = ResultCache(self.config["cache_size"])
+        self._fetch_pool = ThreadPoolExecutor(max_workers=self.config["fetch_workers"], thread_name_prefix='fetch')
+        self._backends = {}
+        self._batchers = {}
+        self._unavailable = {}
+        self._metrics = {name: BackendMetrics() for name in self.config["backends"]}
+        self._lock = threading.Lock()
+
+        self.near_duplicates = None
+        if self.config["near_duplicates"]:
+            self.near_duplicates = HashIndex.load(self.config["near_duplicate_index"])
+            self._saved_size = len(self.near_duplicates)
+            threading.Thread(target=self._save_loop, name='phash-save', daemon=True,
+                             args=(self.config["near_duplicate_save_interval"], self.save_near_duplicates,
+                                   'near-duplicate index')).start()
+            atexit.register(self.save_near_duplicates)
+
+        self.embeddings = None
+        if self.config["embedding_index"]:
+            self.embeddings = EmbeddingIndex(self.config["embedding_index"])
+            threading.Thread(target=self._save_loop, name='embedding-flush', daemon=True,
+                             args=(self.config["embedding_flush_interval"], self.embeddings.flush,
+                                   'embedding index')).start()
+            atexit.register(self.embeddings.flush)
+
+    def save_near_duplicates(self):
+        """Write the near-duplicate index if it grew since the last save."""
+        if self.near_duplicates is None or len(self.near_duplicates) == self._saved_size:
+            return
+        size = len(self.near_duplicates)
+        self.near_duplicates.save(self.config["near_duplicate_index"])
+        self._saved_size = size
+
+    def _save_loop(self, interval, save, what):
+        while True:
+            time.sleep(interval)
+            try:
+                save()
+            except OSError as e:
+                print(f"Saving {what} failed: {e}")
+
+    def backend(self, name=None):
+        """
+        The backend called `name` (default: the configured one), built on first use.
+
+        Raises:
+            UnknownBackend: if the backend is not enabled
+            BackendUnavailable: if it cannot be built here
+        """
+        name = name or self.config["default_backend"]
+        if name not in self.config["backends"]:
+            raise UnknownBackend(name)
+        with self._lock:
+            if name not in self._backends:
+                try:
+                    backend = BACKEND_CLASSES[name]()
+                except BackendUnavailable as e:
+                    self._unavailable[name] = str(e)
+                    raise
+                self._unavailable.pop(name, None)
+                if self.embeddings is not None and hasattr(backend, 'with_embedding'):
+                    backend.with_embedding = True
+                self._backends[name] = backend
+                if backend.max_batch > 1 and self.config["max_batch"] > 1:
+                    self._batchers[name] = MicroBatcher(backend, min(backend.max_batch, self.config["max_batch"]),
+                                                        self.config["batch_wait_ms"] / 1000)
+            return self._backends[name]
+
+    def fetch(self, image_url, deadline=None):
+        """(bytes, info) for a URL; ImageRejected and DeadlineExceeded propagate."""
+        return fetch_image_bytes(image_url, timeout=10, deadline=deadline)
+
+    def _cache_keys(self, backend, options, image_url=None, image_bytes=None):
+        prefix = (backend.name, backend.version, _options_key(options))
+        keys = []
+        if image_url is not None:
+            keys.append(prefix + (image_url,))
+        if image_bytes is not None:
+            keys.append(prefix + (_image_digest(image_bytes),))
+        return keys
+
+    def _lookup(self, keys):
+        for key in keys:
+            result = self.cache.get(key)
+            if result is not None:
+                return result
+        return None
+
+    def _store(self, keys, result):
+        # Errors are not cached, so a transient upstream failure is retried
+        if not result.get('error'):
+            for key in keys:
+                self.cache.put(key, result)
+
+    def _verdict_version(self, backend, options):
+        # Verdicts are reused only for the same model and options
+        return backend.version + (f"|{_options_key(options)}" if options else '')
+
+    def _near_duplicate(self, backend, options, image_bytes, deadline=None):
+        """
+        (hash, earlier verdict) for an image. The verdict is None without a
+        match; the hash is None when the index is off or the image cannot be
+        hashed.
+        """
+        if self.near_duplicates is None:
+            return None, None
+        try:
+            with stage(deadline, 'phash'):
+                code = image_hash(image_bytes, self.config["near_duplicate_method"])
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            return None, None
+        match = self.near_duplicates.nearest(code, self.config["near_duplicate_distance"],
+                                             self._verdict_version(backend, options))
+        if match is None:
+            return code, None
+        return code, {"label": match["label"], "confidence": match["confidence"],
+                      "near_duplicate": {"distance": match["distance"], "similarity": match["similarity"]}}
+
+    def _remember(self, backend, options, codes, results):
+        """Add successful verdicts to the near-duplicate index."""
+        entries = [(code, result) for code, result in zip(codes, results)
+                   if code is not None and not result.get('error')]
+        if entries:
+            self.near_duplicates.add([code for code, _ in entries],
+                                     [result.get('label') for _, result in entries],
+                                     [result.get('confidence', 0.0) for _, result in entries],
+                                     self._verdict_version(backend, options))
+
+    def _index_embeddings(self, backend, image_keys, results):
+        """Add the embeddings of successful results to the embedding index."""
+        entries = [(key, result) for key, result in zip(image_keys, results)
+                   if result.get('embedding') is not None and not result.get('error')]
+        if self.embeddings is None or not entries:
+            return
+        try:
+            self.embeddings.add(np.stack([result['embedding'] for _, result in entries]),
+                                [result.get('label') for _, result in entries],
+                                [result.get('confidence', 0.0) for _, result in entries],
+                                [key for key, _ in entries], backend.version)
+        except (OSError, ValueError) as e:
+            print(f"Adding to the embedding index failed: {e}")
+
+    @staticmethod
+    def _with_content_key(result, content_key):
+        """
+        Tag a result that has an embedding with the image's content digest
+        (kept in the cache, removed by respond), so a later request for the
+        same image by URL can still leave out its own upload as a neighbor.
+        """
+        if result.get('embedding') is None:
+            return result
+        return dict(result, _content_key=content_key)
+
+    def neighbors(self, embedding, k, exclude_keys=()):
+        """
+        The k most similar images in the embedding index, most similar first.
+
+        Args:
+            exclude_keys (collection): Keys of the image itself (URL, content
+                digest); its earlier entries are skipped
+
+        Returns:
+            list: {"key", "label", "confidence", "similarity", "version"} per neighbor
+        """
+        if self.embeddings is None or embedding is None or k <= 0:
+            return []
+        # A few extra in case the image itself was indexed more than once
+        ids, similarities = self.embeddings.search(embedding, k + 4, self.config["embedding_nprobe"])
+        found = []
+        for entry, similarity in zip(self.embeddings.entries(ids[0]), similarities[0]):
+            if entry is None or entry["key"] in exclude_keys:
+                continue
+            found.append({"key": entry["key"], "label": entry["label"],
+                          "confidence": round(entry["confidence"], 4),
+                          "similarity": round(float(similarity), 4), "version": entry["version"]})
+        return found[:k]
+
+    def respond(self, result, image_key=None, neighbors=0, embedding=False, deadline=None):
+        """
+        A result as returned to the client: the embedding is dropped unless
+        asked for, and with neighbors > 0 the most similar earlier images
+        are added as "neighbors". A successful result that cannot have
+        neighbors gets an empty list and "neighbors_unavailable" saying why.
+        """
+        own_keys = {image_key, result.pop('_content_key', None)} - {None}
+        vector = result.get('embedding')
+        if vector is None:
+            result.pop('embedding', None)
+            if neighbors and not result.get('error'):
+                result['neighbors'] = []
+                if self.embeddings is None:
+                    result['neighbors_unavailable'] = "no embedding index is configured"
+                elif result.get('near_duplicate'):
+                    result['neighbors_unavailable'] = "near-duplicate verdicts are reused without an embedding"
+                else:
+                    result['neighbors_unavailable'] = "this backend does not produce embeddings"
+            return result
+        if neighbors:
+            if not self.embeddings.trained and len(self.embeddings) > self.config["embedding_flat_max"]:
+                # A full scan of a large index takes most of a second per request
+                result['neighbors'] = []
+                result['neighbors_unavailable'] = "embedding index is not trained"
+            else:
+                with stage(deadline, 'neighbors'):
+                    result['neighbors'] = self.neighbors(vector, min(neighbors, self.config["max_neighbors"]),
+                                                         own_keys)
+        if not embedding:
+            result.pop('embedding')
+        return result
+
+    def classify(self, backend_name=None, image_url=None, image_bytes=None, info=None, options=None,
+                 deadline=None):
+        """
+        Classify one image (a URL or uploaded bytes) with a backend.
+
+        Returns:
+            dict: The backend's result plus "backend" ("cached" on a cache hit,
+                "near_duplicate" when an earlier verdict was reused)
+
+        Raises:
+            ImageRejected, DeadlineExceeded, UnknownBackend, BackendUnavailable,
+            requests.RequestException (the download failed)
+        """
+        backend = self.backend(backend_name)
+        metrics = self._metrics[backend.name]
+
+        url_keys = self._cache_keys(backend, options, image_url=image_url)
+        cached = self._lookup(url_keys)
+        if cached is None:
+            if image_bytes is None:
+                image_bytes, info = self.fetch(image_url, deadline)
+            content_keys = self._cache_keys(backend, options, image_bytes=image_bytes)
+            cached = self._lookup(content_keys)
+            if cached is not None:
+                self._store(url_keys, cached)
+        if cached is not None:
+            metrics.record(1, 0, 1)
+            return dict(cached, backend=backend.name, cached=True)
+
+        code, prior = self._near_duplicate(backend, options, image_bytes, deadline)
+        if prior is not None:
+            metrics.record(1, 0, 0, near_duplicates=1)
+            self._store(url_keys + content_keys, prior)
+            return dict(prior, backend=backend.name)
+
+        start = time.perf_counter()
+        batcher = self._batchers.get(backend.name)
+        if batcher is not None and not options:
+            result = batcher.classify(image_bytes, info, deadline)
+        else:
+            result = backend.classify(image_bytes, info, deadline, options)
+        metrics.record(1, int(bool(result.get('error'))), 0, (time.perf_counter() - start) * 1000)
+        self._remember(backend, options, [code], [result])
+        self._index_embeddings(backend, [image_url or _image_digest(image_bytes)], [result])
+        result = self._with_content_key(result, content_keys[0][-1])
+        self._store(url_keys + content_keys, result)
+        return dict(result, backend=backend.name)
+
+    def classify_many(self, backend_name=None, image_urls=None, uploads=None, options=None, deadline=None):
+        """
+        Classify several images: cached ones are answered directly, the rest
+        are downloaded in parallel and scored in classify_batch chunks.
+
+        Returns:
+            list: One result per image, in order (URL results carry "url")
+        """
+        backend = self.backend(backend_name)
+        metrics = self._metrics[backend.name]
+        count = len(image_urls) if image_urls is not None else len(uploads)
+        results = [None] * count
+        keys = [[] for _ in range(count)]
+
+        if image_urls is not None:
+            futures = {}
+            for i, url in enumerate(image_urls):
+                keys[i] = self._cache_keys(backend, options, image_url=url)
+                cached = self._lookup(keys[i])
+                if cached is not None:
+                    results[i] = dict(cached, cached=True)
+                else:
+                    futures[i] = self._fetch_pool.submit(self.fetch, url, deadline)
+            images = {}
+            for i, future in futures.items():
+                timeout = max(0.0, deadline.remaining()) if deadline is not None else None
+                try:
+                    images[i] = future.result(timeout)
+                except FutureTimeout:
+                    raise DeadlineExceeded(stage='fetch')
+                except DeadlineExceeded:
+                    raise
+                except ImageRejected as e:
+                    results[i] = {"error": str(e), "rejected": e.reason}
+                except Exception as e:
+                    results[i] = {"error": str(e)}
+        else:
+            images = dict(enumerate(uploads))
+
+        pending, codes, near_duplicate_hits = [], {}, 0
+        for i, (image_bytes, info) in images.items():
+            keys[i] = keys[i] + self._cache_keys(backend, options, image_bytes=image_bytes)
+            cached = self._lookup(keys[i][-1:])
+            if cached is not None:
+                results[i] = dict(cached, cached=True)
+                continue
+            codes[i], prior = self._near_duplicate(backend, options, image_bytes, deadline)
+            if prior is not None:
+                self._store(keys[i], prior)
+                results[i] = prior
+                near_duplicate_hits += 1
+            else:
+                pending.append(i)
+        cache_hits = sum(1 for r in results if r is not None and r.get('cached'))
+
+        start = time.perf_counter()
+        for chunk_start in range(0, len(pending), backend.max_batch):
+            chunk = pending[chunk_start:chunk_start + backend.max_batch]
+            chunk_results = backend.classify_batch([images[i] for i in chunk], deadline, options)
+            for i, result in zip(chunk, chunk_results):
+                result = self._with_content_key(result, keys[i][-1][-1])
+                self._store(keys[i], result)
+                results[i] = result
+            self._remember(backend, options, [codes[i] for i in chunk], chunk_results)
+            # Index under the URL, or the content digest (last part of the content cache key)
+            self._index_embeddings(backend, [image_urls[i] if image_urls is not None else keys[i][-1][-1]
+                                             for i in chunk], chunk_results)
+        errors = sum(1 for r in results if r.get('error'))
+        metrics.record(count, errors, cache_hits, (time.perf_counter() - start) * 1000 if pending else None,
+                       batched=len(pending), near_duplicates=near_duplicate_hits)
+
+        results = [dict(result, backend=backend.name) for result in results]
+        if image_urls is not None:
+            for result, url in zip(results, image_urls):
+                result['url'] = url
+        return results
+
+    def stats(self):
+        """Per-backend metrics and state for /health."""
+        with self._lock:
+            backends = dict(self._backends)
+            unavailable = dict(self._unavailable)
+        report = {}
+        for name in self.config["backends"]:
+            entry = {"loaded": name in backends, **self._metrics[name].snapshot()}
+            if name in unavailable:
+                entry["unavailable"] = unavailable[name]
+            if name in backends:
+                entry.update(backends[name].health())
+                entry["version"] = backends[name].version
+            if name in self._batchers:
+                batcher = self._batchers[name]
+                entry["merged_batches"] = batcher.batches
+                entry["merged_images"] = batcher.batched_images
+            report[name] = entry
+        return {"default_backend": self.config["default_backend"], "cache_entries": len(self.cache),
+                "near_duplicate_entries": len(self.near_duplicates) if self.near_duplicates is not None else None,
+                "embedding_entries": len(self.embeddings) if self.embeddings is not None else None,
+                "backends": report}
+
+# ============================================================================
+# 5. FLASK API SERVER
+# ============================================================================
+
+ALLOWED_ORIGINS = "*"
+ALLOWED_HEADERS = "Content-Type, Authorization, X-Request-Timeout-Ms, X-Client-Id"
+ALLOWED_METHODS = "GET, POST, OPTIONS"
+
+service = None
+
+
+def get_service():
+    global service
+    if service is None:
+        service = DetectorService()
+    return service
+
+
+@app.after_request
+def apply_cors(response):
+    response.headers["Access-Control-Allow-Origin"] = ALLOWED_ORIGINS
+    response.headers["Access-Control-Allow-Headers"] = ALLOWED_HEADERS
+    response.headers["Access-Control-Allow-Methods"] = ALLOWED_METHODS
+    response.headers["Access-Control-Max-Age"] = "600"
+    return response
+
+
+@app.route('/classify', methods=['OPTIONS'])
+@app.route('/classify/batch', methods=['OPTIONS'])
+@app.route('/health', methods=['OPTIONS'])
+def cors_preflight():
+    return make_response("", 204)
+
+
+def _result_status(result):
+    """HTTP status for a result dict: 400 rejected image, 502 backend error, else 200."""
+    if result.get('rejected'):
+        return 400
+    if result.get('error'):
+        return 502
+    return 200
+
+
+def _request_options(data):
+    """Backend selection and per-request options, from the JSON body or the query string."""
+    source = data if data is not None else request.args
+    options = {}
+    multi_crop = source.get('multiCrop')
+    if multi_crop in (True, '1', 'true'):
+        options['multiCrop'] = True
+    return source.get('backend'), options
+
+
+def _response_options(data):
+    """How many nearest earlier images to add, and whether to return the embedding."""
+    source = data if data is not None else request.args
+    try:
+        neighbors = max(0, int(source.get('neighbors') or 0))
+    except (TypeError, ValueError):
+        return None
+    return {"neighbors": neighbors, "embedding": source.get('embedding') in (True, '1', 'true')}
+
+
+def _service_errors(view):
+    """Map service exceptions to the same status codes for every endpoint."""
+    @functools.wraps(view)
+    def wrapper():
+        try:
+            return view()
+        except ImageRejected as e:
+            return jsonify({"error": str(e), "rejected": e.reason}), 400
+        except UnknownBackend as e:
+            return jsonify({"error": str(e), "backends": get_service().config["backends"]}), 400
+        except BackendUnavailable as e:
+            return jsonify({"error": str(e), "unavailable": True}), 503
+        except requests.RequestException as e:
+            # The image host failed, not this service
+            return jsonify({"error": f"Could not download image: {e}"}), 502
+        except DeadlineExceeded:
+            raise  # admission.limit answers 504
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    return wrapper
+
+
+@app.route('/classify', methods=['POST'])
+@admission.limit
+@_service_errors
+def classify_image():
+    """
+    Classify one image.
+
+    JSON body {"imageUrl": ..., "backend": "huggingface", "multiCrop": false,
+    "neighbors": 5, "embedding": false}, or the image bytes themselves with
+    ?backend=...&neighbors=...
+    """
+    uploads = images_from_request(request)
+    if uploads is not None:
+        if len(uploads) != 1:
+            return jsonify({"error": "exactly one image required"}), 400
+        backend, options = _request_options(None)
+        response_options = _response_options(None)
+        if response_options is None:
+            return jsonify({"error": "neighbors must be an integer"}), 400
+        image_bytes, info = uploads[0]
+        image_key = _image_digest(image_bytes)
+        result = get_service().classify(backend, image_bytes=image_bytes, info=info, options=options,
+                                        deadline=g.deadline)
+    else:
+        data = request.get_json(silent=True) or {}
+        image_url = image_key = data.get('imageUrl')
+        if not image_url:
+            return jsonify({"error": "imageUrl required"}), 400
+        backend, options = _request_options(data)
+        response_options = _response_options(data)
+        if response_options is None:
+            return jsonify({"error": "neighbors must be an integer"}), 400
+        result = get_service().classify(backend, image_url=image_url, options=options, deadline=g.deadline)
+    result = get_service().respond(result, image_key, deadline=g.deadline, **response_options)
+    return jsonify(result), _result_status(result)
+
+
+@app.route('/classify/batch', methods=['POST'])
+@admission.limit
+@_service_errors
+def classify_batch():
+    """Classify several images: {"imageUrls": [...], "backend": ...} or uploads with ?backend=..."""
+    uploads = images_from_request(request)
+    if uploads is not None:
+        backend, options = _request_options(None)
+        response_options = _response_options(None)
+        if response_options is None:
+            return jsonify({"error": "neighbors must be an integer"}), 400
+        results = get_service().classify_many(backend, uploads=uploads, options=options, deadline=g.deadline)
+        image_keys = [_image_digest(image_bytes) for image_bytes, _ in uploads]
+        return jsonify({"results": [get_service().respond(result, key, deadline=g.deadline, **response_options)
+                                    for result, key in zip(results, image_keys)]})
+
+    data = request.get_json(silent=True) or {}
+    image_urls = data.get('imageUrls')
+    if not image_urls or not isinstance(image_urls, list):
+        return jsonify({"error": "imageUrls must be a non-empty list"}), 400
+    if len(image_urls) > MAX_UPLOAD_IMAGES:
+        return jsonify({"error": f"at most {MAX_UPLOAD_IMAGES} imageUrls per batch"}), 400
+    backend, options = _request_options(data)
+    response_options = _response_options(data)
+    if response_options is None:
+        return jsonify({"error": "neighbors must be an integer"}), 400
+    results = get_service().classify_many(backend, image_urls=image_urls, options=options, deadline=g.deadline)
+    return jsonify({"results": [get_service().respond(result, url, deadline=g.deadline, **response_options)
+                                for result, url in zip(results, image_urls)]})
+
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint, with per-backend metrics"""
+    return jsonify({
+        "status": "healthy",
+        "service": get_service().stats(),
+        "admission": admission.snapshot(),
+        "deadlines": deadline_stats()
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Unified AI detection service")
+    parser.add_argument('--config', help="Service config JSON (default: $DETECTOR_CONFIG)")
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--preload', action='store_true', help="Build every enabled backend at startup")
+    args = parser.parse_args()
+
+    service = DetectorService(load_service_config(args.config))
+    if args.preload:
+        for name in service.config["backends"]:
+            try:
+                service.backend(name)
+            except BackendUnavailable as e:
+                print(f"Backend {name} unavailable: {e}")
+    print(f"Backends: {', '.join(service.config['backends'])} (default {service.config['default_backend']})")
+    print(f"Starting unified AI Detection API on http://localhost:{args.port}")
+    app.run(host='0.0.0.0', port=args.port, threaded=True)
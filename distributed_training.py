@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+"""
+Data-parallel training on local worker processes
+Trains create_cnn_model on N processes at once. Each worker holds a full
+replica of the model and a disjoint shard of the dataset; after every step
+the workers average their gradients through shared memory and all apply the
+same update, so the replicas stay identical (synchronous data parallelism,
+as a multi-worker distribution strategy does over localhost). Rank 0 saves
+the trained model.
+
+Each worker gets cores // N TensorFlow threads (model_serving's thread
+budget), so N workers share the machine instead of oversubscribing it.
+`--scaling 1 2 4 8` measures examples/sec at each worker count and writes
+the speedup and parallel efficiency as a JSON report.
+
+    python distributed_training.py data --workers 4 --epochs 5
+    python distributed_training.py --synthetic --scaling 1 2 4 8
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from evaluate import list_labeled_files, load_array_dataset, load_image
+from model_serving import DEFAULT_THREAD_CONFIG, apply_thread_config, available_cores
+
+# Synthetic dataset size (per class) for benchmarks without data
+SYNTHETIC_IMAGES = 512
+
+# ============================================================================
+# 1. GRADIENT EXCHANGE
+# ============================================================================
+
+class GradientExchange:
+    """
+    Allreduce and broadcast between local worker processes.
+
+    Every worker owns one row of a shared float32 buffer. A collective
+    writes the local values into the worker's row, waits at a barrier, then
+    every worker reduces the same rows in the same order, so all of them
+    get bit-identical results. A second barrier keeps the next collective
+    from overwriting rows that are still being read.
+    """
+
+    def __init__(self, context, world_size, size, timeout=300.0):
+        """
+        Args:
+            context: multiprocessing context the workers are started from
+            world_size (int): Number of workers
+            size (int): Largest number of values in one collective
+            timeout (float): Seconds to wait for a peer before giving up
+        """
+        self.world_size = world_size
+        self.size = size
+        # The last column carries each worker's weight (its example count)
+        self._buffer = context.RawArray('f', world_size * (size + 1))
+        self._barrier = context.Barrier(world_size, timeout=timeout)
+
+    def _rows(self):
+        return np.frombuffer(self._buffer, dtype=np.float32).reshape(self.world_size, self.size + 1)
+
+    def allreduce(self, rank, values, weight=1.0):
+        """
+        Weighted mean of `values` across workers.
+
+        Args:
+            rank (int): This worker's index
+            values (np.ndarray): Flat float32 values, at most `size` long
+            weight (float): This worker's weight (0 contributes nothing)
+
+        Returns:
+            tuple: (mean values, total weight)
+        """
+        rows = self._rows()
+        count = len(values)
+        rows[rank, :count] = values
+        rows[rank, -1] = weight
+        self._barrier.wait()
+        weights = rows[:, -1].copy()
+        total = float(weights.sum())
+        if total > 0:
+            mean = (weights @ rows[:, :count]) / np.float32(total)
+        else:
+            mean = np.zeros(count, dtype=np.float32)
+        self._barrier.wait()
+        return mean, total
+
+    def broadcast(self, rank, values, root=0):
+        """Return root's `values` on every worker (others pass an array of the same length)."""
+        rows = self._rows()
+        count = len(values)
+        if rank == root:
+            rows[root, :count] = values
+        self._barrier.wait()
+        result = rows[root, :count].copy()
+        self._barrier.wait()
+        return result
+
+    def abort(self):
+        """Release peers waiting at the barrier after this worker failed."""
+        self._barrier.abort()
+
+
+def _flatten(arrays):
+    return np.concatenate([np.asarray(a, dtype=np.float32).ravel() for a in arrays])
+
+
+def _unflatten(flat, like):
+    arrays, offset = [], 0
+    for a in like:
+        size = int(np.prod(a.shape))
+        arrays.append(flat[offset:offset + size].reshape(a.shape))
+        offset += size
+    return arrays
+
+# ============================================================================
+# 2. DATA SHARDS
+# ============================================================================
+
+def open_dataset(dataset, synthetic=False, seed=0):
+    """
+    Index a training set without decoding it.
+
+    Args:
+        dataset (str): Directory with real/ and ai/ subdirectories, or the
+            prefix of an array dataset built by `evaluate.py --build`
+        synthetic (bool): Use random images instead (for benchmarks)
+        seed (int): Seed for synthetic images
+
+    Returns:
+        dict: {"kind", "source", "labels"}; sharding and loading work on
+            positions in "labels"
+    """
+    if synthetic:
+        labels = np.repeat(np.arange(2, dtype=np.int8), SYNTHETIC_IMAGES)
+        return {"kind": "synthetic", "source": seed, "labels": labels}
+    if os.path.exists(f'{dataset}.images.npy'):
+        _, labels = load_array_dataset(dataset)
+        return {"kind": "arrays", "source": dataset, "labels": labels}
+    paths, labels = list_labeled_files(dataset)
+    return {"kind": "directory", "source": paths, "labels": labels}
+
+
+def shard_indices(labels, rank, world_size):
+    """This worker's positions: every world_size-th usable example, starting at rank."""
+    usable = np.flatnonzero(labels >= 0)
+    return usable[rank::world_size]
+
+
+class ShardLoader:
+    """Loads batches of one worker's shard, in a new shuffled order each epoch."""
+
+    def __init__(self, data, indices, batch_size, seed, target_size=(224, 224)):
+        self.data = data
+        self.indices = indices
+        self.batch_size = batch_size
+        self.target_size = target_size
+        self._rng = np.random.default_rng(seed)
+        self._images = None
+        if data["kind"] == "arrays":
+            self._images, _ = load_array_dataset(data["source"])
+        elif data["kind"] == "synthetic":
+            self._images = self._synthetic_images(data["source"])
+        self._order = np.array([], dtype=np.int64)
+
+    def _synthetic_images(self, seed):
+        # One random image per class, so the task is learnable and cheap to hold
+        rng = np.random.default_rng(seed)
+        shape = (2, self.target_size[1], self.target_size[0], 3)
+        return rng.integers(0, 256, size=shape, dtype=np.uint8)
+
+    def _load(self, positions):
+        labels = self.data["labels"][positions]
+        if self.data["kind"] == "synthetic":
+            return self._images[labels], labels
+        if self.data["kind"] == "arrays":
+            # Sorted reads are sequential in the memory-mapped file
+            order = np.argsort(positions)
+            return np.asarray(self._images[positions[order]]), labels[order]
+
+        images, kept = [], []
+        for i, position in enumerate(positions):
+            try:
+                images.append(load_image(self.data["source"][position], self.target_size))
+                kept.append(i)
+            except Exception:
+                continue
+        if not images:
+            return None, labels[:0]
+        return np.stack(images), labels[kept]
+
+    def next_batch(self):
+        """(uint8 images or None, labels); reshuffles when the shard is used up."""
+        if len(self._order) < self.batch_size:
+            self._order = np.concatenate([self._order, self._rng.permutation(self.indices)])
+        positions, self._order = self._order[:self.batch_size], self._order[self.batch_size:]
+        return self._load(positions)
+
+# ============================================================================
+# 3. WORKER
+# ============================================================================
+
+def _worker(rank, world_size, exchange, results, options):
+    """Train one replica; reports per-epoch metrics and timings to `results`."""
+    try:
+        config = apply_thread_config(dict(DEFAULT_THREAD_CONFIG, workers=world_size, pin=options["pin"]), slot=rank)
+        results.put({"rank": rank, "result": _train_replica(rank, world_size, exchange, options, config)})
+    except threading.BrokenBarrierError:
+        # A peer failed (and reports why) or stopped responding
+        results.put({"rank": rank, "error": "peer failed", "broken": True})
+    except BaseException:
+        exchange.abort()
+        results.put({"rank": rank, "error": traceback.format_exc()})
+
+
+def _train_replica(rank, world_size, exchange, options, config):
+    import tensorflow as tf
+    from ml_model_example import create_cnn_model
+
+    tf.keras.utils.set_random_seed(options["seed"] + rank)
+    model = create_cnn_model()
+    optimizer = model.optimizer
+    optimizer.build(model.trainable_variables)
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy()
+
+    # Start every replica from rank 0's weights
+    weights = model.get_weights()
+    model.set_weights(_unflatten(exchange.broadcast(rank, _flatten(weights)), weights))
+
+    @tf.function
+    def compute_gradients(images, labels):
+        with tf.GradientTape() as tape:
+            probabilities = model(images, training=True)
+            loss = loss_fn(labels, probabilities)
+        correct = tf.reduce_sum(tf.cast(tf.equal(tf.argmax(probabilities, axis=1, output_type=tf.int32), labels), tf.float32))
+        return loss, correct, tape.gradient(loss, model.trainable_variables)
+
+    @tf.function
+    def apply_gradients(gradients):
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+    data = open_dataset(options["dataset"], options["synthetic"], options["seed"])
+    loader = ShardLoader(data, shard_indices(data["labels"], rank, world_size),
+                         options["batch_size"], options["seed"] * 1000 + rank)
+    trainable = model.trainable_variables
+    moving = [v for v in model.non_trainable_variables if v.dtype == tf.float32]
+
+    history, timings = [], {"load": 0.0, "compute": 0.0, "sync": 0.0}
+    measured_examples, measured_start = 0, None
+    step = 0
+    for epoch in range(options["epochs"]):
+        totals = np.zeros(3)  # loss sum, correct, examples
+        for _ in range(options["steps_per_epoch"]):
+            if step == options["warmup_steps"]:
+                # Tracing and first-touch costs stay out of the measurement
+                measured_start = time.perf_counter()
+                timings = dict.fromkeys(timings, 0.0)
+            started = time.perf_counter()
+            images, labels = loader.next_batch()
+            loaded = time.perf_counter()
+
+            count = len(labels)
+            if count:
+                loss, correct, gradients = compute_gradients(
+                    tf.convert_to_tensor(images, tf.float32) / 255.0,
+                    tf.convert_to_tensor(labels, tf.int32))
+                flat = _flatten([g.numpy() for g in gradients])
+                totals += (float(loss) * count, float(correct), count)
+            else:
+                flat = np.zeros(sum(int(np.prod(v.shape)) for v in trainable), dtype=np.float32)
+            computed = time.perf_counter()
+
+            # Weighting by example count keeps the mean exact when a shard's
+            # batch came up short (undecodable files)
+            mean, _ = exchange.allreduce(rank, flat, weight=count)
+            apply_gradients([tf.constant(g) for g in _unflatten(mean, trainable)])
+            finished = time.perf_counter()
+
+            timings["load"] += loaded - started
+            timings["compute"] += computed - loaded
+            timings["sync"] += finished - computed
+            if measured_start is not None:
+                measured_examples += count
+            step += 1
+
+        # BatchNorm statistics are local to each replica; average them so
+        # every replica (and the saved model) uses the same ones
+        if moving:
+            averaged, _ = exchange.allreduce(rank, _flatten([v.numpy() for v in moving]))
+            for variable, value in zip(moving, _unflatten(averaged, moving)):
+                variable.assign(value)
+        history.append({"epoch": epoch, "loss_sum": totals[0], "correct": totals[1], "examples": totals[2]})
+
+    elapsed = time.perf_counter() - measured_start if measured_start is not None else 0.0
+    if rank == 0 and options["output"]:
+        model.save(options["output"])
+    return {
+        "history": history,
+        "examples": measured_examples,
+        "seconds": elapsed,
+        "timings": timings,
+        "threads": {"intra_op": config["intra_op"], "inter_op": config["inter_op"], "cpus": config.get("cpus")},
+    }
+
+# ============================================================================
+# 4. LAUNCHER
+# ============================================================================
+
+@functools.lru_cache(maxsize=None)
+def parameter_count():
+    """Values in one full set of create_cnn_model's weights (sizes the exchange buffer)."""
+    from ml_model_example import create_cnn_model
+    return int(sum(np.prod(w.shape) for w in create_cnn_model().get_weights()))
+
+
+def train_data_parallel(dataset='data', workers=2, epochs=5, batch_size=8, steps_per_epoch=None,
+                        output='best_model.h5', seed=0, synthetic=False, warmup_steps=2,
+                        pin=False, timeout=300.0):
+    """
+    Train create_cnn_model on `workers` local processes with synchronized gradients.
+
+    Args:
+        dataset (str): Labeled directory or array-dataset prefix (see open_dataset)
+        workers (int): Number of worker processes
+        epochs (int): Training epochs
+        batch_size (int): Examples per worker per step (the global batch is
+            workers * batch_size, so learning-rate tuning depends on workers)
+        steps_per_epoch (int): Steps per epoch; defaults to one pass over
+            the smallest shard
+        output (str): Where rank 0 saves the model (None to skip)
+        seed (int): Seed for initial weights and shard order
+        synthetic (bool): Train on random images (benchmarks)
+        warmup_steps (int): Steps excluded from the throughput figures
+        pin (bool): Pin each worker to its own slice of the cores
+        timeout (float): Seconds a worker may wait for its peers
+
+    Returns:
+        dict: Per-epoch loss/accuracy over all workers, throughput and timings
+
+    Raises:
+        RuntimeError: if a worker fails
+    """
+    data = open_dataset(dataset, synthetic, seed)
+    smallest_shard = len(shard_indices(data["labels"], workers - 1, workers))
+    if steps_per_epoch is None:
+        steps_per_epoch = smallest_shard // batch_size
+    if smallest_shard == 0 or steps_per_epoch < 1:
+        raise ValueError(f"{workers} workers need at least {workers * batch_size} examples "
+                         f"for one step of batch {batch_size}; the dataset has {int(np.sum(data['labels'] >= 0))}")
+
+    options = {
+        "dataset": dataset, "synthetic": synthetic, "seed": seed, "epochs": epochs,
+        "batch_size": batch_size, "steps_per_epoch": steps_per_epoch,
+        "warmup_steps": min(warmup_steps, epochs * steps_per_epoch - 1),
+        "output": output, "pin": pin,
+    }
+
+    # Spawned, not forked: each worker starts its own TensorFlow runtime
+    context = multiprocessing.get_context('spawn')
+    exchange = GradientExchange(context, workers, parameter_count(), timeout)
+    results = context.Queue()
+    processes = [context.Process(target=_worker, args=(rank, workers, exchange, results, options),
+                                 name=f"train-worker-{rank}") for rank in range(workers)]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+
+    replies = {}
+    try:
+        while len(replies) < workers:
+            try:
+                reply = results.get(timeout=1.0)
+            except queue.Empty:
+                crashed = [p for p in processes if p.exitcode not in (None, 0)]
+                if crashed:
+                    raise RuntimeError(f"{crashed[0].name} exited with code {crashed[0].exitcode}")
+                continue
+            if "error" in reply and not reply.get("broken"):
+                raise RuntimeError(f"Worker {reply['rank']} failed:\n{reply['error']}")
+            replies[reply["rank"]] = reply.get("result")
+        if None in replies.values():
+            raise RuntimeError(f"Workers timed out waiting for each other after {timeout}s")
+    finally:
+        for process in processes:
+            if len(replies) < workers:
+                process.terminate()
+            process.join()
+
+    return _summarize(replies, workers, batch_size, steps_per_epoch, time.perf_counter() - started)
+
+
+def _summarize(replies, workers, batch_size, steps_per_epoch, wall_seconds):
+    """Combine the workers' reports into one."""
+    history = []
+    for epoch in range(len(replies[0]["history"])):
+        rows = [replies[rank]["history"][epoch] for rank in range(workers)]
+        examples = sum(row["examples"] for row in rows)
+        history.append({
+            "epoch": epoch + 1,
+            "loss": round(sum(row["loss_sum"] for row in rows) / max(examples, 1), 4),
+            "accuracy": round(sum(row["correct"] for row in rows) / max(examples, 1), 4),
+        })
+
+    # Steps are synchronized, so the slowest worker sets the pace
+    seconds = max(reply["seconds"] for reply in replies.values())
+    examples = sum(reply["examples"] for reply in replies.values())
+    timings = {key: round(max(reply["timings"][key] for reply in replies.values()) * 1000, 1)
+               for key in replies[0]["timings"]}
+    return {
+        "workers": workers,
+        "batch_size": batch_size,
+        "global_batch_size": workers * batch_size,
+        "steps_per_epoch": steps_per_epoch,
+        "history": history,
+        "examples_per_second": round(examples / seconds, 2) if seconds else None,
+        "measured_examples": examples,
+        "measured_seconds": round(seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "time_ms": timings,
+        "threads": [replies[rank]["threads"] for rank in range(workers)],
+    }
+
+# ============================================================================
+# 5. SCALING REPORT
+# ============================================================================
+
+def benchmark_scaling(worker_counts=(1, 2, 4, 8), dataset='data', steps=20, batch_size=8,
+                      synthetic=False, warmup_steps=2, pin=False):
+    """
+    Measure training throughput at each worker count.
+
+    Every run takes the same number of steps with the same per-worker batch
+    (weak scaling): ideal scaling multiplies examples/sec by the worker
+    count. Speedup and efficiency are relative to the first count.
+
+    Returns:
+        dict: {"host", "results": [{"workers", "examples_per_second",
+            "speedup", "efficiency", "time_ms"}, ...]}
+    """
+    results = []
+    for workers in worker_counts:
+        print(f"Training with {workers} worker(s)...")
+        report = train_data_parallel(dataset, workers, epochs=1, batch_size=batch_size,
+                                     steps_per_epoch=warmup_steps + steps, output=None,
+                                     synthetic=synthetic, warmup_steps=warmup_steps, pin=pin)
+        results.append({key: report[key] for key in
+                        ("workers", "global_batch_size", "examples_per_second", "measured_seconds", "time_ms")})
+
+    base = results[0]
+    for row in results:
+        if base["examples_per_second"] and row["examples_per_second"]:
+            row["speedup"] = round(row["examples_per_second"] / base["examples_per_second"], 2)
+            row["efficiency"] = round(row["speedup"] * base["workers"] / row["workers"], 2)
+    return {
+        "host": {"cpus": available_cores(), "machine": platform.machine()},
+        "dataset": "synthetic" if synthetic else dataset,
+        "batch_size": batch_size,
+        "steps": steps,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Data-parallel training of the CNN on local worker processes')
+    parser.add_argument('dataset', nargs='?', default='data',
+                        help='Directory with real/ and ai/, or an evaluate.py --build prefix')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=8, help='Examples per worker per step')
+    parser.add_argument('--steps-per-epoch', type=int, default=None)
+    parser.add_argument('--output', default='best_model.h5', help='Where to save the trained model')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--synthetic', action='store_true', help='Use random images instead of a dataset')
+    parser.add_argument('--pin', action='store_true', help='Pin each worker to its own cores')
+    parser.add_argument('--scaling', type=int, nargs='+', metavar='N',
+                        help='Benchmark throughput at these worker counts instead of training')
+    parser.add_argument('--steps', type=int, default=20, help='Measured steps per scaling run')
+    parser.add_argument('--report', default='scaling_report.json', help='Scaling report path')
+    args = parser.parse_args()
+
+    if args.scaling:
+        report = benchmark_scaling(args.scaling, args.dataset, args.steps, args.batch_size,
+                                   args.synthetic, pin=args.pin)
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n{'workers':>8} {'examples/s':>11} {'speedup':>8} {'efficiency':>11}")
+        for row in report["results"]:
+            print(f"{row['workers']:>8} {row['examples_per_second']:>11} "
+                  f"{row.get('speedup', '-'):>8} {row.get('efficiency', '-'):>11}")
+        print(f"Report written to {args.report} ({report['host']['cpus']} cores available)")
+        return
+
+    report = train_data_parallel(args.dataset, args.workers, args.epochs, args.batch_size,
+                                 args.steps_per_epoch, args.output, args.seed, args.synthetic,
+                                 pin=args.pin)
+    for row in report["history"]:
+        print(f"Epoch {row['epoch']}: loss {row['loss']}, accuracy {row['accuracy']}")
+    print(f"{report['examples_per_second']} examples/s on {args.workers} workers "
+          f"(sync {report['time_ms']['sync']} ms of {report['measured_seconds'] * 1000:.0f} ms)")
+    if args.output:
+        print(f"Model saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
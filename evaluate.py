@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+Evaluation harness for the AI image detector
+Runs batched inference over a labeled set and reports quality (accuracy,
+ROC-AUC, precision/recall at thresholds, calibration) and speed in one JSON
+report, so a model or serving backend change can be compared against a
+baseline on both. A labeled set is either a directory laid out like
+train_model.py's data/ (real/ and ai/ subdirectories) or a memory-mapped
+.npy dataset built from one with --build, which skips decoding on every
+later run. All metrics are computed vectorized over the full score array.
+
+    python evaluate.py data --model best_model.h5 --output report.json
+    python evaluate.py --build data/eval data
+    python evaluate.py data/eval --baseline report.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_probe import decode_first_frame
+from model_serving import apply_thread_config, load_thread_config
+
+# Class directories and their labels, as in train_model.py
+CLASS_DIRS = {"real": 0, "ai": 1}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+DEFAULT_THRESHOLDS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+# ============================================================================
+# 1. DATASETS
+# ============================================================================
+
+def list_labeled_files(root):
+    """
+    Image paths under root/real and root/ai with labels 0 and 1.
+
+    Returns:
+        tuple: (paths list, labels int8 array)
+    """
+    paths, labels = [], []
+    for class_dir, label in CLASS_DIRS.items():
+        directory = os.path.join(root, class_dir)
+        if not os.path.isdir(directory):
+            continue
+        for dirpath, _, files in os.walk(directory):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(dirpath, name))
+                    labels.append(label)
+    if not paths:
+        raise ValueError(f"No images found under {root}/real or {root}/ai")
+    return paths, np.array(labels, dtype=np.int8)
+
+
+def load_image(path, target_size=(224, 224)):
+    """Decode and resize one file the way the servers do; uint8 (H, W, 3)."""
+    with open(path, 'rb') as f:
+        image = decode_first_frame(f.read())
+    return np.asarray(image.resize(target_size), dtype=np.uint8)
+
+
+def build_array_dataset(root, prefix, workers=8, target_size=(224, 224)):
+    """
+    Decode a labeled directory once into memory-mappable arrays.
+
+    Writes prefix.images.npy (uint8, N x H x W x 3), prefix.labels.npy and
+    prefix.files.txt. Images that fail to decode are kept with label -1 and
+    skipped by evaluation.
+
+    Returns:
+        int: Number of images that failed to decode
+    """
+    paths, labels = list_labeled_files(root)
+    images = np.lib.format.open_memmap(f'{prefix}.images.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), target_size[1], target_size[0], 3))
+    labels = labels.copy()
+
+    def load(i):
+        try:
+            images[i] = load_image(paths[i], target_size)
+        except Exception:
+            labels[i] = -1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(load, range(len(paths))))
+    images.flush()
+    del images
+
+    np.save(f'{prefix}.labels.npy', labels)
+    with open(f'{prefix}.files.txt', 'w') as f:
+        f.write('\n'.join(paths) + '\n')
+    return int(np.sum(labels < 0))
+
+
+def load_array_dataset(prefix):
+    """Memory-map a dataset written by build_array_dataset; returns (images, labels)."""
+    images = np.load(f'{prefix}.images.npy', mmap_mode='r')
+    labels = np.load(f'{prefix}.labels.npy')
+    return images, labels
+
+
+def directory_batches(paths, labels, batch_size, workers=8, target_size=(224, 224)):
+    """
+    Yield (uint8 images, labels, failed count) batches, decoding on a thread
+    pool (PIL releases the GIL while decoding and resizing).
+    """
+    def load(path):
+        try:
+            return load_image(path, target_size)
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(paths), batch_size):
+            loaded = list(executor.map(load, paths[start:start + batch_size]))
+            keep = [i for i, image in enumerate(loaded) if image is not None]
+            batch_labels = labels[start:start + batch_size][keep]
+            images = np.stack([loaded[i] for i in keep]) if keep else None
+            yield images, batch_labels, len(loaded) - len(keep)
+
+
+def array_batches(images, labels, batch_size, indices=None):
+    """
+    Yield batches straight from a memory-mapped dataset (label -1 rows
+    skipped), optionally only the rows in sorted indices.
+    """
+    count = len(labels) if indices is None else len(indices)
+    for start in range(0, count, batch_size):
+        if indices is None:
+            rows = slice(start, start + batch_size)
+        else:
+            rows = indices[start:start + batch_size]
+        batch_labels = labels[rows]
+        keep = batch_labels >= 0
+        batch = images[rows]
+        if not keep.all():
+            batch = batch[keep]
+        yield (np.asarray(batch) if len(batch) else None), batch_labels[keep], int(np.sum(~keep))
+
+# ============================================================================
+# 2. METRICS
+# ============================================================================
+#
+# labels are 0 (real) / 1 (ai) and scores the model's AI probability, both
+# 1-D arrays over the whole set.
+
+def roc_auc(labels, scores):
+    """
+    Area under the ROC curve, from the rank-sum (Mann-Whitney U) statistic
+    with tied scores given their average rank.
+    """
+    labels = np.asarray(labels, dtype=bool)
+    n_pos = int(labels.sum())
+    n_neg = len(labels) - n_pos
+    if n_pos == 0 or n_neg == 0:
+        return None
+
+    order = np.argsort(scores, kind='mergesort')
+    sorted_scores = np.asarray(scores)[order]
+    # Average rank for each run of equal scores
+    _, first, counts = np.unique(sorted_scores, return_index=True, return_counts=True)
+    run_ranks = first + (counts + 1) / 2.0
+    ranks = np.empty(len(scores), dtype=np.float64)
+    ranks[order] = np.repeat(run_ranks, counts)
+
+    return float((ranks[labels].sum() - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg))
+
+
+def precision_recall_at(labels, scores, thresholds=DEFAULT_THRESHOLDS):
+    """
+    Precision, recall and F1 of "ai" for score >= each threshold.
+
+    Returns:
+        list: One dict per threshold
+    """
+    labels = np.asarray(labels, dtype=bool)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    sorted_scores = np.sort(scores)
+    positive_scores = np.sort(np.asarray(scores)[labels])
+
+    # Counts of scores >= t for every threshold at once
+    predicted = len(sorted_scores) - np.searchsorted(sorted_scores, thresholds, side='left')
+    true_pos = len(positive_scores) - np.searchsorted(positive_scores, thresholds, side='left')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, true_pos / predicted, np.nan)
+        recall = true_pos / max(len(positive_scores), 1)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    return [
+        {"threshold": float(t), "precision": None if np.isnan(p) else round(float(p), 4),
+         "recall": round(float(r), 4), "f1": None if np.isnan(f) else round(float(f), 4),
+         "flagged": int(n)}
+        for t, p, r, f, n in zip(thresholds, precision, recall, f1, predicted)
+    ]
+
+
+def expected_calibration_error(labels, scores, bins=15):
+    """
+    ECE over equal-width confidence bins: the gap between how confident the
+    predicted label is and how often it is right, weighted by bin size.
+
+    Returns:
+        tuple: (ece, list of per-bin dicts for non-empty bins)
+    """
+    labels = np.asarray(labels, dtype=bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    predicted_ai = scores >= 0.5
+    confidence = np.where(predicted_ai, scores, 1.0 - scores)
+    correct = predicted_ai == labels
+
+    # Confidence of the predicted label is in [0.5, 1]
+    edges = np.linspace(0.5, 1.0, bins + 1)
+    bin_index = np.clip(np.searchsorted(edges, confidence, side='right') - 1, 0, bins - 1)
+    counts = np.bincount(bin_index, minlength=bins)
+    confidence_sum = np.bincount(bin_index, weights=confidence, minlength=bins)
+    correct_sum = np.bincount(bin_index, weights=correct, minlength=bins)
+
+    nonempty = counts > 0
+    mean_confidence = confidence_sum[nonempty] / counts[nonempty]
+    accuracy = correct_sum[nonempty] / counts[nonempty]
+    ece = float(np.sum(counts[nonempty] * np.abs(accuracy - mean_confidence)) / max(len(scores), 1))
+
+    reliability = [
+        {"bin": [round(float(lo), 3), round(float(hi), 3)], "count": int(n),
+         "confidence": round(float(c), 4), "accuracy": round(float(a), 4)}
+        for lo, hi, n, c, a in zip(edges[:-1][nonempty], edges[1:][nonempty],
+                                   counts[nonempty], mean_confidence, accuracy)
+    ]
+    return ece, reliability
+
+
+def compute_metrics(labels, scores, thresholds=DEFAULT_THRESHOLDS, bins=15):
+    """All quality metrics for one run."""
+    labels = np.asarray(labels, dtype=np.int8)
+    scores = np.asarray(scores, dtype=np.float64)
+    predicted = (scores >= 0.5).astype(np.int8)
+
+    confusion = np.bincount(labels * 2 + predicted, minlength=4).reshape(2, 2)
+    ece, reliability = expected_calibration_error(labels, scores, bins)
+    auc = roc_auc(labels, scores)
+    return {
+        "count": int(len(labels)),
+        "positives": int(labels.sum()),
+        "accuracy": round(float(np.mean(predicted == labels)), 4),
+        "roc_auc": None if auc is None else round(auc, 4),
+        "brier": round(float(np.mean((scores - labels) ** 2)), 4),
+        "ece": round(ece, 4),
+        # rows: true real / ai, columns: predicted real / ai
+        "confusion": confusion.tolist(),
+        "thresholds": precision_recall_at(labels, scores, thresholds),
+        "reliability": reliability
+    }
+
+# ============================================================================
+# 3. RUNNER
+# ============================================================================
+
+def _prefetch(batches, depth=2):
+    """Load the next batches on a background thread while the model runs."""
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for batch in batches:
+                buffer.put(batch)
+        finally:
+            buffer.put(done)
+
+    threading.Thread(target=produce, name='eval-prefetch', daemon=True).start()
+    while True:
+        batch = buffer.get()
+        if batch is done:
+            return
+        yield batch
+
+
+def run_inference(model, batches):
+    """
+    Score every batch and time the run.
+
+    Args:
+        model: Anything with predict(inputs, verbose=0) returning (N, 2)
+            softmax rows (Keras model or model_serving.TFLiteModel)
+        batches (iterable): (uint8 images, labels, failed) tuples
+
+    Returns:
+        tuple: (labels, scores, throughput dict)
+    """
+    all_labels, all_scores, latencies = [], [], []
+    failed = 0
+    wait_s = 0.0
+
+    start = time.perf_counter()
+    waited_from = start
+    for images, labels, batch_failed in _prefetch(batches):
+        wait_s += time.perf_counter() - waited_from
+        failed += batch_failed
+        if images is not None:
+            inputs = images.astype(np.float32) / 255.0
+            predict_start = time.perf_counter()
+            predictions = model.predict(inputs, verbose=0)
+            latencies.append(time.perf_counter() - predict_start)
+            all_scores.append(np.asarray(predictions)[:, 1])
+            all_labels.append(labels)
+        waited_from = time.perf_counter()
+    elapsed = time.perf_counter() - start
+
+    labels = np.concatenate(all_labels) if all_labels else np.zeros(0, dtype=np.int8)
+    scores = np.concatenate(all_scores) if all_scores else np.zeros(0)
+    latencies = np.array(latencies)
+    inference_s = float(latencies.sum())
+    throughput = {
+        "images": int(len(scores)),
+        "failed": failed,
+        "elapsed_s": round(elapsed, 2),
+        "images_per_second": round(len(scores) / max(elapsed, 1e-9), 1),
+        "inference_images_per_second": round(len(scores) / max(inference_s, 1e-9), 1),
+        "waiting_on_input_s": round(wait_s, 2),
+        "batch_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1) if len(latencies) else None,
+        "batch_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1) if len(latencies) else None
+    }
+    return labels, scores, throughput
+
+
+def stratified_subset(labels, limit, seed=0):
+    """
+    Sorted indices of a seeded random subset of `limit` rows, with the
+    classes in the same proportions as the whole set (and at least one row
+    of each). Files are listed class by class, so the first `limit` rows
+    would be a single class. Rows labeled -1 (failed to decode) are left out.
+    """
+    rng = np.random.default_rng(seed)
+    classes = [np.flatnonzero(labels == label) for label in sorted(CLASS_DIRS.values())]
+    sizes = np.array([len(rows) for rows in classes])
+    counts = np.minimum(sizes, np.maximum(limit * sizes // max(sizes.sum(), 1), sizes > 0))
+    # The rounding remainder goes to the largest classes
+    for i in np.argsort(-sizes):
+        if counts.sum() < limit and counts[i] < sizes[i]:
+            counts[i] += 1
+    picked = [rng.choice(rows, count, replace=False) for rows, count in zip(classes, counts)]
+    return np.sort(np.concatenate(picked)).astype(np.int64)
+
+
+def evaluate(model, dataset, batch_size=64, workers=8, thresholds=DEFAULT_THRESHOLDS, limit=None, seed=0):
+    """
+    Evaluate a model on a labeled directory or a build_array_dataset prefix.
+
+    With limit, a stratified random subset (see stratified_subset) is used.
+
+    Returns:
+        dict: {"metrics": ..., "throughput": ...}
+
+    Raises:
+        ValueError: if no image could be evaluated
+    """
+    if os.path.exists(f'{dataset}.images.npy'):
+        images, labels = load_array_dataset(dataset)
+        indices = stratified_subset(labels, limit, seed) if limit else None
+        batches = array_batches(images, labels, batch_size, indices)
+    else:
+        paths, labels = list_labeled_files(dataset)
+        if limit:
+            indices = stratified_subset(labels, limit, seed)
+            paths, labels = [paths[i] for i in indices], labels[indices]
+        batches = directory_batches(paths, labels, batch_size, workers)
+
+    labels, scores, throughput = run_inference(model, batches)
+    if not len(labels):
+        raise ValueError(f"No images could be evaluated in {dataset} ({throughput['failed']} failed to decode)")
+    return {"metrics": compute_metrics(labels, scores, thresholds), "throughput": throughput}
+
+
+def compare_reports(report, baseline):
+    """Headline metric deltas against a baseline report."""
+    keys = [("metrics", "accuracy"), ("metrics", "roc_auc"), ("metrics", "ece"), ("metrics", "brier"),
+            ("throughput", "images_per_second"), ("throughput", "inference_images_per_second")]
+    deltas = {}
+    for section, key in keys:
+        new, old = report[section].get(key), baseline.get(section, {}).get(key)
+        if new is not None and old is not None:
+            deltas[key] = {"baseline": old, "current": new, "delta": round(new - old, 4)}
+    return deltas
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate the detector on a labeled image set")
+    parser.add_argument('dataset', nargs='?', default='data',
+                        help="Directory with real/ and ai/, or a prefix written by --build")
+    parser.add_argument('--build', metavar='PREFIX',
+                        help="Decode the dataset directory into PREFIX.*.npy and exit")
+    parser.add_argument('--model', help="Keras weights (.h5) or .tflite model (default: best_model.h5)")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=8, help="Decode threads for directory datasets")
+    parser.add_argument('--limit', type=int, help="Evaluate a stratified random sample of N images")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the --limit sample")
+    parser.add_argument('--thresholds', type=float, nargs='+', default=DEFAULT_THRESHOLDS)
+    parser.add_argument('--output', default='eval_report.json')
+    parser.add_argument('--baseline', help="Earlier report to compare against")
+    args = parser.parse_args()
+
+    if args.build:
+        failed = build_array_dataset(args.dataset, args.build, args.workers)
+        print(f"Wrote {args.build}.images.npy ({failed} images failed to decode)")
+        raise SystemExit(0)
+
+    from bulk_score import load_detector
+
+    thread_config = apply_thread_config(load_thread_config())
+    detector = load_detector(args.model, threads=thread_config['intra_op'])
+    try:
+        report = evaluate(detector.model, args.dataset, args.batch_size, args.workers, args.thresholds,
+                          args.limit, args.seed)
+    except ValueError as e:
+        raise SystemExit(f"Evaluation failed: {e}")
+    report.update(
+        model=args.model or ('best_model.h5' if os.path.exists('best_model.h5') else None),
+        backend=type(detector.model).__name__,
+        dataset=args.dataset,
+        limit=args.limit,
+        seed=args.seed if args.limit else None,
+        batch_size=args.batch_size,
+        host={"cpus": os.cpu_count(), "machine": platform.machine(), "threads": thread_config}
+    )
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare_reports(report, json.load(f))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    metrics, throughput = report["metrics"], report["throughput"]
+    print(f"{metrics['count']} images: accuracy {metrics['accuracy']}, ROC-AUC {metrics['roc_auc']}, "
+          f"ECE {metrics['ece']}, Brier {metrics['brier']}")
+    print(f"{throughput['images_per_second']} img/s overall, "
+          f"{throughput['inference_images_per_second']} img/s inference, "
+          f"batch p95 {throughput['batch_p95_ms']} ms ({throughput['failed']} failed)")
+    for delta_key, delta in report.get("comparison", {}).items():
+        print(f"  {delta_key}: {delta['baseline']} -> {delta['current']} ({delta['delta']:+})")
+    print(f"Report written to {args.output}")
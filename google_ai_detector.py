@@ -6,19 +6,90 @@ Uses Google's free AI detection service
 
 import requests
 import json
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 import os
+import io
+import base64
 
-app = Flask(__name__)
+from circuit_breaker import get_breaker, breaker_states, CircuitOpenError
+from image_probe import decode_first_frame, images_from_request, sniff_image_header, ImageRejected
+from admission import AdmissionController
+from response_codec import install_codec
+from deadline import DeadlineExceeded, bounded_timeout, deadline_stats, stage
+
+app = install_codec(Flask(__name__))
+
+# Bounded concurrency with fair queuing; mostly waiting on Google
+admission = AdmissionController.from_env('google', max_in_flight=16)
 
 # Google AI Detection API endpoint
 GOOGLE_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent"
 
-def detect_ai_with_google(image_url, api_key):
+# (connect, read) timeouts for the upstream call
+GOOGLE_TIMEOUT = (3.05, 20)
+
+# Fire a second upstream attempt when the first is slower than p95
+HEDGE_REQUESTS = os.getenv('GOOGLE_HEDGE_REQUESTS', '0') == '1'
+
+# Formats Gemini takes inline as they are; the rest are re-encoded to JPEG
+INLINE_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+def _inline_image(image_bytes, image_format=None):
+    """
+    (mime_type, base64 data) for an uploaded image.
+
+    GIF, BMP and TIFF are not accepted inline, so their first frame is sent
+    as a JPEG at full size.
+
+    Raises:
+        ImageRejected: if an image that needs re-encoding cannot be decoded
+    """
+    if image_format is None:
+        info = sniff_image_header(image_bytes, complete=True)
+        image_format = info["format"] if info else None
+
+    mime_type = INLINE_MIME_TYPES.get(image_format)
+    if mime_type is None:
+        try:
+            image = decode_first_frame(image_bytes)
+        except ImageRejected:
+            raise
+        except Exception as e:
+            raise ImageRejected("undecodable", f"Could not decode image: {e}") from e
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=90)
+        image_bytes, mime_type = buffer.getvalue(), "image/jpeg"
+
+    return mime_type, base64.b64encode(image_bytes).decode('utf-8')
+
+def _post_to_google(payload, headers, api_key, deadline=None):
+    """POST to the Google API; server errors raise so the breaker counts them."""
+    response = requests.post(
+        f"{GOOGLE_API_URL}?key={api_key}",
+        json=payload,
+        headers=headers,
+        timeout=tuple(bounded_timeout(deadline, t, 'upstream') for t in GOOGLE_TIMEOUT)
+    )
+    if response.status_code >= 500 or response.status_code == 429:
+        response.raise_for_status()
+    return response
+
+def detect_ai_with_google(image_url, api_key, image_bytes=None, deadline=None, image_format=None):
     """
     Use Google's AI detection API to classify images
+    
+    When the client uploaded the image, image_bytes is sent inline instead
+    of the URL, with the MIME type of image_format (the probed format; sniffed
+    when not given). The upstream call is bounded by the request deadline;
+    DeadlineExceeded propagates.
     """
     try:
+        mime_type = "image/jpeg"
+        if image_bytes is not None:
+            mime_type, image_data = _inline_image(image_bytes, image_format)
+        else:
+            image_data = image_url  # This should be base64 encoded in production
+        
         # Google's API expects a specific format
         payload = {
             "contents": [{
@@ -26,8 +97,8 @@ def detect_ai_with_google(image_url, api_key):
                     "text": "Analyze this image and determine if it was generated by AI or is a real photograph. Respond with only 'AI' or 'REAL' and a confidence score from 0-100."
                 }, {
                     "inline_data": {
-                        "mime_type": "image/jpeg",
-                        "data": image_url  # This should be base64 encoded in production
+                        "mime_type": mime_type,
+                        "data": image_data
                     }
                 }]
             }]
@@ -38,11 +109,9 @@ def detect_ai_with_google(image_url, api_key):
             "Authorization": f"Bearer {api_key}"
         }
         
-        response = requests.post(
-            f"{GOOGLE_API_URL}?key={api_key}",
-            json=payload,
-            headers=headers
-        )
+        with stage(deadline, 'upstream'):
+            response = get_breaker('google').call(
+                _post_to_google, payload, headers, api_key, deadline, hedge=HEDGE_REQUESTS)
         
         if response.status_code == 200:
             result = response.json()
@@ -52,28 +121,64 @@ def detect_ai_with_google(image_url, api_key):
         else:
             return {"error": f"API error: {response.status_code}"}
             
+    except DeadlineExceeded:
+        raise
+    except ImageRejected as e:
+        return {"error": str(e), "rejected": e.reason}
+    except CircuitOpenError as e:
+        return {"error": str(e), "circuit": "open"}
     except Exception as e:
         return {"error": str(e)}
 
 @app.route('/classify', methods=['POST'])
+@admission.limit
 def classify_image():
     """Flask endpoint for image classification"""
     try:
-        data = request.get_json()
-        image_url = data.get('imageUrl')
         api_key = os.getenv('GOOGLE_API_KEY')
-        
-        if not image_url:
-            return jsonify({"error": "imageUrl required"}), 400
-            
         if not api_key:
             return jsonify({"error": "GOOGLE_API_KEY environment variable required"}), 500
+        
+        # Image bytes uploaded by the client skip the URL entirely
+        uploads = images_from_request(request)
+        if uploads is not None:
+            if len(uploads) != 1:
+                return jsonify({"error": "exactly one image required"}), 400
+            image_bytes, info = uploads[0]
+            result = detect_ai_with_google(None, api_key, image_bytes=image_bytes, deadline=g.deadline,
+                                           image_format=info["format"])
+        else:
+            data = request.get_json()
+            image_url = data.get('imageUrl')
             
-        result = detect_ai_with_google(image_url, api_key)
+            if not image_url:
+                return jsonify({"error": "imageUrl required"}), 400
+            
+            result = detect_ai_with_google(image_url, api_key, deadline=g.deadline)
+        if result.get('rejected'):
+            return jsonify(result), 400
+        # Surface upstream failures as 502 so the extension falls back cleanly
+        if result.get('error'):
+            return jsonify(result), 502
         return jsonify(result)
         
+    except ImageRejected as e:
+        return jsonify({"error": str(e), "rejected": e.reason}), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint"""
+    return jsonify({
+        "status": "healthy",
+        "api_key_configured": bool(os.getenv('GOOGLE_API_KEY')),
+        "circuit_breakers": breaker_states(),
+        "admission": admission.snapshot(),
+        "deadlines": deadline_stats()
+    })
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
@@ -0,0 +1,74 @@
+"""
+Gunicorn configuration for serving deploy_model.py with pre-forked workers
+
+    SERVING_BACKEND=tflite WEB_CONCURRENCY=4 gunicorn -c gunicorn.conf.py
+
+The master converts trained_model.h5 to a TFLite flatbuffer and pages it in
+before forking; each worker maps that same file, so the weights are held once
+in the page cache rather than once per worker. The app is not preloaded:
+TensorFlow's runtime is not fork-safe, so it only ever starts inside workers.
+Each worker applies the thread config from model_serving.load_thread_config
+(SERVING_THREADS_CONFIG file and env overrides): by default cores / workers
+intra-op and OpenCV threads, so together they do not oversubscribe the
+machine, and with "pin" each worker is bound to its own slice of CPUs.
+
+With SERVING_BACKEND=keras (the default) every worker loads its own Keras
+copy, as `python deploy_model.py` does, but still with the thread budget.
+
+When a model registry exists (model_registry.py), workers serve its active
+version instead and each one hot-swaps to a new version by itself; the
+export above is then skipped.
+"""
+
+import os
+
+from model_registry import ModelRegistry
+from model_serving import apply_thread_config, export_tflite, load_thread_config, page_in
+
+_thread_config = load_thread_config()
+if not os.getenv('WEB_CONCURRENCY') and not os.getenv('SERVING_THREADS_CONFIG'):
+    _thread_config['workers'] = 2
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = _thread_config['workers']
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+wsgi_app = 'deploy_model:app'
+preload_app = False
+
+_backend = os.getenv('SERVING_BACKEND', 'keras')
+_mapping = None
+
+
+def on_starting(server):
+    """Export and page in the shared model once, in the master."""
+    global _mapping
+    if _backend != 'tflite' or ModelRegistry.from_env() is not None:
+        return
+    tflite_path = os.getenv('MODEL_TFLITE_PATH', 'trained_model.tflite')
+    export_tflite('trained_model.h5', tflite_path)
+    _mapping = page_in(tflite_path)
+    server.log.info("Mapped %s (%d bytes) for %d workers", tflite_path, len(_mapping), workers)
+
+
+def pre_fork(server, worker):
+    """Give the new worker the lowest free slot (its CPU slice when pinning)."""
+    # The worker being forked is not in server.WORKERS yet
+    taken = {getattr(w, 'cpu_slot', None) for w in server.WORKERS.values()}
+    worker.cpu_slot = next((slot for slot in range(workers) if slot not in taken), None)
+    if worker.cpu_slot is None:
+        # More workers than configured (TTIN): run this one unpinned
+        server.log.warning("No free CPU slot for a new worker (%d running); it will not be pinned",
+                           len(server.WORKERS))
+
+
+def post_fork(server, worker):
+    """Hand each worker its share of the cores before TensorFlow starts."""
+    config = apply_thread_config(_thread_config, slot=worker.cpu_slot)
+    server.log.info("Worker %s: intra_op=%s inter_op=%s opencv=%s cpus=%s", worker.pid,
+                    config['intra_op'], config['inter_op'], config['opencv'], config.get('cpus', 'all'))
+
+
+def post_worker_init(worker):
+    """Load (or map) and warm the model in the worker before it takes requests."""
+    import deploy_model
+    deploy_model.load_or_create_model()
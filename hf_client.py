@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Reusable Hugging Face Inference API client
+Keeps one pooled session, downsizes images before upload, retries the
+"model loading" 503 and rate-limit 429 responses with backoff, and batches
+several images per call when the endpoint accepts it.
+"""
+
+import base64
+import io
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+from deadline import DeadlineExceeded
+from image_probe import ImageRejected
+
+# Point at a local mock server with HF_API_URL=http://localhost:8000/models/
+HF_API_URL = os.getenv('HF_API_URL', "https://api-inference.huggingface.co/models/")
+DEFAULT_MODEL = "google/vit-base-patch16-224"
+
+RETRY_STATUSES = (429, 503)
+
+
+class HuggingFaceError(Exception):
+    """Raised when the Inference API keeps failing after all retries."""
+
+    def __init__(self, status_code, details):
+        super().__init__(f"API error: {status_code}" if status_code else f"Upstream unreachable: {details}")
+        self.status_code = status_code
+        self.details = details
+
+    @property
+    def upstream_fault(self):
+        """True when the upstream is unreachable, rate limiting or failing (429, 5xx), not for a rejected request."""
+        return self.status_code is None or self.status_code == 429 or self.status_code >= 500
+
+
+def resize_and_encode_jpeg(image_bytes: bytes, max_dim: int = 512, quality: int = 85) -> str:
+    """Downscale to max_dim and return base64 JPEG data URI string."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img = img.convert('RGB')
+        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality, optimize=True)
+        encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        return f"data:image/jpeg;base64,{encoded}"
+
+
+class HuggingFaceClient:
+    """
+    Pooled, retrying client for one Inference API model.
+
+    Safe to share between request threads: requests.Session is backed by a
+    thread-safe urllib3 connection pool sized by pool_size.
+    """
+
+    def __init__(self, api_key, model_name=DEFAULT_MODEL, base_url=None,
+                 connect_timeout=3.05, read_timeout=20, max_retries=4,
+                 backoff_base=0.5, max_backoff=30.0, max_dim=512,
+                 batch_size=1, pool_size=10):
+        """
+        Args:
+            api_key (str): Hugging Face API token
+            model_name (str): Model id appended to base_url
+            base_url (str): API root (defaults to HF_API_URL)
+            connect_timeout (float): Seconds to wait for a connection
+            read_timeout (float): Seconds to wait for a response
+            max_retries (int): Retries on 429/503 and connection errors
+            backoff_base (float): First backoff in seconds, doubled each retry
+            max_backoff (float): Cap on any single wait, including estimated_time
+            max_dim (int): Longest image side sent upstream
+            batch_size (int): Images per call; 1 for endpoints that take a single input
+            pool_size (int): Pooled connections kept open
+        """
+        self.url = f"{base_url or HF_API_URL}{model_name}"
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.max_dim = max_dim
+        self.batch_size = max(1, batch_size)
+        self.pool_size = pool_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _backoff(self, attempt, response=None):
+        """Seconds to wait before the next attempt."""
+        delay = self.backoff_base * (2 ** attempt)
+
+        if response is not None:
+            # 503 while the model loads carries {"estimated_time": seconds}
+            if response.status_code == 503:
+                try:
+                    delay = max(delay, float(response.json().get('estimated_time', 0)))
+                except (ValueError, AttributeError):
+                    pass
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.replace('.', '', 1).isdigit():
+                delay = max(delay, float(retry_after))
+
+        # Jitter so concurrent callers do not retry in lockstep
+        return min(delay, self.max_backoff) * random.uniform(0.8, 1.2)
+
+    def _request_timeout(self, deadline):
+        if deadline is None:
+            return self.timeout
+        return (deadline.timeout(self.timeout[0], 'upstream'), deadline.timeout(self.timeout[1], 'upstream'))
+
+    def _sleep(self, delay, deadline):
+        # No point waiting for a retry the caller will not be around for
+        if deadline is not None and delay >= deadline.remaining():
+            raise DeadlineExceeded(stage='upstream')
+        time.sleep(delay)
+
+    def post(self, payload, deadline=None):
+        """
+        POST a JSON payload, retrying transient failures.
+
+        Args:
+            payload (dict): JSON body
+            deadline (Deadline): Request deadline; bounds each attempt's
+                timeouts and stops retrying once a backoff would outlast it
+
+        Returns:
+            The decoded JSON response
+
+        Raises:
+            HuggingFaceError: on a non-retryable status or once retries run out
+            DeadlineExceeded: if the deadline passed
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.url, json=payload, timeout=self._request_timeout(deadline))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded(stage='upstream') from e
+                if attempt == self.max_retries:
+                    raise HuggingFaceError(None, str(e))
+                self._sleep(self._backoff(attempt), deadline)
+                continue
+
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                raise HuggingFaceError(response.status_code, response.text)
+            self._sleep(self._backoff(attempt, response), deadline)
+
+    def prepare(self, image_bytes, prompt=None):
+        """
+        Model input for one image: a downscaled JPEG data URI, with the prompt if given.
+
+        Raises:
+            ImageRejected: if the image cannot be decoded
+        """
+        try:
+            image = resize_and_encode_jpeg(image_bytes, max_dim=self.max_dim)
+        except Exception as e:
+            # PIL raises OSError, ValueError, DecompressionBombError... depending on the format
+            raise ImageRejected("undecodable", f"Could not decode image: {e}") from e
+        if prompt:
+            return {"image": image, "text": prompt}
+        return image
+
+    def classify(self, image_bytes, prompt=None, deadline=None):
+        """
+        Classify one image.
+
+        Args:
+            image_bytes (bytes): Encoded image, downscaled before upload
+            prompt (str): Optional text prompt for vision-language models
+            deadline (Deadline): Request deadline (see post)
+
+        Returns:
+            The model's JSON response
+
+        Raises:
+            ImageRejected: if the image cannot be decoded
+        """
+        return self.post({"inputs": self.prepare(image_bytes, prompt)}, deadline)
+
+    def prepare_batch(self, images, prompt=None):
+        """
+        Model inputs for several images, decoded concurrently.
+
+        Returns:
+            list: One input (or ImageRejected) per image, in input order
+        """
+        return list(self._get_executor().map(lambda b: self._safe(self.prepare, b, prompt), images))
+
+    def post_batch(self, inputs, deadline=None):
+        """
+        Send inputs from prepare_batch.
+
+        With batch_size > 1, up to batch_size inputs go in each call as a list.
+        Otherwise the single-input calls run concurrently over the pooled
+        session. ImageRejected entries are passed through without a call.
+
+        Returns:
+            list: One response (or HuggingFaceError, or ImageRejected) per
+                input, in input order
+
+        Raises:
+            DeadlineExceeded: if the deadline passed
+        """
+        results = list(inputs)
+        decoded = [i for i, result in enumerate(results) if not isinstance(result, ImageRejected)]
+        if self.batch_size == 1:
+            responses = self._get_executor().map(
+                lambda i: self._safe(self.post, {"inputs": results[i]}, deadline), decoded)
+            for i, result in zip(decoded, list(responses)):
+                results[i] = result
+            return results
+
+        for start in range(0, len(decoded), self.batch_size):
+            chunk = decoded[start:start + self.batch_size]
+            try:
+                response = self.post({"inputs": [results[i] for i in chunk]}, deadline)
+            except HuggingFaceError as e:
+                response = [e] * len(chunk)
+            if not isinstance(response, list) or len(response) != len(chunk):
+                response = [HuggingFaceError(200, "batch response does not match inputs")] * len(chunk)
+            for i, result in zip(chunk, response):
+                results[i] = result
+        return results
+
+    def classify_batch(self, images, prompt=None, deadline=None):
+        """
+        Classify several images (prepare_batch, then post_batch). An image
+        that cannot be decoded gets an ImageRejected entry and does not
+        affect the others.
+
+        Args:
+            images (list): Encoded images
+            prompt (str): Optional text prompt applied to every image
+            deadline (Deadline): Request deadline for the whole batch
+
+        Returns:
+            list: One response (or HuggingFaceError, or ImageRejected) per
+                image, in input order
+
+        Raises:
+            DeadlineExceeded: if the deadline passed
+        """
+        return self.post_batch(self.prepare_batch(images, prompt), deadline)
+
+    def warmup(self):
+        """Best-effort request so the model is loaded before real traffic."""
+        try:
+            self.session.post(self.url, json={"inputs": "warmup"}, timeout=(self.timeout[0], 3))
+        except requests.RequestException:
+            pass
+
+    def _safe(self, fn, *args):
+        try:
+            return fn(*args)
+        except (HuggingFaceError, ImageRejected) as e:
+            return e
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size)
+            return self._executor
+
+    def close(self):
+        """Close pooled connections and worker threads."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.session.close()
@@ -4,112 +4,300 @@ Hugging Face AI Detection Model
 Uses pre-trained models for AI image detection
 """
 
-import requests
-import json
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 import os
-from PIL import Image
-import io
-import base64
 import re
+import threading
 
-app = Flask(__name__)
+from circuit_breaker import get_breaker, breaker_states, CircuitOpenError
+from hf_client import HuggingFaceClient, HuggingFaceError, DEFAULT_MODEL
+from image_probe import fetch_image_bytes, images_from_request, ImageRejected, MAX_UPLOAD_IMAGES
+from admission import AdmissionController
+from response_codec import install_codec
+from deadline import DeadlineExceeded, deadline_stats, stage
 
-# Hugging Face API endpoint for AI detection models
-HF_API_URL = "https://api-inference.huggingface.co/models/"
+app = install_codec(Flask(__name__))
 
-def detect_ai_with_huggingface(image_url, api_key):
+# Bounded concurrency with fair queuing; mostly waiting on Hugging Face
+admission = AdmissionController.from_env('huggingface', max_in_flight=16)
+
+# Model used for detection; the client appends it to HF_API_URL
+HF_MODEL_NAME = DEFAULT_MODEL
+
+# Create a prompt for AI detection
+PROMPT = "Analyze this image and determine if it was generated by AI or is a real photograph. Look for signs like: 1) Unrealistic details or artifacts 2) Perfect symmetry or patterns 3) Inconsistent lighting or shadows 4) Unusual textures or surfaces. Respond with only 'AI' or 'REAL' followed by a confidence percentage (0-100)."
+
+# Fire a second upstream attempt when the first is slower than p95
+HEDGE_REQUESTS = os.getenv('HF_HEDGE_REQUESTS', '0') == '1'
+
+# One pooled client per API key, shared by all request threads
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(api_key):
+    """Return the shared HuggingFaceClient for this API key."""
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(api_key)
+        if client is None:
+            client = HuggingFaceClient(api_key, model_name=HF_MODEL_NAME)
+            _CLIENTS[api_key] = client
+        return client
+
+
+def parse_hf_response(result):
     """
-    Use Hugging Face's API to classify images
-    We'll use a vision-language model and prompt it for AI detection
+    Turn an Inference API response into label/confidence.
+    
+    Handles text generation output ({"generated_text": ...}) as well as
+    image classification output ([{"label": ..., "score": ...}]).
+    """
+    if isinstance(result, list) and result and isinstance(result[0], dict) and 'score' in result[0]:
+        top = max(result, key=lambda r: r.get('score', 0))
+        top_label = str(top.get('label', ''))
+        label = "ai" if re.search(r'\b(ai|artificial|fake|generated)\b', top_label, re.IGNORECASE) else "real"
+        return label, float(top.get('score', 0)), top_label
+    
+    if isinstance(result, list) and result:
+        result = result[0]
+    
+    # Parse the response to extract AI/REAL and confidence
+    response_text = result.get('generated_text', '') if isinstance(result, dict) else ''
+    
+    # Extract AI/REAL label
+    ai_match = re.search(r'\bAI\b', response_text, re.IGNORECASE)
+    real_match = re.search(r'\bREAL\b', response_text, re.IGNORECASE)
+    
+    if ai_match:
+        label = "ai"
+    elif real_match:
+        label = "real"
+    else:
+        # Default to real if unclear
+        label = "real"
+    
+    # Extract confidence (look for percentage)
+    confidence_match = re.search(r'(\d+)%', response_text)
+    if confidence_match:
+        confidence = int(confidence_match.group(1)) / 100.0
+    else:
+        # Default confidence based on response clarity
+        confidence = 0.7 if label == "ai" else 0.6
+    
+    return label, confidence, response_text
+
+
+def _upstream_failed(error):
+    """Breaker outcome of an upstream exception: only outages count, a 4xx means the API is up."""
+    return not isinstance(error, HuggingFaceError) or error.upstream_fault
+
+
+def classify_image_bytes(image_bytes, api_key, deadline=None):
+    """
+    Classify an image that is already in memory (downloaded or uploaded).
+    
+    Returns:
+        dict: label/confidence result, or an error dict
+    
+    Raises:
+        DeadlineExceeded: if the request deadline passed
     """
     try:
-        # Download image
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status()
-        
-        # Convert to base64 for API
-        image_data = base64.b64encode(response.content).decode('utf-8')
+        client = get_client(api_key)
+        # Decode and downsize outside the breaker: a bad image says nothing about the upstream
+        inputs = client.prepare(image_bytes, PROMPT)
+        with stage(deadline, 'upstream'):
+            result = get_breaker('huggingface').call(
+                client.post, {"inputs": inputs}, deadline, hedge=HEDGE_REQUESTS, is_failure=_upstream_failed)
+        label, confidence, raw = parse_hf_response(result)
         
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
+        return {
+            "label": label,
+            "confidence": confidence,
+            "source": "huggingface",
+            "raw_response": raw
         }
-        
-        # Use a simpler approach with a basic vision model
-        model_name = "google/vit-base-patch16-224"
-        
-        # Create a prompt for AI detection
-        prompt = "Analyze this image and determine if it was generated by AI or is a real photograph. Look for signs like: 1) Unrealistic details or artifacts 2) Perfect symmetry or patterns 3) Inconsistent lighting or shadows 4) Unusual textures or surfaces. Respond with only 'AI' or 'REAL' followed by a confidence percentage (0-100)."
-        
-        payload = {
-            "inputs": {
-                "image": f"data:image/jpeg;base64,{image_data}",
-                "text": prompt
-            }
-        }
-        
-        api_response = requests.post(
-            f"{HF_API_URL}{model_name}",
-            json=payload,
-            headers=headers
-        )
-        
-        if api_response.status_code == 200:
-            result = api_response.json()
-            
-            # Parse the response to extract AI/REAL and confidence
-            response_text = result.get('generated_text', '')
-            
-            # Extract AI/REAL label
-            ai_match = re.search(r'\bAI\b', response_text, re.IGNORECASE)
-            real_match = re.search(r'\bREAL\b', response_text, re.IGNORECASE)
-            
-            if ai_match:
-                label = "ai"
-            elif real_match:
-                label = "real"
-            else:
-                # Default to real if unclear
-                label = "real"
-            
-            # Extract confidence (look for percentage)
-            confidence_match = re.search(r'(\d+)%', response_text)
-            if confidence_match:
-                confidence = int(confidence_match.group(1)) / 100.0
-            else:
-                # Default confidence based on response clarity
-                confidence = 0.7 if label == "ai" else 0.6
-            
-            return {
-                "label": label,
-                "confidence": confidence,
-                "source": "huggingface",
-                "raw_response": response_text
-            }
-        else:
-            return {"error": f"API error: {api_response.status_code}", "details": api_response.text}
-            
+    
+    except DeadlineExceeded:
+        raise
+    except ImageRejected as e:
+        return {"error": str(e), "rejected": e.reason}
+    except CircuitOpenError as e:
+        return {"error": str(e), "circuit": "open"}
+    except HuggingFaceError as e:
+        return {"error": str(e), "details": e.details}
+    except Exception as e:
+        return {"error": str(e)}
+
+def detect_ai_with_huggingface(image_url, api_key, deadline=None):
+    """
+    Use Hugging Face's API to classify images
+    We'll use a vision-language model and prompt it for AI detection
+    """
+    try:
+        # Download image (header-probed)
+        image_bytes, _ = fetch_image_bytes(image_url, timeout=10, deadline=deadline)
+    except ImageRejected as e:
+        return {"error": str(e), "rejected": e.reason}
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return {"error": str(e)}
+    
+    return classify_image_bytes(image_bytes, api_key, deadline)
+
+def _upstream_batch(client, inputs, deadline=None):
+    responses = client.post_batch(inputs, deadline)
+    # Only a batch where every image failed upstream counts against the breaker
+    faults = [r for r in responses if isinstance(r, HuggingFaceError) and r.upstream_fault]
+    if len(faults) == len(responses):
+        raise faults[0]
+    return responses
+
+def classify_images_batch(images, api_key, deadline=None):
+    """
+    Classify several in-memory images, batching upstream calls where the client allows.
+    
+    Returns:
+        list: One result dict per image, in input order
+    
+    Raises:
+        DeadlineExceeded: if the request deadline passed
+    """
+    if not images:
+        return []
+    
+    client = get_client(api_key)
+    # Decode and downsize outside the breaker, as in classify_image_bytes
+    responses = client.prepare_batch(images, PROMPT)
+    sent = [i for i, item in enumerate(responses) if not isinstance(item, ImageRejected)]
+    if sent:
+        try:
+            with stage(deadline, 'upstream'):
+                upstream = get_breaker('huggingface').call(
+                    _upstream_batch, client, [responses[i] for i in sent], deadline, is_failure=_upstream_failed)
+        except (CircuitOpenError, HuggingFaceError) as e:
+            upstream = [e] * len(sent)
+        for i, response in zip(sent, upstream):
+            responses[i] = response
+    
+    results = []
+    for response in responses:
+        if isinstance(response, CircuitOpenError):
+            results.append({"error": str(response), "circuit": "open"})
+            continue
+        if isinstance(response, ImageRejected):
+            results.append({"error": str(response), "rejected": response.reason})
+            continue
+        if isinstance(response, HuggingFaceError):
+            results.append({"error": str(response), "details": response.details})
+            continue
+        label, confidence, raw = parse_hf_response(response)
+        results.append({
+            "label": label,
+            "confidence": confidence,
+            "source": "huggingface",
+            "raw_response": raw
+        })
+    return results
+
+def detect_ai_batch_with_huggingface(image_urls, api_key, deadline=None):
+    """
+    Download and classify several images.
+    
+    Returns:
+        list: One result dict per URL, in input order
+    """
+    results = [None] * len(image_urls)
+    images, indices = [], []
+    
+    for i, url in enumerate(image_urls):
+        try:
+            image_bytes, _ = fetch_image_bytes(url, timeout=10, deadline=deadline)
+            images.append(image_bytes)
+            indices.append(i)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            results[i] = {"url": url, "error": str(e)}
+    
+    for i, result in zip(indices, classify_images_batch(images, api_key, deadline)):
+        results[i] = dict(result, url=image_urls[i])
+    
+    return results
 
 @app.route('/classify', methods=['POST'])
+@admission.limit
 def classify_image():
-    """Flask endpoint for image classification"""
+    """
+    Flask endpoint for image classification
+    
+    Accepts a JSON body with imageUrl, or the image bytes themselves (see
+    image_probe.images_from_request) so the server does not refetch an image
+    the client already has.
+    """
     try:
-        data = request.get_json()
-        image_url = data.get('imageUrl')
         api_key = os.getenv('HF_API_KEY')
+        if not api_key:
+            return jsonify({"error": "HF_API_KEY environment variable required"}), 500
         
-        if not image_url:
-            return jsonify({"error": "imageUrl required"}), 400
+        uploads = images_from_request(request)
+        if uploads is not None:
+            if len(uploads) != 1:
+                return jsonify({"error": "exactly one image required"}), 400
+            result = classify_image_bytes(uploads[0][0], api_key, g.deadline)
+        else:
+            data = request.get_json()
+            image_url = data.get('imageUrl')
+            
+            if not image_url:
+                return jsonify({"error": "imageUrl required"}), 400
             
+            result = detect_ai_with_huggingface(image_url, api_key, g.deadline)
+        
+        if result.get('rejected'):
+            return jsonify(result), 400
+        # Surface upstream failures as 502 so the extension falls back cleanly
+        if result.get('error'):
+            return jsonify(result), 502
+        return jsonify(result)
+        
+    except ImageRejected as e:
+        return jsonify({"error": str(e), "rejected": e.reason}), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/classify/batch', methods=['POST'])
+@admission.limit
+def classify_batch():
+    """Flask endpoint for several images, as uploads or a JSON list of imageUrls"""
+    try:
+        api_key = os.getenv('HF_API_KEY')
         if not api_key:
             return jsonify({"error": "HF_API_KEY environment variable required"}), 500
+        
+        uploads = images_from_request(request)
+        if uploads is not None:
+            images = [image_bytes for image_bytes, _ in uploads]
+            return jsonify({"results": classify_images_batch(images, api_key, g.deadline)})
+        
+        data = request.get_json()
+        image_urls = data.get('imageUrls')
+        
+        if not image_urls or not isinstance(image_urls, list):
+            return jsonify({"error": "imageUrls must be a non-empty list"}), 400
+        
+        if len(image_urls) > MAX_UPLOAD_IMAGES:
+            return jsonify({"error": f"at most {MAX_UPLOAD_IMAGES} imageUrls per batch"}), 400
             
-        result = detect_ai_with_huggingface(image_url, api_key)
-        return jsonify(result)
+        return jsonify({"results": detect_ai_batch_with_huggingface(image_urls, api_key, g.deadline)})
         
+    except ImageRejected as e:
+        return jsonify({"error": str(e), "rejected": e.reason}), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -120,7 +308,10 @@ def health_check():
     return jsonify({
         "status": "healthy", 
         "api_key_configured": bool(api_key),
-        "api_key_length": len(api_key) if api_key else 0
+        "api_key_length": len(api_key) if api_key else 0,
+        "circuit_breakers": breaker_states(),
+        "admission": admission.snapshot(),
+        "deadlines": deadline_stats()
     })
 
 if __name__ == '__main__':
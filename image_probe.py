@@ -0,0 +1,623 @@
+#!/usr/bin/env python3
+"""
+Header-only image probing
+Streams just enough of an image response to read its format, dimensions and
+frame count, rejects oversize or unsupported images before the body is
+downloaded, and decodes only the first frame of animations.
+"""
+
+import io
+import struct
+
+import requests
+from PIL import Image
+
+from deadline import bounded_timeout, stage
+
+# Limits applied before and while downloading. Override per call by passing a
+# dict with any subset of these keys.
+DEFAULT_LIMITS = {
+    "max_bytes": 20 * 1024 * 1024,      # compressed size
+    "max_pixels": 40_000_000,           # decompression bomb guard
+    "max_dimension": 16384,
+    "max_frames": 1000,                 # animation frames / TIFF pages
+    "allowed_formats": ["JPEG", "PNG", "GIF", "WEBP", "BMP", "TIFF"],
+    "probe_bytes": 16 * 1024,           # first read, enough for most headers
+    "max_header_bytes": 256 * 1024,     # give up if the header is still incomplete
+}
+
+CHUNK_SIZE = 16 * 1024
+
+
+class ImageRejected(ValueError):
+    """Raised when an image fails a probe limit; reason is a short machine-readable code."""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def _limits(limits):
+    merged = dict(DEFAULT_LIMITS)
+    if limits:
+        merged.update(limits)
+    return merged
+
+# ============================================================================
+# 1. HEADER PARSERS
+# ============================================================================
+#
+# Each parser takes the bytes read so far and returns (width, height, frames)
+# or None when it needs more data. frames is None when the header says the
+# image is animated but does not record how many frames it has.
+
+def _parse_png(data, complete):
+    if len(data) < 24:
+        return None
+    width, height = struct.unpack('>II', data[16:24])
+
+    # Animated PNGs declare acTL before the first IDAT chunk
+    offset = 8
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if chunk_type == b'acTL':
+            if offset + 12 > len(data):
+                return None
+            return width, height, struct.unpack('>I', data[offset + 8:offset + 12])[0]
+        if chunk_type == b'IDAT':
+            return width, height, 1
+        offset += 12 + length
+
+    return (width, height, 1) if complete else None
+
+
+def _parse_gif(data, complete):
+    if len(data) < 13:
+        return None
+    width, height, packed = struct.unpack('<HHB', data[6:11])
+    offset = 13
+    if packed & 0x80:
+        offset += 3 * (2 ** ((packed & 0x07) + 1))
+
+    # The looping extension (NETSCAPE2.0) comes before the first image
+    # descriptor; GIF headers never store a frame count.
+    while offset < len(data):
+        block = data[offset]
+        if block == 0x2C or block == 0x3B:
+            return width, height, 1
+        if block != 0x21 or offset + 2 > len(data):
+            return None if not complete else (width, height, 1)
+
+        label = data[offset + 1]
+        offset += 2
+        if label == 0xFF and data[offset + 1:offset + 12] in (b'NETSCAPE2.0', b'ANIMEXTS1.0'):
+            return width, height, None
+
+        # Skip the extension's data sub-blocks
+        while offset < len(data) and data[offset] != 0:
+            offset += data[offset] + 1
+        offset += 1
+
+    return (width, height, 1) if complete else None
+
+
+def _parse_jpeg(data, complete):
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            offset += 1
+            continue
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        # SOF0..SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height, 1
+        offset += 2 + length
+
+    return None
+
+
+def _parse_webp(data, complete):
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b'VP8X':
+        animated = bool(data[20] & 0x02)
+        width = 1 + int.from_bytes(data[24:27], 'little')
+        height = 1 + int.from_bytes(data[27:30], 'little')
+        return width, height, None if animated else 1
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF, 1
+    if chunk == b'VP8L':
+        bits = int.from_bytes(data[21:25], 'little')
+        return 1 + (bits & 0x3FFF), 1 + ((bits >> 14) & 0x3FFF), 1
+    return None
+
+
+def _parse_bmp(data, complete):
+    if len(data) < 26:
+        return None
+    width, height = struct.unpack('<ii', data[18:26])
+    return abs(width), abs(height), 1
+
+
+def _parse_tiff(data, complete):
+    if len(data) < 8:
+        return None
+    order = '<' if data[:2] == b'II' else '>'
+    offset = struct.unpack(order + 'I', data[4:8])[0]
+    if offset + 2 > len(data):
+        return None
+    count = struct.unpack(order + 'H', data[offset:offset + 2])[0]
+    end = offset + 2 + 12 * count
+    if end + 4 > len(data):
+        return None
+
+    width = height = 0
+    for entry in range(offset + 2, end, 12):
+        tag, kind = struct.unpack(order + 'HH', data[entry:entry + 4])
+        if tag in (256, 257):
+            # SHORT or LONG, stored in the value field
+            value = struct.unpack(order + ('H' if kind == 3 else 'I'), data[entry + 8:entry + 8 + (2 if kind == 3 else 4)])[0]
+            if tag == 256:
+                width = value
+            else:
+                height = value
+
+    # A further IFD means a multi-page file; counting pages means following
+    # the chain through the whole file
+    next_ifd = struct.unpack(order + 'I', data[end:end + 4])[0]
+    return width, height, 1 if next_ifd == 0 else None
+
+
+def _detect_format(data):
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if data.startswith(b'\xff\xd8'):
+        return 'JPEG'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    if data.startswith(b'BM'):
+        return 'BMP'
+    if data[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'TIFF'
+    return None
+
+
+_PARSERS = {
+    'PNG': _parse_png,
+    'GIF': _parse_gif,
+    'JPEG': _parse_jpeg,
+    'WEBP': _parse_webp,
+    'BMP': _parse_bmp,
+    'TIFF': _parse_tiff,
+}
+
+
+def sniff_image_header(data, complete=False):
+    """
+    Read format, dimensions and frame count from the start of an image.
+
+    Args:
+        data (bytes): Leading bytes of the image
+        complete (bool): True when data is the whole file, so a missing
+            optional header field means "not present" rather than "not read yet"
+
+    Returns:
+        dict: format, width, height, frames (None if animated with unknown
+        count) and animated, or None if more bytes are needed
+    """
+    fmt = _detect_format(data[:16])
+    if fmt is None:
+        if len(data) < 16 and not complete:
+            return None
+        return {"format": None, "width": 0, "height": 0, "frames": 1, "animated": False}
+
+    parser = _PARSERS.get(fmt)
+    if parser is None:
+        return {"format": fmt, "width": 0, "height": 0, "frames": 1, "animated": False}
+
+    try:
+        parsed = parser(data, complete)
+    except (struct.error, IndexError):
+        parsed = None
+    if parsed is None:
+        return None
+
+    width, height, frames = parsed
+    return {
+        "format": fmt,
+        "width": width,
+        "height": height,
+        "frames": frames,
+        "animated": frames != 1
+    }
+
+
+def _count_gif_frames(data, stop):
+    packed = data[10]
+    offset = 13
+    if packed & 0x80:
+        offset += 3 * (2 ** ((packed & 0x07) + 1))
+
+    frames = 0
+    while offset < len(data) and frames <= stop:
+        block = data[offset]
+        if block == 0x2C:
+            frames += 1
+            packed = data[offset + 9]
+            offset += 10
+            if packed & 0x80:
+                offset += 3 * (2 ** ((packed & 0x07) + 1))
+            offset += 1  # LZW minimum code size
+        elif block == 0x21:
+            offset += 2
+        else:
+            break
+        # Skip the data sub-blocks
+        while offset < len(data) and data[offset] != 0:
+            offset += data[offset] + 1
+        offset += 1
+    return frames
+
+
+def _count_webp_frames(data, stop):
+    frames = 0
+    offset = 12
+    while offset + 8 <= len(data) and frames <= stop:
+        chunk, size = struct.unpack('<4sI', data[offset:offset + 8])
+        if chunk == b'ANMF':
+            frames += 1
+        offset += 8 + size + (size & 1)
+    return frames
+
+
+def _count_tiff_pages(data, stop):
+    order = '<' if data[:2] == b'II' else '>'
+    offset = struct.unpack(order + 'I', data[4:8])[0]
+    seen = set()
+    while offset and offset not in seen and offset + 2 <= len(data) and len(seen) <= stop:
+        seen.add(offset)
+        count = struct.unpack(order + 'H', data[offset:offset + 2])[0]
+        end = offset + 2 + 12 * count
+        if end + 4 > len(data):
+            break
+        offset = struct.unpack(order + 'I', data[end:end + 4])[0]
+    return len(seen)
+
+
+_FRAME_COUNTERS = {
+    'GIF': _count_gif_frames,
+    'WEBP': _count_webp_frames,
+    'TIFF': _count_tiff_pages,
+}
+
+
+def count_frames(data, fmt, stop=None):
+    """
+    Count the frames (or TIFF pages) of a complete image by walking its
+    block structure; no pixel data is decoded.
+
+    Args:
+        data (bytes): The whole image
+        fmt (str): Format from sniff_image_header
+        stop (int): Stop counting once the count exceeds this
+
+    Returns:
+        int: Frame count (a lower bound when stopped early or truncated)
+    """
+    counter = _FRAME_COUNTERS.get(fmt)
+    if counter is None:
+        return 1
+    try:
+        return counter(data, float('inf') if stop is None else stop)
+    except (struct.error, IndexError):
+        return 1
+
+
+def check_limits(info, limits=None):
+    """
+    Reject an image whose header breaks a limit.
+
+    Raises:
+        ImageRejected: format not allowed, a dimension too large, too many
+            pixels, or more frames than max_frames (when the header has a count)
+    """
+    limits = _limits(limits)
+
+    if info["format"] not in limits["allowed_formats"]:
+        raise ImageRejected("unsupported_format", f"Unsupported image format: {info['format'] or 'unknown'}")
+    if max(info["width"], info["height"]) > limits["max_dimension"]:
+        raise ImageRejected("too_large", f"Image dimension exceeds {limits['max_dimension']}px: {info['width']}x{info['height']}")
+    if info["width"] * info["height"] > limits["max_pixels"]:
+        raise ImageRejected("too_many_pixels", f"Image exceeds {limits['max_pixels']:,} pixels: {info['width']}x{info['height']}")
+    if info["frames"] is not None and info["frames"] > limits["max_frames"]:
+        raise ImageRejected("too_many_frames", f"Image has {info['frames']:,} frames, limit is {limits['max_frames']:,}")
+
+# ============================================================================
+# 2. STREAMING FETCH
+# ============================================================================
+
+def _read_header(chunks, limits):
+    """Read from a chunk iterator until the header parses; returns (buffer, info, chunks, exhausted)."""
+    chunks = iter(chunks)
+    buffer = bytearray()
+    exhausted = False
+
+    while True:
+        try:
+            buffer.extend(next(chunks))
+        except StopIteration:
+            exhausted = True
+
+        if len(buffer) >= limits["probe_bytes"] or exhausted:
+            info = sniff_image_header(bytes(buffer), complete=exhausted)
+            if info is not None:
+                return buffer, info, chunks, exhausted
+            # TIFF writers often put the first IFD after the pixel data
+            budget = limits["max_bytes"] if buffer[:4] in (b'II*\x00', b'MM\x00*') else limits["max_header_bytes"]
+            if exhausted or len(buffer) >= budget:
+                raise ImageRejected("unreadable_header", "Could not read image header")
+
+
+def _read_image(chunks, limits):
+    """Read a whole image from a chunk iterator, checking limits as soon as the header arrives."""
+    buffer, info, chunks, exhausted = _read_header(chunks, limits)
+    check_limits(info, limits)
+
+    if not exhausted:
+        for chunk in chunks:
+            buffer.extend(chunk)
+            if len(buffer) > limits["max_bytes"]:
+                raise ImageRejected("too_large", f"Image exceeds {limits['max_bytes']:,} bytes")
+
+    # Animated WebP and multi-page TIFF headers carry no count, and a GIF
+    # without a looping extension can still hold any number of frames
+    if info["frames"] is None or info["format"] == 'GIF':
+        info["frames"] = count_frames(buffer, info["format"], stop=limits["max_frames"])
+        info["animated"] = info["frames"] != 1
+        check_limits(info, limits)
+    return bytes(buffer), info
+
+
+def _open_stream(image_url, limits, timeout):
+    try:
+        response = requests.get(image_url, stream=True, timeout=timeout)
+    except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema,
+            requests.exceptions.InvalidURL) as e:
+        raise ImageRejected("invalid_url", f"Invalid image URL: {image_url!r}") from e
+    response.raise_for_status()
+
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit() and int(content_length) > limits["max_bytes"]:
+        response.close()
+        raise ImageRejected("too_large", f"Image is {int(content_length):,} bytes, limit is {limits['max_bytes']:,}")
+    return response
+
+
+def probe_image_url(image_url, limits=None, timeout=10):
+    """
+    Read only the header of a remote image.
+
+    Args:
+        image_url (str): URL of the image
+        limits (dict): Overrides for DEFAULT_LIMITS
+        timeout (float): Connect/read timeout in seconds
+
+    Returns:
+        dict: Header info (see sniff_image_header), after limits were checked
+
+    Raises:
+        ImageRejected: if the image breaks a limit
+    """
+    limits = _limits(limits)
+    response = _open_stream(image_url, limits, timeout)
+    try:
+        _, info, _, _ = _read_header(response.iter_content(chunk_size=CHUNK_SIZE), limits)
+        check_limits(info, limits)
+        return info
+    finally:
+        response.close()
+
+
+def _chunks_until(response, deadline):
+    """
+    Yield the body as it arrives, stopping as soon as the deadline passes.
+
+    iter_content blocks until a whole chunk has arrived, which a server
+    trickling bytes can stretch far past the deadline; read1 returns
+    whatever is available, so the deadline is checked between socket reads.
+    """
+    read1 = getattr(response.raw, 'read1', None)
+    if read1 is None:
+        # urllib3 < 2 has no read1: check between whole chunks instead
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            deadline.check('fetch')
+            yield chunk
+        return
+
+    while True:
+        deadline.check('fetch')
+        chunk = read1(CHUNK_SIZE, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+
+def fetch_image_bytes(image_url, limits=None, timeout=10, deadline=None):
+    """
+    Download an image, checking limits as soon as the header arrives.
+
+    The body is only read past the header when the image passes, and the
+    download is aborted once it grows past max_bytes (servers do not always
+    send Content-Length).
+
+    Args:
+        image_url (str): URL of the image
+        limits (dict): Overrides for DEFAULT_LIMITS
+        timeout (float): Connect/read timeout in seconds
+        deadline (Deadline): Request deadline; shortens the timeout and
+            aborts the download between chunks once it passes
+
+    Returns:
+        tuple: (image bytes, header info)
+
+    Raises:
+        ImageRejected: if the image breaks a limit
+        DeadlineExceeded: if the deadline passed
+    """
+    limits = _limits(limits)
+    with stage(deadline, 'fetch'):
+        response = _open_stream(image_url, limits, bounded_timeout(deadline, timeout, 'fetch'))
+        try:
+            if deadline is not None:
+                chunks = _chunks_until(response, deadline)
+            else:
+                chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+            return _read_image(chunks, limits)
+        finally:
+            response.close()
+
+# ============================================================================
+# 3. DECODING
+# ============================================================================
+
+def decode_first_frame(image_bytes, limits=None, deadline=None):
+    """
+    Decode an image to RGB, first frame only for animations.
+
+    The pixel cap is checked against the decoder's own view of the size
+    before any pixel data is decoded, in case the header we sniffed lied.
+
+    Args:
+        image_bytes (bytes): Encoded image
+        limits (dict): Overrides for DEFAULT_LIMITS
+        deadline (Deadline): Request deadline; decoding is skipped once it passed
+
+    Returns:
+        PIL.Image.Image: RGB image
+
+    Raises:
+        ImageRejected: if the image exceeds the pixel cap
+        DeadlineExceeded: if the deadline passed
+    """
+    limits = _limits(limits)
+    with stage(deadline, 'decode'):
+        image = Image.open(io.BytesIO(image_bytes))
+
+        width, height = image.size
+        if width * height > limits["max_pixels"]:
+            raise ImageRejected("too_many_pixels", f"Image exceeds {limits['max_pixels']:,} pixels: {width}x{height}")
+
+        # Image.open leaves animations on frame 0 and convert() decodes only the
+        # current frame, so later frames are never touched
+        return image.convert('RGB')
+
+# ============================================================================
+# 4. UPLOADED IMAGES
+# ============================================================================
+#
+# Clients that already hold the image (the browser extension, bulk scorers)
+# can send the bytes instead of a URL, which skips the server-side refetch:
+#   - multipart/form-data with one or more "image" file fields
+#   - a raw body with Content-Type image/* or application/octet-stream
+#   - application/x-image-batch: repeated [4-byte big-endian length][image bytes]
+# Every image goes through the same header checks as a download.
+
+BATCH_CONTENT_TYPE = 'application/x-image-batch'
+MAX_UPLOAD_IMAGES = 32
+
+
+class _LimitedStream:
+    """Read at most `remaining` bytes from an underlying stream."""
+
+    def __init__(self, stream, remaining):
+        self.stream = stream
+        self.remaining = remaining
+
+    def read(self, size):
+        if self.remaining <= 0:
+            return b''
+        data = self.stream.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+
+def read_image_stream(stream, limits=None):
+    """
+    Read an uploaded image from a file-like stream.
+
+    Bytes are consumed chunk by chunk, so a bad header or an oversize body is
+    rejected without buffering the rest of the upload.
+
+    Returns:
+        tuple: (image bytes, header info)
+
+    Raises:
+        ImageRejected: if the image breaks a limit
+    """
+    limits = _limits(limits)
+    return _read_image(iter(lambda: stream.read(CHUNK_SIZE), b''), limits)
+
+
+def _read_batch_stream(stream, limits):
+    images = []
+    while True:
+        prefix = stream.read(4)
+        if not prefix:
+            return images
+        if len(prefix) < 4:
+            raise ImageRejected("malformed_batch", "Truncated length prefix in image batch")
+        if len(images) >= MAX_UPLOAD_IMAGES:
+            raise ImageRejected("too_many_images", f"At most {MAX_UPLOAD_IMAGES} images per batch")
+
+        length = struct.unpack('>I', prefix)[0]
+        if length > limits["max_bytes"]:
+            raise ImageRejected("too_large", f"Image is {length:,} bytes, limit is {limits['max_bytes']:,}")
+        image_bytes, info = read_image_stream(_LimitedStream(stream, length), limits)
+        if len(image_bytes) != length:
+            raise ImageRejected("malformed_batch", "Image batch ended before the declared length")
+        images.append((image_bytes, info))
+
+
+def images_from_request(req, limits=None):
+    """
+    Extract uploaded images from a Flask request.
+
+    Args:
+        req (flask.Request): Incoming request
+        limits (dict): Overrides for DEFAULT_LIMITS
+
+    Returns:
+        list: (image bytes, header info) per uploaded image, or None when the
+        request carries no image upload (e.g. a JSON body with imageUrl)
+
+    Raises:
+        ImageRejected: if an image breaks a limit or the batch is malformed
+    """
+    limits = _limits(limits)
+    mimetype = req.mimetype or ''
+
+    if mimetype == 'multipart/form-data':
+        files = req.files.getlist('image')
+        if len(files) > MAX_UPLOAD_IMAGES:
+            raise ImageRejected("too_many_images", f"At most {MAX_UPLOAD_IMAGES} images per batch")
+        return [read_image_stream(f.stream, limits) for f in files]
+    if mimetype == BATCH_CONTENT_TYPE:
+        return _read_batch_stream(req.stream, limits)
+    if mimetype.startswith('image/') or mimetype == 'application/octet-stream':
+        return [read_image_stream(req.stream, limits)]
+    return None
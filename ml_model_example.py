@@ -6,39 +6,61 @@ This example shows how to build a real classifier that could be deployed as an A
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers, models
-import cv2
-from PIL import Image
-import requests
-from io import BytesIO
-import json
-from flask import Flask, request, jsonify
+import functools
+import threading
+from flask import Flask, g, request, jsonify
+
+from image_features import extract_statistical_features
+from cpu_pool import PreprocessPool
+from model_serving import apply_thread_config, available_cores, load_thread_config
+from admission import AdmissionController
+from response_codec import install_codec
+from deadline import DeadlineExceeded, deadline_stats, stage
+from training_checkpoint import AsyncCheckpointer, fit_resumable
+from augmentation import DEFAULT_AUGMENTATION, augmented
+from sampling import BalancedSampler
+from model_registry import HotModel, file_version, serve_from_registry
+from image_probe import fetch_image_bytes, decode_first_frame, images_from_request, ImageRejected
 
 # ============================================================================
 # 1. DATA PREPARATION & FEATURE EXTRACTION
 # ============================================================================
 
-def download_and_preprocess_image(image_url, target_size=(224, 224)):
+# Upper bound on crops per image in patch-based inference, keeps latency bounded
+MAX_PATCHES = 16
+
+def download_image(image_url, deadline=None):
+    """
+    Download image from URL and decode it at native resolution.
+    
+    The header is probed first, so oversize, unsupported or decompression
+    bomb images are rejected before the body is downloaded. Animations are
+    decoded to their first frame only.
+    
+    Args:
+        image_url (str): URL of the image
+        deadline (Deadline): Request deadline bounding download and decode
+    
+    Returns:
+        PIL.Image.Image: RGB image
+    """
+    image_bytes, _ = fetch_image_bytes(image_url, timeout=10, deadline=deadline)
+    return decode_first_frame(image_bytes, deadline=deadline)
+
+def download_and_preprocess_image(image_url, target_size=(224, 224), deadline=None):
     """
     Download image from URL and preprocess for model input.
     
     Args:
         image_url (str): URL of the image
         target_size (tuple): Target size (width, height)
+        deadline (Deadline): Request deadline; DeadlineExceeded propagates
     
     Returns:
         np.array: Preprocessed image array
     """
     try:
-        # Download image
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status()
-        
-        # Load image
-        image = Image.open(BytesIO(response.content))
-        
-        # Convert to RGB if needed
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        image = download_image(image_url, deadline)
         
         # Resize
         image = image.resize(target_size)
@@ -48,67 +70,107 @@ def download_and_preprocess_image(image_url, target_size=(224, 224)):
         
         return image_array
     
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"Error processing image {image_url}: {e}")
         return None
 
-def extract_statistical_features(image):
+def compute_patch_grid(width, height, patch_size=(224, 224), max_patches=MAX_PATCHES):
     """
-    Extract statistical features that help distinguish AI vs real images.
+    Decide how many crops to take along each axis of an image.
+    
+    One crop per patch-sized tile, so large images get more crops. When the
+    grid exceeds max_patches the axis with the most crops is thinned first,
+    which keeps the crops spread over the whole image.
     
     Args:
-        image (np.array): Image array (H, W, C)
+        width (int): Image width in pixels
+        height (int): Image height in pixels
+        patch_size (tuple): Crop size (width, height)
+        max_patches (int): Maximum number of crops
     
     Returns:
-        dict: Statistical features
+        tuple: (n_cols, n_rows)
     """
-    # Convert to grayscale for some analyses
-    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    patch_w, patch_h = patch_size
+    n_cols = max(1, int(np.ceil(width / patch_w)))
+    n_rows = max(1, int(np.ceil(height / patch_h)))
     
-    features = {}
+    while n_cols * n_rows > max(1, max_patches):
+        if n_cols >= n_rows:
+            n_cols -= 1
+        else:
+            n_rows -= 1
     
-    # 1. Basic statistics
-    features['mean_intensity'] = np.mean(gray)
-    features['std_intensity'] = np.std(gray)
-    features['skewness'] = np.mean(((gray - np.mean(gray)) / np.std(gray)) ** 3)
-    features['kurtosis'] = np.mean(((gray - np.mean(gray)) / np.std(gray)) ** 4)
+    return n_cols, n_rows
+
+def _patch_offsets(length, patch_length, count):
+    """Evenly spaced crop offsets along one axis (centered for a single crop)."""
+    if count == 1:
+        return [(length - patch_length) // 2]
+    return np.linspace(0, length - patch_length, count).astype(int).tolist()
+
+def extract_image_patches(image, patch_size=(224, 224), max_patches=MAX_PATCHES):
+    """
+    Tile an image into native-resolution crops for patch-based inference.
     
-    # 2. Edge density (AI images often have different edge patterns)
-    edges = cv2.Canny(gray, 50, 150)
-    features['edge_density'] = np.sum(edges > 0) / (edges.shape[0] * edges.shape[1])
+    Unlike download_and_preprocess_image, nothing is squashed: each crop keeps
+    the original pixels, so high-frequency generator artifacts survive and
+    panoramas are not distorted. Images smaller than one patch are upscaled
+    (aspect ratio preserved) so that every crop is full size.
     
-    # 3. Local binary pattern (texture analysis)
-    features['lbp_variance'] = extract_lbp_features(gray)
+    Args:
+        image (PIL.Image.Image): RGB image
+        patch_size (tuple): Crop size (width, height)
+        max_patches (int): Maximum number of crops
     
-    # 4. Color distribution
-    for i, color in enumerate(['red', 'green', 'blue']):
-        channel = image[:, :, i]
-        features[f'{color}_mean'] = np.mean(channel)
-        features[f'{color}_std'] = np.std(channel)
+    Returns:
+        np.array: Patches of shape (N, height, width, 3) in [0, 1]
+    """
+    patch_w, patch_h = patch_size
+    width, height = image.size
+    
+    scale = max(patch_w / width, patch_h / height)
+    if scale > 1.0:
+        width = max(patch_w, int(round(width * scale)))
+        height = max(patch_h, int(round(height * scale)))
+        image = image.resize((width, height))
+    
+    n_cols, n_rows = compute_patch_grid(width, height, patch_size, max_patches)
+    xs = _patch_offsets(width, patch_w, n_cols)
+    ys = _patch_offsets(height, patch_h, n_rows)
+    
+    # Crop on uint8 pixels and only normalize the crops, not the full image
+    pixels = np.asarray(image)
+    patches = np.stack([
+        pixels[y:y + patch_h, x:x + patch_w]
+        for y in ys
+        for x in xs
+    ])
     
-    return features
+    return patches.astype(np.float32) / 255.0
 
-def extract_lbp_features(gray_image, radius=3, n_points=8):
+def aggregate_patch_scores(predictions, method='mean'):
     """
-    Extract Local Binary Pattern features for texture analysis.
+    Combine per-patch model outputs into one AI probability.
+    
+    Args:
+        predictions (np.array): Softmax outputs of shape (N, 2)
+        method (str): 'mean' for a smooth average, 'max' to flag an image
+            when any single patch looks generated
+    
+    Returns:
+        float: Aggregated AI probability
     """
-    # Simplified LBP implementation
-    height, width = gray_image.shape
-    lbp_image = np.zeros((height, width), dtype=np.uint8)
+    ai_scores = np.asarray(predictions)[:, 1]
     
-    for i in range(radius, height - radius):
-        for j in range(radius, width - radius):
-            center = gray_image[i, j]
-            binary = 0
-            for k in range(n_points):
-                angle = 2 * np.pi * k / n_points
-                x = int(i + radius * np.cos(angle))
-                y = int(j + radius * np.sin(angle))
-                if gray_image[x, y] >= center:
-                    binary |= (1 << k)
-            lbp_image[i, j] = binary
+    if method == 'mean':
+        return float(np.mean(ai_scores))
+    if method == 'max':
+        return float(np.max(ai_scores))
     
-    return np.var(lbp_image)
+    raise ValueError(f"Unknown patch aggregation method: {method}")
 
 # ============================================================================
 # 2. DEEP LEARNING MODEL ARCHITECTURE
@@ -202,45 +264,71 @@ def create_ensemble_model():
 # 3. TRAINING PIPELINE
 # ============================================================================
 
-def create_data_generator(real_image_urls, ai_image_urls, batch_size=32):
+def create_data_generator(real_image_urls, ai_image_urls, batch_size=32, seed=None, start=0):
     """
     Create a data generator for training.
     
+    Every batch is half real, half AI. Each class is read in a new seeded
+    shuffle per pass (see sampling.py), so the batch order depends only on
+    seed and a resumed run can continue the same sequence: start jumps that
+    many batches ahead without downloading them.
+    
     Args:
         real_image_urls (list): URLs of real images
         ai_image_urls (list): URLs of AI-generated images
         batch_size (int): Batch size for training
+        seed (int): Seed for the batch order (random if None)
+        start (int): Number of batches to skip
     
     Yields:
         tuple: (images, labels)
     """
+    sources = (real_image_urls, ai_image_urls)  # label 0: real, 1: AI
+    sampler = BalancedSampler([len(urls) for urls in sources], batch_size, seed=seed)
+    batches = sampler.batches(start)
+    
     while True:
         # Sample batch
         batch_images = []
         batch_labels = []
         
-        for _ in range(batch_size):
-            # Randomly choose real or AI image
-            if np.random.random() < 0.5:
-                url = np.random.choice(real_image_urls)
-                label = 0  # Real
-            else:
-                url = np.random.choice(ai_image_urls)
-                label = 1  # AI
-            
+        labels, indices = next(batches)
+        for label, index in zip(labels, indices):
+            url = sources[label][index]
             # Download and preprocess
             image = download_and_preprocess_image(url)
             if image is not None:
                 batch_images.append(image)
                 batch_labels.append(label)
         
+        # A batch whose downloads all failed is skipped (and shifts resume by one)
         if len(batch_images) > 0:
             yield np.array(batch_images), np.array(batch_labels)
 
-def train_model(model, train_generator, validation_generator, epochs=50):
+def train_model(model, train_batches, validation_generator, epochs=50, checkpoint_dir='checkpoints', seed=None,
+                augmentation=None):
     """
     Train the model with callbacks and monitoring.
+    
+    Progress is checkpointed in the background to checkpoint_dir (see
+    training_checkpoint.py) and a rerun resumes from the latest checkpoint
+    with the same data order. The best model by val_accuracy is exported
+    to best_model.h5.
+    
+    Args:
+        model: Compiled model
+        train_batches (callable): (seed, start) -> training generator, e.g.
+            functools.partial(create_data_generator, real_urls, ai_urls, 32)
+        validation_generator: Validation batches
+        epochs (int): Total epochs
+        checkpoint_dir (str): Where checkpoints are kept
+        seed (int): Data order for a fresh run
+        augmentation (dict): Batched augmentation settings (see
+            augmentation.py); None disables augmentation
     """
+    if augmentation is not None:
+        train_batches = augmented(train_batches, augmentation)
+    
     callbacks = [
         tf.keras.callbacks.EarlyStopping(
             monitor='val_loss',
@@ -252,21 +340,21 @@ def train_model(model, train_generator, validation_generator, epochs=50):
             factor=0.5,
             patience=5,
             min_lr=1e-7
-        ),
-        tf.keras.callbacks.ModelCheckpoint(
-            'best_model.h5',
-            monitor='val_accuracy',
-            save_best_only=True
         )
     ]
     
-    history = model.fit(
-        train_generator,
-        validation_data=validation_generator,
+    history = fit_resumable(
+        model,
+        train_batches,
         epochs=epochs,
-        callbacks=callbacks,
         steps_per_epoch=100,
-        validation_steps=20
+        checkpointer=AsyncCheckpointer(checkpoint_dir),
+        seed=seed,
+        validation_data=validation_generator,
+        validation_steps=20,
+        callbacks=callbacks,
+        export_best='best_model.h5',
+        monitor='val_accuracy'
     )
     
     return history
@@ -280,59 +368,135 @@ class AIImageDetector:
     Main class for AI image detection.
     """
     
-    def __init__(self, model_path=None):
+    def __init__(self, model_path=None, cpu_pool=None, serving=None):
         """
         Initialize the detector.
         
         Args:
             model_path (str): Path to saved model weights
+            cpu_pool (PreprocessPool): Optional worker pool that decodes,
+                resizes and extracts features off the request thread
+            serving (HotModel): Serve a model registry's active version
+                instead (model_path is then ignored)
         """
-        self.model = create_cnn_model()
-        if model_path:
-            self.model.load_weights(model_path)
-    
-    def predict(self, image_url):
+        if serving is None:
+            model = create_cnn_model()
+            if model_path:
+                model.load_weights(model_path)
+            serving = HotModel.fixed(model, file_version(model_path) if model_path else 'untrained')
+        self.serving = serving
+        self.cpu_pool = cpu_pool
+        self._embedder = (None, None)
+    
+    @property
+    def model(self):
+        """The current model; predict() pins one version for a whole batch."""
+        return self.serving.model
+    
+    @model.setter
+    def model(self, model):
+        path = getattr(model, 'model_path', None)
+        self.serving = HotModel.fixed(model, file_version(path) if path else 'custom')
+    
+    @property
+    def model_version(self):
+        return self.serving.version
+    
+    def _embedding_model(self, served):
         """
-        Predict whether an image is AI-generated or real.
+        The served model with a second output: the input of its final
+        (softmax) layer, i.e. the 256-d image embedding. Built once per
+        served model; None for models without Keras layers (TFLite).
+        """
+        model = served.model
+        built_for, embedder = self._embedder
+        if built_for is not model:
+            embedder = None
+            if isinstance(model, tf.keras.Model):
+                embedder = tf.keras.Model(model.inputs, [model.outputs[0], model.layers[-1].input])
+            self._embedder = (model, embedder)
+        return embedder
+    
+    def _forward(self, served, batch, with_embedding=False):
+        """Model output for a batch, and the embeddings too when asked for and available."""
+        embedder = self._embedding_model(served) if with_embedding else None
+        if embedder is None:
+            return served.model.predict(batch, verbose=0), None
+        prediction, embeddings = embedder.predict(batch, verbose=0)
+        return prediction, embeddings
+    
+    def _prepare_input(self, image_url, multi_crop=False, max_patches=MAX_PATCHES, deadline=None):
+        """
+        Download (or decode uploaded bytes of) an image and build the model input for it.
         
         Args:
-            image_url (str): URL of the image to analyze
+            image_url (str or bytes): URL of the image, or its encoded bytes
+            deadline (Deadline): Request deadline; DeadlineExceeded propagates
         
         Returns:
-            dict: Prediction results
+            tuple: (model_input, image, features) where model_input is a batch
+            of one resized image, or of native-resolution patches when
+            multi_crop is set, image is the 224x224 view used for statistical
+            features, and features are those features if the CPU pool already
+            computed them (else None). (None, None, None) if the image could
+            not be loaded.
         """
-        # Download and preprocess image
-        image = download_and_preprocess_image(image_url)
-        if image is None:
-            return {
-                'error': 'Failed to download or process image',
-                'label': 'unknown',
-                'confidence': 0.0
-            }
+        if self.cpu_pool is not None and not multi_crop:
+            try:
+                image_bytes = image_url
+                if not isinstance(image_url, (bytes, bytearray)):
+                    image_bytes, _ = fetch_image_bytes(image_url, deadline=deadline)
+                with stage(deadline, 'preprocess'):
+                    image, features = self.cpu_pool.preprocess(image_bytes, with_features=True, deadline=deadline)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                print(f"Error processing image {image_url if isinstance(image_url, str) else '(upload)'}: {e}")
+                return None, None, None
+            return np.expand_dims(image, axis=0), image, features
         
-        # Extract statistical features
-        stats_features = extract_statistical_features(image)
-        
-        # Prepare input for model
-        image_input = np.expand_dims(image, axis=0)
-        stats_input = np.array([[
-            stats_features['mean_intensity'],
-            stats_features['std_intensity'],
-            stats_features['skewness'],
-            stats_features['kurtosis'],
-            stats_features['edge_density'],
-            stats_features['lbp_variance'],
-            stats_features['red_mean'],
-            stats_features['red_std'],
-            stats_features['green_mean'],
-            stats_features['green_std'],
-            stats_features['blue_mean'],
-            stats_features['blue_std']
-        ]])
+        if isinstance(image_url, (bytes, bytearray)):
+            try:
+                full_image = decode_first_frame(image_url, deadline=deadline)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                print(f"Error processing uploaded image: {e}")
+                return None, None, None
+        elif not multi_crop:
+            image = download_and_preprocess_image(image_url, deadline=deadline)
+            if image is None:
+                return None, None, None
+            return np.expand_dims(image, axis=0), image, None
+        else:
+            try:
+                full_image = download_image(image_url, deadline)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                print(f"Error processing image {image_url}: {e}")
+                return None, None, None
         
-        # Make prediction
-        prediction = self.model.predict(image_input)
-        ai_probability = prediction[0][1]  # Probability of being AI-generated
+        if not multi_crop:
+            image = np.array(full_image.resize((224, 224))) / 255.0
+            return np.expand_dims(image, axis=0), image, None
+        
+        patches = extract_image_patches(full_image, max_patches=max_patches)
+        image = np.array(full_image.resize((224, 224))) / 255.0
+        return patches, image, None
+    
+    def _build_result(self, prediction, image, multi_crop=False, aggregate='mean', features=None, deadline=None,
+                      embedding=None):
+        """Turn raw model output (one row per patch) into a result dict."""
+        # Extract statistical features (unless a pool worker already did)
+        if features is not None:
+            stats_features = features
+        else:
+            with stage(deadline, 'features'):
+                stats_features = extract_statistical_features(image)
+        
+        # Probability of being AI-generated (a single row aggregates to itself)
+        ai_probability = aggregate_patch_scores(prediction, aggregate)
         
         # Determine label and confidence
         if ai_probability > 0.5:
@@ -342,29 +506,167 @@ class AIImageDetector:
             label = 'real'
             confidence = 1 - ai_probability
         
-        return {
+        result = {
             'label': label,
             'confidence': float(confidence),
             'ai_probability': float(ai_probability),
             'features': stats_features
         }
+        if multi_crop:
+            result['patches'] = len(prediction)
+        if embedding is not None:
+            # Patches of one image average into a single embedding
+            result['embedding'] = embedding.mean(axis=0).astype(np.float32)
+        return result
+    
+    def predict(self, image_url, multi_crop=False, max_patches=MAX_PATCHES, aggregate='mean', deadline=None,
+                with_embedding=False):
+        """
+        Predict whether an image is AI-generated or real.
+        
+        Args:
+            image_url (str or bytes): URL of the image to analyze, or the
+                uploaded image bytes
+            multi_crop (bool): Score native-resolution patches instead of a
+                single 224x224 resize
+            max_patches (int): Cap on patches per image in multi-crop mode
+            aggregate (str): How patch scores are combined ('mean' or 'max')
+            deadline (Deadline): Request deadline checked between stages
+            with_embedding (bool): Add the image's 256-d CNN embedding to
+                the result as 'embedding' (skipped for TFLite models)
+        
+        Returns:
+            dict: Prediction results
+        
+        Raises:
+            DeadlineExceeded: if the deadline passed before the result was ready
+        """
+        image_input, image, features = self._prepare_input(image_url, multi_crop, max_patches, deadline)
+        if image_input is None:
+            return {
+                'error': 'Failed to download or process image',
+                'label': 'unknown',
+                'confidence': 0.0
+            }
+        
+        # All patches go through the model in one forward pass
+        with stage(deadline, 'predict'), self.serving.acquire() as served:
+            prediction, embedding = self._forward(served, image_input, with_embedding)
+        
+        result = self._build_result(prediction, image, multi_crop, aggregate, features, deadline, embedding)
+        result['model_version'] = served.version
+        return result
+    
+    def predict_batch(self, image_urls, multi_crop=False, max_patches=MAX_PATCHES, aggregate='mean', deadline=None,
+                      with_embedding=False):
+        """
+        Predict several images with a single forward pass.
+        
+        In multi-crop mode the patches of every image are concatenated into
+        one batch and split back per image afterwards.
+        
+        Args:
+            image_urls (list): URLs of the images to analyze, or uploaded
+                image bytes (results then carry no 'url')
+            multi_crop (bool): Score native-resolution patches
+            max_patches (int): Cap on patches per image in multi-crop mode
+            aggregate (str): How patch scores are combined ('mean' or 'max')
+            deadline (Deadline): Request deadline for the whole batch
+            with_embedding (bool): Add each image's CNN embedding as 'embedding'
+        
+        Returns:
+            list: One result dict per URL, in input order
+        
+        Raises:
+            DeadlineExceeded: if the deadline passed before the results were ready
+        """
+        results = [None] * len(image_urls)
+        inputs, images, features, indices = [], [], [], []
+        
+        for i, url in enumerate(image_urls):
+            image_input, image, image_features = self._prepare_input(url, multi_crop, max_patches, deadline)
+            if image_input is None:
+                results[i] = {
+                    'error': 'Failed to download or process image',
+                    'label': 'unknown',
+                    'confidence': 0.0
+                }
+                if isinstance(url, str):
+                    results[i]['url'] = url
+                continue
+            inputs.append(image_input)
+            images.append(image)
+            features.append(image_features)
+            indices.append(i)
+        
+        if inputs:
+            # One version for the whole batch, even if a new one is swapped in meanwhile
+            with stage(deadline, 'predict'), self.serving.acquire() as served:
+                predictions, embeddings = self._forward(served, np.concatenate(inputs), with_embedding)
+            splits = np.cumsum([len(x) for x in inputs])[:-1]
+            per_image = np.split(embeddings, splits) if embeddings is not None else [None] * len(inputs)
+            
+            for i, image, image_features, prediction, embedding in zip(indices, images, features,
+                                                                       np.split(predictions, splits), per_image):
+                result = self._build_result(prediction, image, multi_crop, aggregate, image_features, deadline,
+                                            embedding)
+                result['model_version'] = served.version
+                if isinstance(image_urls[i], str):
+                    result['url'] = image_urls[i]
+                results[i] = result
+        
+        return results
 
 # ============================================================================
 # 5. FLASK API SERVER
 # ============================================================================
 
-app = Flask(__name__)
-detector = AIImageDetector('best_model.h5')  # Load trained model
+app = install_codec(Flask(__name__))
+
+# CPU-bound: about one request per core, the rest wait or are shed
+admission = AdmissionController.from_env('custom_model', max_in_flight=available_cores())
+
+# The trained detector is built on first use rather than at import, so
+# modules that only need the helpers above (deploy_model, pre-forked
+# serving workers) do not each hold an extra copy of the CNN weights.
+_detector = None
+_detector_lock = threading.Lock()
+
+def get_detector():
+    """
+    Return the server's AIImageDetector, loading the model on first call:
+    the model registry's active version (hot-swapped when it changes, see
+    model_registry.py) if there is a registry, else best_model.h5.
+    """
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            serving = serve_from_registry()
+            if serving is not None:
+                _detector = AIImageDetector(serving=serving)
+            else:
+                _detector = AIImageDetector('best_model.h5')  # Load trained model
+        return _detector
+
+def __getattr__(name):
+    # Keeps `from ml_model_example import detector` working
+    if name == 'detector':
+        return get_detector()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 @app.route('/classify', methods=['POST'])
+@admission.limit
 def classify_image():
     """
     API endpoint for image classification.
     
     Expected request:
     {
-        "imageUrl": "https://example.com/image.jpg"
+        "imageUrl": "https://example.com/image.jpg",
+        "multiCrop": false
     }
+    or the image bytes themselves (multipart "image" field or a raw image/*
+    body, see image_probe.images_from_request), with ?multiCrop=1.
     
     Response:
     {
@@ -374,29 +676,99 @@ def classify_image():
     }
     """
     try:
-        data = request.get_json()
-        image_url = data.get('imageUrl')
+        uploads = images_from_request(request)
+        if uploads is not None:
+            if len(uploads) != 1:
+                return jsonify({'error': 'exactly one image is required'}), 400
+            image_source = uploads[0][0]
+            multi_crop = request.args.get('multiCrop') in ('1', 'true')
+        else:
+            data = request.get_json()
+            image_source = data.get('imageUrl')
+            multi_crop = bool(data.get('multiCrop'))
         
-        if not image_url:
+        if not image_source:
             return jsonify({'error': 'imageUrl is required'}), 400
         
         # Make prediction
-        result = detector.predict(image_url)
+        result = get_detector().predict(image_source, multi_crop=multi_crop, deadline=g.deadline)
         
         if 'error' in result:
             return jsonify(result), 400
         
         return jsonify(result)
     
+    except ImageRejected as e:
+        return jsonify({'error': str(e), 'rejected': e.reason}), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Keep a single batch request bounded in memory and latency
+MAX_BATCH_SIZE = 32
+
+@app.route('/classify/batch', methods=['POST'])
+@admission.limit
+def classify_batch():
+    """
+    API endpoint for classifying several images in one forward pass.
+    
+    Expected request:
+    {
+        "imageUrls": ["https://example.com/a.jpg", "https://example.com/b.jpg"],
+        "multiCrop": true
+    }
+    or uploaded images (multipart "image" fields or an
+    application/x-image-batch body), with ?multiCrop=1.
+    
+    Response:
+    {
+        "results": [
+            {"url": "https://example.com/a.jpg", "label": "ai", "confidence": 0.87, ...},
+            {"url": "https://example.com/b.jpg", "error": "...", "label": "unknown", ...}
+        ]
+    }
+    """
+    try:
+        uploads = images_from_request(request)
+        if uploads is not None:
+            image_sources = [image_bytes for image_bytes, _ in uploads]
+            multi_crop = request.args.get('multiCrop') in ('1', 'true')
+        else:
+            data = request.get_json()
+            image_sources = data.get('imageUrls')
+            multi_crop = bool(data.get('multiCrop'))
+        
+        if not image_sources or not isinstance(image_sources, list):
+            return jsonify({'error': 'imageUrls must be a non-empty list'}), 400
+        
+        if len(image_sources) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'at most {MAX_BATCH_SIZE} imageUrls per batch'}), 400
+        
+        results = get_detector().predict_batch(image_sources, multi_crop=multi_crop, deadline=g.deadline)
+        
+        return jsonify({'results': results})
+    
+    except ImageRejected as e:
+        return jsonify({'error': str(e), 'rejected': e.reason}), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
-    return jsonify({'status': 'healthy'})
+    return jsonify({'status': 'healthy',
+                    'model': _detector.serving.stats() if _detector is not None else None,
+                    'admission': admission.snapshot(), 'deadlines': deadline_stats()})
 
 if __name__ == '__main__':
+    # Thread pools must be sized before the detector starts TensorFlow
+    apply_thread_config(load_thread_config())
+    # CPU_POOL_WORKERS > 0 moves decode/preprocessing into worker processes
+    get_detector().cpu_pool = PreprocessPool.from_env()
     app.run(host='0.0.0.0', port=5000, debug=True)
 
 # ============================================================================
@@ -442,11 +814,12 @@ def example_training():
         # ... more AI image URLs
     ]
     
-    # Create data generators
-    train_generator = create_data_generator(
+    # Create data generators (training batches resume where a checkpoint left off)
+    train_batches = functools.partial(
+        create_data_generator,
         real_image_urls[:800], 
         ai_image_urls[:800], 
-        batch_size=32
+        32
     )
     
     validation_generator = create_data_generator(
@@ -457,7 +830,7 @@ def example_training():
     
     # Create and train model
     model = create_cnn_model()
-    history = train_model(model, train_generator, validation_generator)
+    history = train_model(model, train_batches, validation_generator, augmentation=DEFAULT_AUGMENTATION)
     
     # Save model
     model.save_weights('best_model.h5')
@@ -484,7 +857,7 @@ def create_extension_compatible_api():
                 return jsonify({'error': 'imageUrl is required'}), 400
             
             # Make prediction
-            result = detector.predict(image_url)
+            result = get_detector().predict(image_url)
             
             if 'error' in result:
                 return jsonify({'error': result['error']}), 400
@@ -507,7 +880,7 @@ def optimize_for_production():
     Production optimizations for the model.
     """
     # 1. Model quantization
-    converter = tf.lite.TFLiteConverter.from_keras_model(detector.model)
+    converter = tf.lite.TFLiteConverter.from_keras_model(get_detector().model)
     converter.optimizations = [tf.lite.Optimize.DEFAULT]
     tflite_model = converter.convert()
     
@@ -530,7 +903,7 @@ def optimize_for_production():
             
             if batch_images:
                 batch_input = np.array(batch_images)
-                batch_predictions = detector.model.predict(batch_input)
+                batch_predictions = get_detector().model.predict(batch_input)
                 
                 for j, pred in enumerate(batch_predictions):
                     ai_prob = pred[1]
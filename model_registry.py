@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Local model registry with hot-swap reloading
+A registry is a directory of model versions plus a manifest naming the
+active one:
+
+    models/
+      manifest.json        {"active": "v2", "versions": {"v1": {...}, "v2": {...}}}
+      v1/best_model.h5
+      v2/best_model.h5
+
+Publishing or activating a version only rewrites manifest.json (atomically).
+Servers holding a HotModel notice the change, load and warm the new
+version on a background thread while the old one keeps serving, and then
+swap it in. Each request or batch pins the version it started with
+(HotModel.acquire), so a swap only happens between batches, and the old
+model is dropped once its last request finishes. Results carry
+"model_version", so anything cached from them can be keyed by it.
+
+    python model_registry.py publish best_model.h5 --note "retrained on v3 data"
+    python model_registry.py activate v1     # roll back
+    python model_registry.py list
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from model_serving import TFLiteModel, export_tflite
+
+MANIFEST_NAME = 'manifest.json'
+
+# ============================================================================
+# 1. REGISTRY
+# ============================================================================
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_version(path):
+    """Version name for a model served straight from a file: name plus content hash."""
+    return f"{os.path.basename(path)}@{file_sha256(path)[:12]}"
+
+
+class ModelRegistry:
+    """A versioned directory of model files with a manifest."""
+
+    def __init__(self, root='models'):
+        self.root = root
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+
+    @classmethod
+    def from_env(cls):
+        """The registry at MODEL_REGISTRY (default models/), or None if it has no manifest."""
+        registry = cls(os.getenv('MODEL_REGISTRY', 'models'))
+        return registry if os.path.exists(registry.manifest_path) else None
+
+    def manifest(self):
+        """The manifest, or an empty one for a new registry."""
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"active": None, "versions": {}}
+
+    def _write_manifest(self, manifest):
+        # Write then rename, so a reader never sees a half-written manifest
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def active(self):
+        """(version, absolute model path) of the active version, or (None, None)."""
+        manifest = self.manifest()
+        version = manifest.get("active")
+        if version is None:
+            return None, None
+        return version, os.path.join(self.root, manifest["versions"][version]["file"])
+
+    def publish(self, model_path, version=None, note=None, metrics=None, activate=True):
+        """
+        Copy a model file into the registry as a new version.
+
+        Args:
+            model_path (str): Keras (.h5/.keras) or .tflite file
+            version (str): Version name (default: v<N+1>)
+            note (str): Free-form description
+            metrics (dict): E.g. evaluate.py's report["metrics"]
+            activate (bool): Make it the active version
+
+        Returns:
+            str: The version name
+
+        Raises:
+            ValueError: if the version already exists
+        """
+        os.makedirs(self.root, exist_ok=True)
+        manifest = self.manifest()
+        version = version or f"v{len(manifest['versions']) + 1}"
+        if version in manifest["versions"]:
+            raise ValueError(f"Version {version} already exists in {self.root}")
+
+        directory = os.path.join(self.root, version)
+        os.makedirs(directory)
+        target = os.path.join(directory, os.path.basename(model_path))
+        shutil.copy2(model_path, target)
+
+        manifest["versions"][version] = {
+            "file": os.path.relpath(target, self.root),
+            "sha256": file_sha256(target),
+            "published_at": time.time(),
+            "note": note,
+            "metrics": metrics,
+        }
+        if activate:
+            manifest["active"] = version
+        self._write_manifest(manifest)
+        return version
+
+    def activate(self, version):
+        """Make an existing version active (also how to roll back)."""
+        manifest = self.manifest()
+        if version not in manifest["versions"]:
+            raise ValueError(f"Unknown version {version}; have {', '.join(manifest['versions']) or 'none'}")
+        manifest["active"] = version
+        self._write_manifest(manifest)
+
+# ============================================================================
+# 2. LOADING
+# ============================================================================
+
+def load_model_file(path, backend=None, threads=None):
+    """
+    Load and warm a model file for serving.
+
+    Args:
+        path (str): Keras model or weights (.h5/.keras), or a .tflite file
+        backend (str): 'tflite' to serve a Keras file through TFLite (it is
+            converted once, next to the original); default SERVING_BACKEND
+        threads (int): TFLite interpreter threads
+
+    Returns:
+        Model with a Keras-style predict(batch)
+    """
+    backend = backend or os.getenv('SERVING_BACKEND', 'keras')
+    if backend == 'tflite' and not path.endswith('.tflite'):
+        path = export_tflite(path, os.path.splitext(path)[0] + '.tflite')
+
+    if path.endswith('.tflite'):
+        model = TFLiteModel(path, num_threads=threads or 1,
+                            use_xnnpack=os.getenv('TFLITE_XNNPACK', '0') == '1')
+        model.warmup()
+        return model
+
+    import tensorflow as tf
+    try:
+        model = tf.keras.models.load_model(path)
+    except ValueError:
+        # A weights-only file (save_weights), as example_training writes
+        from ml_model_example import create_cnn_model
+        model = create_cnn_model()
+        model.load_weights(path)
+    # The first predict builds the graph; pay for it before taking traffic
+    model.predict(np.zeros((1,) + tuple(model.input_shape[1:]), dtype=np.float32), verbose=0)
+    return model
+
+# ============================================================================
+# 3. HOT SWAP
+# ============================================================================
+
+class ModelHandle:
+    """One loaded version and the number of requests using it."""
+
+    __slots__ = ('version', 'model', 'loaded_at', 'in_use', 'retired')
+
+    def __init__(self, version, model):
+        self.version = version
+        self.model = model
+        self.loaded_at = time.time()
+        self.in_use = 0
+        self.retired = False
+
+
+class HotModel:
+    """
+    The model a server predicts with, swapped for the registry's active
+    version without a restart.
+
+    A daemon thread checks the manifest every poll_interval seconds (one
+    stat() while nothing changes). A new active version is loaded and warmed
+    on that thread; only then does acquire() start handing it out. Requests
+    already holding the old version finish with it, and the old model is
+    released when the last of them does.
+    """
+
+    def __init__(self, registry=None, loader=load_model_file, poll_interval=5.0):
+        """
+        Args:
+            registry (ModelRegistry): Where versions come from (None for a
+                fixed model, see HotModel.fixed)
+            loader (callable): path -> warmed model
+            poll_interval (float): Seconds between manifest checks
+        """
+        self.registry = registry
+        self.loader = loader
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._current = None
+        self._draining = []
+        self._manifest_mtime = None
+        self._reloading = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counters = {"swaps": 0, "failed_loads": 0}
+        self.last_error = None
+
+    @classmethod
+    def fixed(cls, model, version):
+        """A HotModel that always serves `model` (no registry)."""
+        hot = cls()
+        hot._current = ModelHandle(version, model)
+        return hot
+
+    def start(self):
+        """Load the active version now, then watch for changes; returns self."""
+        if not self.check():
+            raise RuntimeError(f"No loadable active model in {self.registry.root}: {self.last_error}")
+        self._thread = threading.Thread(target=self._watch, name='model-reload', daemon=True)
+        self._thread.start()
+        return self
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                mtime = os.stat(self.registry.manifest_path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime != self._manifest_mtime:
+                self.check()
+
+    def check(self):
+        """
+        Load and swap in the active version if it is not the current one.
+
+        Returns:
+            bool: Whether a model is being served afterwards
+        """
+        with self._reloading:
+            try:
+                self._manifest_mtime = os.stat(self.registry.manifest_path).st_mtime_ns
+                version, path = self.registry.active()
+            except (OSError, ValueError, KeyError) as e:
+                self.last_error = f"Unreadable manifest: {e}"
+                return self._current is not None
+            if version is None or (self._current is not None and version == self._current.version):
+                return self._current is not None
+
+            started = time.perf_counter()
+            try:
+                model = self.loader(path)
+            except Exception as e:
+                # Keep serving the old version; the next manifest change retries
+                self.counters["failed_loads"] += 1
+                self.last_error = f"Loading {version} failed: {e}"
+                print(f"[models] {self.last_error}", flush=True)
+                return self._current is not None
+            self._swap(ModelHandle(version, model))
+            print(f"[models] Serving {version} (loaded and warmed in "
+                  f"{time.perf_counter() - started:.1f}s)", flush=True)
+            return True
+
+    def _swap(self, handle):
+        with self._lock:
+            old, self._current = self._current, handle
+            if old is not None:
+                self.counters["swaps"] += 1
+                old.retired = True
+                if old.in_use:
+                    self._draining.append(old)
+                else:
+                    old.model = None
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """Pin the current version for one request or batch; yields a ModelHandle."""
+        with self._lock:
+            handle = self._current
+            handle.in_use += 1
+        try:
+            yield handle
+        finally:
+            with self._lock:
+                handle.in_use -= 1
+                if handle.retired and not handle.in_use:
+                    # Last request on an old version: let its model go
+                    handle.model = None
+                    if handle in self._draining:
+                        self._draining.remove(handle)
+
+    @property
+    def model(self):
+        """The current model (use acquire() to keep it across a whole batch)."""
+        return self._current.model
+
+    @property
+    def version(self):
+        return self._current.version if self._current is not None else None
+
+    def stats(self):
+        """State for /health."""
+        with self._lock:
+            current = self._current
+            return dict(self.counters,
+                        version=current.version if current else None,
+                        loaded_at=current.loaded_at if current else None,
+                        in_use=current.in_use if current else 0,
+                        draining=[{"version": h.version, "in_use": h.in_use} for h in self._draining],
+                        registry=self.registry.root if self.registry else None,
+                        last_error=self.last_error)
+
+    def close(self):
+        self._stop.set()
+
+
+def serve_from_registry(registry=None, **loader_options):
+    """
+    Start a HotModel on a registry (default: ModelRegistry.from_env()).
+
+    Returns:
+        HotModel or None: None when there is no registry
+    """
+    registry = registry or ModelRegistry.from_env()
+    if registry is None:
+        return None
+    loader = lambda path: load_model_file(path, **loader_options)
+    return HotModel(registry, loader, float(os.getenv('MODEL_POLL_INTERVAL', '5'))).start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the local model registry")
+    parser.add_argument('--root', default=os.getenv('MODEL_REGISTRY', 'models'), help="Registry directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+    publish = commands.add_parser('publish', help="Add a model file as a new version")
+    publish.add_argument('model', help="Keras (.h5/.keras) or .tflite file")
+    publish.add_argument('--version', help="Version name (default: v<N+1>)")
+    publish.add_argument('--note')
+    publish.add_argument('--metrics', help="evaluate.py report whose metrics to record")
+    publish.add_argument('--no-activate', action='store_true', help="Publish without serving it yet")
+    activate = commands.add_parser('activate', help="Serve an existing version (or roll back to it)")
+    activate.add_argument('version')
+    commands.add_parser('list', help="Show the versions")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.root)
+    if args.command == 'publish':
+        metrics = None
+        if args.metrics:
+            with open(args.metrics) as f:
+                metrics = json.load(f).get("metrics")
+        version = registry.publish(args.model, args.version, args.note, metrics, activate=not args.no_activate)
+        print(f"Published {args.model} as {version}" + ("" if args.no_activate else " (active)"))
+    elif args.command == 'activate':
+        registry.activate(args.version)
+        print(f"Activated {args.version}")
+    else:
+        manifest = registry.manifest()
+        for version, info in manifest["versions"].items():
+            marker = '*' if version == manifest["active"] else ' '
+            published = time.strftime('%Y-%m-%d %H:%M', time.localtime(info["published_at"]))
+            accuracy = (info.get("metrics") or {}).get("accuracy")
+            print(f"{marker} {version:<8} {published}  {info['file']:<32} "
+                  f"{'' if accuracy is None else f'acc {accuracy}  '}{info.get('note') or ''}")
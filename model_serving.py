@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+Pre-fork model serving helpers
+The gunicorn master (see gunicorn.conf.py) converts the model to a TFLite
+flatbuffer once and pages it in before forking. Each worker then maps the
+same file read-only, so the weights live once in the page cache instead of
+once per worker, and gets a share of the cores for its op threads.
+
+The thread config (section 1) is shared by every server: TensorFlow's
+intra/inter-op pools, OpenCV's threads and optional per-worker CPU pinning.
+`python model_serving.py` sweeps those settings on the current host and
+writes the fastest combination as a config file (section 4).
+
+TensorFlow is only imported inside the functions that need it: the master
+must not start the TF runtime, whose thread pools do not survive fork().
+"""
+
+import argparse
+import contextlib
+import json
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, conversions are not serialized
+    fcntl = None
+
+# ============================================================================
+# 1. THREAD CONFIGURATION
+# ============================================================================
+
+# One config drives TensorFlow's pools, OpenCV and CPU pinning per worker.
+# None means "derive from the core count and the number of workers".
+DEFAULT_THREAD_CONFIG = {
+    "workers": 1,
+    "intra_op": None,
+    "inter_op": 1,
+    "opencv": None,
+    "pin": False,
+}
+
+def available_cpus():
+    """CPU ids this process may run on (respects taskset/cgroup affinity)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def available_cores():
+    """Number of cores this process may run on."""
+    return len(available_cpus())
+
+def thread_budget(workers, cores=None):
+    """
+    Split the cores between serving workers.
+
+    Args:
+        workers (int): Number of worker processes
+        cores (int): Cores to share (defaults to available_cores())
+
+    Returns:
+        tuple: (intra_op, inter_op) threads per worker
+    """
+    cores = cores or available_cores()
+    # A single request's graph is a straight chain of layers, so inter-op
+    # parallelism buys nothing and only adds threads competing for the cores
+    return max(1, cores // max(1, workers)), 1
+
+def load_thread_config(path=None):
+    """
+    Load the thread config from a JSON file, then apply environment overrides.
+
+    Args:
+        path (str): JSON file (defaults to the SERVING_THREADS_CONFIG env var);
+            benchmark_thread_configs writes one in this format
+
+    Returns:
+        dict: DEFAULT_THREAD_CONFIG with the file's and environment's values
+    """
+    config = dict(DEFAULT_THREAD_CONFIG)
+
+    path = path or os.getenv('SERVING_THREADS_CONFIG')
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+
+    overrides = {
+        'workers': 'WEB_CONCURRENCY',
+        'intra_op': 'TF_INTRA_OP_THREADS',
+        'inter_op': 'TF_INTER_OP_THREADS',
+        'opencv': 'CV_THREADS',
+    }
+    for key, env in overrides.items():
+        if os.getenv(env):
+            config[key] = int(os.getenv(env))
+    if os.getenv('CPU_PIN'):
+        config['pin'] = os.getenv('CPU_PIN') == '1'
+    return config
+
+def resolve_thread_config(config, cores=None):
+    """Fill the derived (None) entries of a thread config for this host."""
+    config = dict(DEFAULT_THREAD_CONFIG, **config)
+    intra_op, inter_op = thread_budget(config['workers'], cores)
+    if config['intra_op'] is None:
+        config['intra_op'] = intra_op
+    if config['inter_op'] is None:
+        config['inter_op'] = inter_op
+    if config['opencv'] is None:
+        config['opencv'] = config['intra_op'] or intra_op
+    return config
+
+def worker_cpus(slot, workers, cpus=None):
+    """The slice of CPUs that worker number `slot` is pinned to."""
+    cpus = cpus or available_cpus()
+    per_worker = max(1, len(cpus) // max(1, workers))
+    start = (slot * per_worker) % len(cpus)
+    return cpus[start:start + per_worker]
+
+def threads_from_env():
+    """(intra_op, inter_op) from TF_INTRA_OP_THREADS / TF_INTER_OP_THREADS, or None if unset."""
+    intra = os.getenv('TF_INTRA_OP_THREADS')
+    if not intra:
+        return None
+    return int(intra), int(os.getenv('TF_INTER_OP_THREADS', '1'))
+
+def configure_tf_threads(intra_op, inter_op):
+    """Set TensorFlow's thread pools; must run before the runtime is first used."""
+    import tensorflow as tf
+
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+    except RuntimeError as e:
+        # The runtime already started (e.g. a model was built at import)
+        print(f"WARNING: TensorFlow thread pools not changed: {e}")
+
+def apply_thread_config(config, slot=None):
+    """
+    Apply a thread config to the current process.
+
+    Pins the process to its CPU slice (when config['pin'] and a worker slot
+    are given), sets TensorFlow's and OpenCV's thread counts and exports them
+    as TF_INTRA_OP_THREADS / TF_INTER_OP_THREADS / CV_THREADS /
+    OMP_NUM_THREADS for code that reads them later (deploy_model's
+    TFLite interpreter). Must run before TensorFlow executes anything.
+
+    Args:
+        config (dict): Thread config (see DEFAULT_THREAD_CONFIG)
+        slot (int): This worker's index, used for pinning
+
+    Returns:
+        dict: The resolved config, plus the pinned 'cpus' if any
+    """
+    config = resolve_thread_config(config)
+
+    if config['pin'] and slot is not None and hasattr(os, 'sched_setaffinity'):
+        cpus = worker_cpus(slot, config['workers'])
+        os.sched_setaffinity(0, cpus)
+        config['cpus'] = cpus
+
+    os.environ['TF_INTRA_OP_THREADS'] = str(config['intra_op'])
+    os.environ['TF_INTER_OP_THREADS'] = str(config['inter_op'])
+    os.environ['CV_THREADS'] = str(config['opencv'])
+    if config['intra_op']:
+        # Eigen/OpenMP kernels outside TF's own pools follow the same budget
+        os.environ['OMP_NUM_THREADS'] = str(config['intra_op'])
+
+    configure_tf_threads(config['intra_op'], config['inter_op'])
+    import cv2
+    cv2.setNumThreads(config['opencv'])
+    return config
+
+# ============================================================================
+# 2. TFLITE EXPORT (MASTER)
+# ============================================================================
+
+def _convert(keras_path, tflite_path):
+    import tensorflow as tf
+    from ml_model_example import create_cnn_model
+
+    if keras_path and os.path.exists(keras_path):
+        model = tf.keras.models.load_model(keras_path)
+    else:
+        print("WARNING: no trained model, exporting an untrained CNN")
+        model = create_cnn_model()
+
+    tflite_model = tf.lite.TFLiteConverter.from_keras_model(model).convert()
+
+    # Write then rename, so workers still mapping an older file keep valid pages;
+    # the temp name is per process so a concurrent writer cannot truncate it
+    tmp_path = f"{tflite_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(tflite_model)
+    os.replace(tmp_path, tflite_path)
+
+def _tflite_fresh(keras_path, tflite_path):
+    return os.path.exists(tflite_path) and (
+        not keras_path or not os.path.exists(keras_path)
+        or os.path.getmtime(tflite_path) >= os.path.getmtime(keras_path))
+
+@contextlib.contextmanager
+def _export_lock(tflite_path):
+    """Exclusive lock on <tflite_path>.lock, held across processes."""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{tflite_path}.lock", 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _export_in_child(keras_path, tflite_path):
+    process = multiprocessing.get_context('spawn').Process(target=_convert, args=(keras_path, tflite_path))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"TFLite export of {keras_path} failed (exit code {process.exitcode})")
+
+def export_tflite(keras_path, tflite_path):
+    """
+    Convert a Keras model file to a TFLite flatbuffer, unless tflite_path is
+    already newer than keras_path.
+
+    The conversion runs in a spawned child process so the caller (the
+    gunicorn master) never initializes TensorFlow. Workers that swap to a
+    registry version all call this at once; a file lock makes one of them
+    convert while the others wait and then find the file fresh.
+
+    Returns:
+        str: tflite_path
+    """
+    if _tflite_fresh(keras_path, tflite_path):
+        return tflite_path
+
+    with _export_lock(tflite_path):
+        if not _tflite_fresh(keras_path, tflite_path):
+            _export_in_child(keras_path, tflite_path)
+    return tflite_path
+
+def page_in(path):
+    """
+    Map a file read-only and fault its pages into the page cache.
+
+    Returns:
+        mmap.mmap: The mapping; keep a reference for as long as it should stay warm
+    """
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapping, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+        mapping.madvise(mmap.MADV_WILLNEED)
+    # Touch one byte per page so the read happens now, not on the first request
+    for offset in range(0, len(mapping), mmap.PAGESIZE):
+        mapping[offset]
+    return mapping
+
+# ============================================================================
+# 3. TFLITE MODEL (WORKER)
+# ============================================================================
+
+class TFLiteModel:
+    """
+    TFLite interpreter with the Keras `predict` interface used by the servers.
+
+    Built from model_path, so the flatbuffer is mmap'd rather than copied and
+    its weight pages are shared with every other worker mapping the same file.
+    The XNNPACK delegate is off by default because it repacks weights into
+    private memory, which undoes that sharing.
+    """
+
+    def __init__(self, model_path, num_threads=1, use_xnnpack=False):
+        """
+        Args:
+            model_path (str): Path to the .tflite file
+            num_threads (int): Kernel threads for this interpreter (0 for the runtime default)
+            use_xnnpack (bool): Faster kernels at the cost of a private weight copy
+        """
+        import tensorflow as tf
+
+        options = {}
+        if not use_xnnpack:
+            options['experimental_op_resolver_type'] = \
+                tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        self.model_path = model_path
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads or None, **options)
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        # One interpreter per worker; its tensors are not safe to share between threads
+        self._lock = threading.Lock()
+
+    @property
+    def input_shape(self):
+        return tuple(self._input['shape'])
+
+    def predict(self, inputs, verbose=0):
+        """
+        Run a batch through the interpreter.
+
+        Args:
+            inputs (np.array): Batch shaped like the model input
+
+        Returns:
+            np.array: Model output, one row per input
+        """
+        inputs = np.asarray(inputs, dtype=self._input['dtype'])
+        with self._lock:
+            if inputs.shape[0] != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input['index'], inputs.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = inputs.shape[0]
+            self.interpreter.set_tensor(self._input['index'], inputs)
+            self.interpreter.invoke()
+            return np.array(self.interpreter.get_tensor(self._output['index']))
+
+    def warmup(self):
+        """Allocate tensors and run one zero batch so the first request is not slow."""
+        self.predict(np.zeros((1,) + self.input_shape[1:], dtype=self._input['dtype']))
+
+# ============================================================================
+# 4. THREAD CONFIG BENCHMARK
+# ============================================================================
+
+def candidate_thread_configs(cores=None, pin_options=None):
+    """
+    Thread configs worth comparing on this host.
+
+    Worker counts are powers of two up to the core count; each is tried
+    with the full per-worker budget, half of it, and TensorFlow's default
+    (intra_op 0, i.e. one thread per core in every worker) as a baseline.
+    """
+    cores = cores or available_cores()
+    if pin_options is None:
+        pin_options = [False, True] if hasattr(os, 'sched_setaffinity') and cores > 1 else [False]
+
+    candidates = []
+    workers = 1
+    while workers <= cores:
+        budget = max(1, cores // workers)
+        for intra_op in sorted({budget, max(1, budget // 2), 0}):
+            for pin in pin_options:
+                candidates.append({
+                    "workers": workers,
+                    "intra_op": intra_op,
+                    "inter_op": 1 if intra_op else 0,
+                    "opencv": intra_op or budget,
+                    "pin": pin,
+                })
+        workers *= 2
+    return candidates
+
+def _benchmark_worker(config, slot, model_path, batch_size, duration, barrier, results):
+    apply_thread_config(config, slot)
+
+    from image_features import extract_statistical_features
+    import cv2
+
+    if model_path and model_path.endswith('.tflite'):
+        model = TFLiteModel(model_path, num_threads=config['intra_op'])
+    else:
+        import tensorflow as tf
+        from ml_model_example import create_cnn_model
+        model = tf.keras.models.load_model(model_path) if model_path else create_cnn_model()
+
+    rng = np.random.default_rng(slot)
+    source = rng.integers(0, 256, size=(768, 1024, 3), dtype=np.uint8)
+
+    def step():
+        # Same CPU work as a request: resize, features, forward pass
+        batch = []
+        for _ in range(batch_size):
+            image = cv2.resize(source, (224, 224), interpolation=cv2.INTER_AREA) / 255.0
+            extract_statistical_features(image)
+            batch.append(image)
+        model.predict(np.array(batch, dtype=np.float32), verbose=0)
+
+    step()  # warm up outside the timed window
+    barrier.wait()
+
+    images = 0
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        step()
+        latencies.append(time.perf_counter() - start)
+        images += batch_size
+    results.put((images, latencies))
+
+def run_thread_benchmark(config, model_path=None, batch_size=1, duration=5.0):
+    """
+    Measure one thread config: `workers` processes run the request pipeline
+    flat out for `duration` seconds, all starting together.
+
+    Returns:
+        dict: The config plus images_per_second and p95_ms
+    """
+    context = multiprocessing.get_context('spawn')
+    config = resolve_thread_config(config)
+    barrier = context.Barrier(config['workers'])
+    results = context.Queue()
+
+    processes = [
+        context.Process(target=_benchmark_worker,
+                        args=(config, slot, model_path, batch_size, duration, barrier, results))
+        for slot in range(config['workers'])
+    ]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    images = sum(count for count, _ in outcomes)
+    latencies = [latency for _, worker_latencies in outcomes for latency in worker_latencies]
+    return dict(config,
+                images_per_second=round(images / duration, 2),
+                p95_ms=round(float(np.percentile(latencies, 95)) * 1000, 1) if latencies else None)
+
+def benchmark_thread_configs(candidates=None, model_path=None, batch_size=1, duration=5.0):
+    """
+    Run every candidate config and rank them by throughput.
+
+    Returns:
+        list: Result dicts, best first
+    """
+    results = []
+    for config in candidates or candidate_thread_configs():
+        result = run_thread_benchmark(config, model_path, batch_size, duration)
+        print(f"workers={result['workers']} intra_op={result['intra_op']} inter_op={result['inter_op']} "
+              f"opencv={result['opencv']} pin={result['pin']}: "
+              f"{result['images_per_second']} img/s, p95 {result['p95_ms']} ms")
+        results.append(result)
+    return sorted(results, key=lambda r: r['images_per_second'], reverse=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep serving thread settings on this host")
+    parser.add_argument('--model', help="Keras .h5 or .tflite model (defaults to an untrained CNN)")
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds per config")
+    parser.add_argument('--output', default='threads.json',
+                        help="Where to write the recommended config (use with SERVING_THREADS_CONFIG)")
+    args = parser.parse_args()
+
+    ranked = benchmark_thread_configs(model_path=args.model, batch_size=args.batch_size, duration=args.duration)
+    best = {key: ranked[0][key] for key in DEFAULT_THREAD_CONFIG}
+    with open(args.output, 'w') as f:
+        json.dump(best, f, indent=2)
+    print(f"\nRecommended: {json.dumps(best)} ({ranked[0]['images_per_second']} img/s), written to {args.output}")
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Perceptual-hash index for near-duplicate lookup
+Re-posted copies of an image (resized, lightly cropped, re-compressed)
+keep almost the same 64-bit perceptual hash, so a verdict reached for one
+copy can be reused for the others without running a model again.
+
+Hashes are pHash (DCT of a 32x32 grayscale thumbnail) or dHash (gradient
+signs of a 9x8 thumbnail). JPEGs are decoded at reduced scale straight to
+grayscale for this, so hashing costs a few milliseconds even for large
+photos.
+
+HashIndex answers Hamming-radius queries with multi-index hashing: each
+code is split into `tables` substrings, and any code within distance r of
+the query agrees with it to within r // tables bits on at least one
+substring. Each table is a bucketed sorted array, so a query reads a few
+hundred small buckets and checks the candidates' full distance, instead
+of scanning every entry.
+
+    index = HashIndex.load('near_duplicates.npz')
+    match = index.nearest(image_hash(image_bytes), max_distance=6, version='cnn:v3')
+
+    python phash_index.py --benchmark 1000000
+"""
+
+import argparse
+import io
+import itertools
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+DEFAULT_MAX_DISTANCE = 6
+
+# Verdicts are stored as small ints
+LABELS = ('real', 'ai')
+_LABEL_IDS = {label: i for i, label in enumerate(LABELS)}
+
+# ============================================================================
+# 1. HASHING
+# ============================================================================
+
+def grayscale_thumbnail(image_bytes, size):
+    """
+    Decode an image to a small float32 grayscale array (size or (width, height)).
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale (PIL draft mode), which
+    is all a perceptual hash needs; other formats are decoded fully.
+    """
+    size = size if isinstance(size, tuple) else (size, size)
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft('L', (size[0] * 4, size[1] * 4))
+        gray = image.convert('L').resize(size, Image.BILINEAR)
+        return np.asarray(gray, dtype=np.float32)
+
+
+def _pack_bits(bits):
+    return int(np.packbits(bits.ravel().astype(np.uint8)).view('>u8')[0])
+
+
+def phash(image_bytes):
+    """64-bit pHash: signs of the 8x8 lowest DCT frequencies relative to their median."""
+    dct = cv2.dct(grayscale_thumbnail(image_bytes, 32))[:8, :8]
+    # The DC term is the overall brightness; leave it out of the median
+    return _pack_bits(dct > np.median(dct.ravel()[1:]))
+
+
+def dhash(image_bytes):
+    """64-bit dHash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour."""
+    gray = grayscale_thumbnail(image_bytes, (9, 8))
+    return _pack_bits(gray[:, :-1] > gray[:, 1:])
+
+
+HASH_METHODS = {"phash": phash, "dhash": dhash}
+
+
+def image_hash(image_bytes, method='phash'):
+    return HASH_METHODS[method](image_bytes)
+
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(values):
+        """Set bits per element of a uint64 array."""
+        return np.bitwise_count(values)
+else:
+    def popcount(values):
+        """Set bits per element of a uint64 array."""
+        return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def hamming(a, b):
+    return bin(int(a) ^ int(b)).count('1')
+
+# ============================================================================
+# 2. MULTI-INDEX HASH TABLE
+# ============================================================================
+
+def _flip_masks(bits, radius):
+    """Every bits-wide mask with at most `radius` set bits."""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for positions in itertools.combinations(range(bits), r):
+            masks.append(sum(1 << p for p in positions))
+    return np.array(masks, dtype=np.int64)
+
+
+class HashIndex:
+    """
+    64-bit hashes with verdicts, searchable by Hamming distance.
+
+    Entries 0..n_sorted-1 are in the tables. Newer entries sit in an
+    unsorted tail that queries scan directly. Once the tail reaches
+    merge_every entries, a background thread builds new tables from a
+    snapshot and swaps them in, so lookups and adds never wait for a build.
+    """
+
+    def __init__(self, tables=4, merge_every=16384):
+        """
+        Args:
+            tables (int): Substrings per code (64 / tables bits each)
+            merge_every (int): Tail length that triggers a rebuild of the tables
+        """
+        if HASH_BITS % tables:
+            raise ValueError(f"tables must divide {HASH_BITS}")
+        self.tables = tables
+        self.sub_bits = HASH_BITS // tables
+        self.merge_every = merge_every
+        self._lock = threading.Lock()
+        self._size = 0
+        self._codes = np.zeros(1024, dtype=np.uint64)
+        self._labels = np.zeros(1024, dtype=np.int8)
+        self._confidence = np.zeros(1024, dtype=np.float32)
+        self._version_ids = np.zeros(1024, dtype=np.int32)
+        self.versions = []
+        self._version_lookup = {}
+        self._n_sorted = 0
+        self._orders = []
+        self._starts = []
+        self._masks = {}
+        self._merging = False
+
+    def __len__(self):
+        return self._size
+
+    def _version_id(self, version):
+        version_id = self._version_lookup.get(version)
+        if version_id is None:
+            version_id = self._version_lookup[version] = len(self.versions)
+            self.versions.append(version)
+        return version_id
+
+    def _reserve(self, size):
+        if size <= len(self._codes):
+            return
+        capacity = max(size, 2 * len(self._codes))
+        for name in ('_codes', '_labels', '_confidence', '_version_ids'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _substrings(self, codes, table):
+        shift = np.uint64(table * self.sub_bits)
+        return ((codes >> shift) & np.uint64((1 << self.sub_bits) - 1)).astype(np.int64)
+
+    def _build_tables(self, codes):
+        orders, starts = [], []
+        for table in range(self.tables):
+            keys = self._substrings(codes, table)
+            orders.append(np.argsort(keys, kind='stable').astype(np.int64))
+            counts = np.bincount(keys, minlength=1 << self.sub_bits)
+            starts.append(np.concatenate([[0], np.cumsum(counts)]))
+        return orders, starts
+
+    def _rebuild(self):
+        """Build the tables from every entry, in place (the caller holds the lock or owns the index)."""
+        self._orders, self._starts = self._build_tables(self._codes[:self._size])
+        self._n_sorted = self._size
+
+    def _merge(self):
+        """Background rebuild: entries 0..size-1 never change, so they are sorted without the lock."""
+        with self._lock:
+            codes, size = self._codes, self._size
+        try:
+            orders, starts = self._build_tables(codes[:size])
+            with self._lock:
+                if size > self._n_sorted:
+                    self._orders, self._starts, self._n_sorted = orders, starts, size
+        finally:
+            with self._lock:
+                self._merging = False
+
+    def add(self, codes, labels, confidences, version=None):
+        """
+        Add a batch of hashes with their verdicts.
+
+        Args:
+            codes (sequence of int): 64-bit hashes
+            labels (sequence of str): 'ai' or 'real' per hash (others are skipped)
+            confidences (sequence of float): Verdict confidence per hash
+            version (str): Model that produced the verdicts
+        """
+        keep = [i for i, label in enumerate(labels) if label in _LABEL_IDS]
+        if not keep:
+            return
+        with self._lock:
+            start, end = self._size, self._size + len(keep)
+            self._reserve(end)
+            self._codes[start:end] = np.array([int(codes[i]) for i in keep], dtype=np.uint64)
+            self._labels[start:end] = [_LABEL_IDS[labels[i]] for i in keep]
+            self._confidence[start:end] = [confidences[i] for i in keep]
+            self._version_ids[start:end] = self._version_id(version)
+            self._size = end
+            merge = self._size - self._n_sorted >= self.merge_every and not self._merging
+            if merge:
+                self._merging = True
+        if merge:
+            threading.Thread(target=self._merge, name='phash-merge', daemon=True).start()
+
+    def _candidates(self, code, max_distance):
+        radius = max_distance // self.tables
+        masks = self._masks.get(radius)
+        if masks is None:
+            masks = self._masks[radius] = _flip_masks(self.sub_bits, radius)
+        query = np.array([code], dtype=np.uint64)
+
+        found = [np.arange(self._n_sorted, self._size)]
+        for table in range(self.tables):
+            keys = self._substrings(query, table)[0] ^ masks
+            starts = self._starts[table]
+            lo, hi = starts[keys], starts[keys + 1]
+            counts = hi - lo
+            total = int(counts.sum())
+            if total:
+                # Concatenated bucket ranges, without a Python loop
+                offsets = np.repeat(lo - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+                found.append(self._orders[table][offsets + np.arange(total)])
+        return np.unique(np.concatenate(found))
+
+    def search(self, code, max_distance=DEFAULT_MAX_DISTANCE, version=None):
+        """
+        Entries within max_distance bits of a hash.
+
+        Args:
+            code (int): 64-bit query hash
+            max_distance (int): Hamming radius
+            version (str): Only entries added with this version
+
+        Returns:
+            tuple: (ids, distances) arrays, nearest first
+        """
+        with self._lock:
+            if version is not None and version not in self._version_lookup:
+                return np.zeros(0, np.int64), np.zeros(0, np.int64)
+            ids = self._candidates(int(code), max_distance) if self._n_sorted else np.arange(self._size)
+            distances = popcount(self._codes[ids] ^ np.uint64(int(code))).astype(np.int64)
+            keep = distances <= max_distance
+            if version is not None:
+                keep &= self._version_ids[ids] == self._version_lookup[version]
+            ids, distances = ids[keep], distances[keep]
+        order = np.argsort(distances, kind='stable')
+        return ids[order], distances[order]
+
+    def nearest(self, code, max_distance=DEFAULT_MAX_DISTANCE, version=None):
+        """
+        The closest prior verdict within max_distance bits, or None.
+
+        Returns:
+            dict: label, confidence, version, distance and similarity (1 - distance / 64)
+        """
+        ids, distances = self.search(code, max_distance, version)
+        if not len(ids):
+            return None
+        return dict(self.verdict(int(ids[0])), distance=int(distances[0]),
+                    similarity=round(1 - int(distances[0]) / HASH_BITS, 4))
+
+    def verdict(self, entry):
+        return {
+            "label": LABELS[self._labels[entry]],
+            "confidence": float(self._confidence[entry]),
+            "version": self.versions[self._version_ids[entry]],
+        }
+
+    def save(self, path):
+        """Write the entries to an .npz file (atomically; the tables are rebuilt on load)."""
+        with self._lock:
+            arrays = {
+                "codes": self._codes[:self._size].copy(),
+                "labels": self._labels[:self._size].copy(),
+                "confidence": self._confidence[:self._size].copy(),
+                "version_ids": self._version_ids[:self._size].copy(),
+                "versions": np.array(self.versions, dtype=str),
+            }
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """An index from save(), or an empty one if the file does not exist."""
+        index = cls(**kwargs)
+        if not os.path.exists(path):
+            return index
+        with np.load(path) as data:
+            index._reserve(len(data["codes"]))
+            index._size = len(data["codes"])
+            index._codes[:index._size] = data["codes"]
+            index._labels[:index._size] = data["labels"]
+            index._confidence[:index._size] = data["confidence"]
+            index._version_ids[:index._size] = data["version_ids"]
+            for version in data["versions"].tolist():
+                index._version_id(version)
+        if index._size:
+            index._rebuild()
+        return index
+
+# ============================================================================
+# 3. BENCHMARK
+# ============================================================================
+
+def benchmark_index(size=1_000_000, queries=2000, max_distance=DEFAULT_MAX_DISTANCE, tables=4, seed=0):
+    """
+    Build an index of random hashes and time radius queries.
+
+    Half the queries are perturbed copies of indexed hashes (up to
+    max_distance flipped bits), half are random. Random hashes spread evenly
+    over the buckets, so real, clustered hashes give somewhat larger buckets.
+
+    Returns:
+        dict: Build time, query latency percentiles and recall on the copies
+    """
+    rng = np.random.default_rng(seed)
+    codes = rng.integers(0, 2 ** 64, size, dtype=np.uint64)
+    index = HashIndex(tables=tables)
+
+    start = time.perf_counter()
+    for chunk in range(0, size, 100_000):
+        batch = codes[chunk:chunk + 100_000]
+        index.add(batch, ['ai'] * len(batch), np.full(len(batch), 0.9, np.float32), 'bench')
+    with index._lock:
+        index._rebuild()
+    build_s = time.perf_counter() - start
+
+    targets = rng.integers(0, size, queries // 2)
+    probes = []
+    for target in targets:
+        flips = rng.choice(HASH_BITS, rng.integers(0, max_distance + 1), replace=False)
+        probes.append(int(codes[target]) ^ sum(1 << int(b) for b in flips))
+    probes += [int(c) for c in rng.integers(0, 2 ** 64, queries - len(probes), dtype=np.uint64)]
+
+    latencies, found = [], 0
+    for i, probe in enumerate(probes):
+        t = time.perf_counter()
+        ids, _ = index.search(probe, max_distance)
+        latencies.append((time.perf_counter() - t) * 1000)
+        if i < len(targets) and targets[i] in ids:
+            found += 1
+
+    latencies = np.array(latencies)
+    return {
+        "entries": size,
+        "tables": tables,
+        "max_distance": max_distance,
+        "build_s": round(build_s, 2),
+        "query_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "query_p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "recall": round(found / len(targets), 4),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Perceptual-hash near-duplicate index")
+    parser.add_argument('images', nargs='*', help="Print the hash of each image and the distances between them")
+    parser.add_argument('--method', choices=sorted(HASH_METHODS), default='phash')
+    parser.add_argument('--benchmark', type=int, metavar='N', help="Time queries on an index of N random hashes")
+    parser.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE)
+    parser.add_argument('--tables', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(benchmark_index(args.benchmark, max_distance=args.max_distance, tables=args.tables))
+    hashes = []
+    for path in args.images:
+        with open(path, 'rb') as f:
+            hashes.append(image_hash(f.read(), args.method))
+        print(f"{hashes[-1]:016x}  {path}")
+    for (i, a), (j, b) in itertools.combinations(enumerate(hashes), 2):
+        print(f"{hamming(a, b):>2} bits  {args.images[i]}  {args.images[j]}")
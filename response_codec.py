@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Response encoding for the API servers
+Content negotiation between JSON and msgpack, a JSON path that handles
+numpy types natively, and gzip/brotli compression of large responses.
+
+install_codec(app) makes every jsonify() in a server go through here:
+
+- Accept: application/msgpack (or application/x-msgpack) gets msgpack with
+  every float packed as float32 (4 bytes instead of a ~20 character
+  decimal). JSON stays the default.
+- numpy scalars and arrays serialize as numbers and lists in both formats
+  (extract_statistical_features returns numpy floats).
+- Responses of RESPONSE_COMPRESS_MIN_BYTES or more (default 1024, so
+  mostly batch responses) are compressed when the client sends a matching
+  Accept-Encoding. Brotli is preferred over gzip.
+
+orjson (fast JSON), msgpack and brotli are optional: without them JSON
+goes through the standard library, and msgpack or brotli is simply not
+offered.
+
+    pip3 install -r requirements-codec.txt   # orjson, msgpack, brotli
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+from flask import current_app, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack')
+
+COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+# Mimetypes worth compressing (images and already-compressed bodies are not)
+COMPRESSIBLE_MIMETYPES = {JSON_MIMETYPE, MSGPACK_MIMETYPE, 'application/x-ndjson', 'text/plain', 'text/html'}
+
+# ============================================================================
+# 1. ENCODERS
+# ============================================================================
+
+def to_builtin(obj):
+    """Fallback for values the encoders do not handle natively (numpy types, sets)."""
+    # numpy is not a dependency of the lightweight servers; if it was never
+    # imported, obj cannot be a numpy value
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(obj, np.generic):
+        return obj.item()
+    if np is not None and isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def dumps_json(obj):
+    """Compact JSON bytes; orjson when installed, else the standard library."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=to_builtin,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=to_builtin, separators=(',', ':')).encode()
+
+
+def dumps_msgpack(obj):
+    """msgpack bytes with floats as float32."""
+    if msgpack is None:
+        raise RuntimeError("msgpack is not installed (pip install msgpack)")
+    return msgpack.packb(obj, default=to_builtin, use_single_float=True)
+
+
+def available_encodings():
+    """Content-Encodings this process can produce, preferred first."""
+    return (['br'] if brotli is not None else []) + ['gzip']
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+# ============================================================================
+# 2. FLASK INTEGRATION
+# ============================================================================
+
+def negotiate_format(req):
+    """The response mimetype for a request: msgpack if asked for and available, else JSON."""
+    if msgpack is None:
+        return JSON_MIMETYPE
+    offers = [JSON_MIMETYPE] + list(MSGPACK_MIMETYPES)
+    best = req.accept_mimetypes.best_match(offers, default=JSON_MIMETYPE)
+    return MSGPACK_MIMETYPE if best in MSGPACK_MIMETYPES else JSON_MIMETYPE
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider: numpy-aware fast JSON, and msgpack for clients that accept it."""
+
+    def dumps(self, obj, **kwargs):
+        return dumps_json(obj).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        mimetype = negotiate_format(request) if has_request_context() else JSON_MIMETYPE
+        body = dumps_msgpack(obj) if mimetype == MSGPACK_MIMETYPE else dumps_json(obj)
+        response = current_app.response_class(body, mimetype=mimetype)
+        response.vary.add('Accept')
+        return response
+
+
+def compress_response(response):
+    """after_request hook: compress large bodies the client can decode."""
+    if (response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def install_codec(app):
+    """Route a Flask app's jsonify() through the codec and compress its large responses."""
+    app.json = CodecJSONProvider(app)
+    app.after_request(compress_response)
+    return app
+
+# ============================================================================
+# 3. BENCHMARK
+# ============================================================================
+
+def sample_batch(size, seed=0):
+    """A /classify/batch response shaped like ml_model_example's, with numpy features."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    results = []
+    for i in range(size):
+        ai_probability = rng.random(dtype=np.float32)
+        results.append({
+            "url": f"https://example.com/images/{i:06d}.jpg",
+            "label": "ai" if ai_probability > 0.5 else "real",
+            "confidence": float(max(ai_probability, 1 - ai_probability)),
+            "ai_probability": ai_probability,
+            "features": {name: rng.random(dtype=np.float32) for name in (
+                "mean_intensity", "std_intensity", "skewness", "kurtosis", "edge_density",
+                "red_mean", "red_std", "green_mean", "green_std", "blue_mean", "blue_std")},
+            "model_version": "v3",
+        })
+    return {"results": results}
+
+
+def benchmark_codecs(batch_size=32, repeat=200):
+    """
+    Time encoding of a batch response in each available format and encoding.
+
+    Returns:
+        list: One row per format/encoding with bytes and microseconds per response
+    """
+    payload = sample_batch(batch_size)
+    encoders = {"json": dumps_json}
+    if msgpack is not None:
+        encoders["msgpack"] = dumps_msgpack
+
+    rows = []
+    for name, encode in encoders.items():
+        for encoding in [None] + available_encodings():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                body = encode(payload)
+                if encoding is not None:
+                    body = compress(body, encoding)
+            elapsed = (time.perf_counter() - start) / repeat
+            rows.append({"format": name, "encoding": encoding or "identity",
+                         "bytes": len(body), "encode_us": round(elapsed * 1e6, 1)})
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare response encodings on a sample batch response")
+    parser.add_argument('--batch-size', type=int, default=32, help="Results per response")
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"orjson: {'yes' if orjson else 'no'}, msgpack: {'yes' if msgpack else 'no'}, "
+          f"brotli: {'yes' if brotli else 'no'}")
+    for row in benchmark_codecs(args.batch_size, args.repeat):
+        print(f"{row['format']:<8} {row['encoding']:<9} {row['bytes']:>8} bytes  {row['encode_us']:>9} us")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Balanced, deterministic batch sampling
+Produces batches of (class, index) pairs for the training generators
+without materializing a shuffled copy of the dataset. Each class is read
+through its own seeded pseudo-random permutation, one pass after another
+(a new permutation per pass), so every image of a class is seen once per
+pass. Batches mix the classes in fixed proportions (equal by default), so
+a minority class is oversampled by cycling through it faster.
+
+A permutation is a keyed Feistel network over the index range, evaluated
+on demand, and the number of draws each class has made before any step
+is closed-form. Memory is O(1) in the dataset size and batch(step) is
+random access, so a resumed run jumps straight to its step.
+
+    sampler = BalancedSampler([len(real_files), len(ai_files)], batch_size=32, seed=1)
+    for classes, indices in sampler.batches(start=step):
+        ...
+"""
+
+import math
+
+import numpy as np
+
+_FEISTEL_ROUNDS = 4
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+# ============================================================================
+# 1. PERMUTATIONS
+# ============================================================================
+
+def _mix(x):
+    """splitmix64 finalizer on a uint64 array (wrapping arithmetic)."""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class Permutation:
+    """
+    A seeded pseudo-random permutation of range(size), evaluated per index.
+
+    A balanced Feistel network permutes the smallest power of four that
+    holds size; outputs that land past size are fed through again
+    (cycle walking), which keeps the map a bijection on range(size).
+    """
+
+    def __init__(self, size, key):
+        """
+        Args:
+            size (int): Length of the range
+            key (sequence of int): Seed material, e.g. (seed, class, pass)
+        """
+        self.size = int(size)
+        half_bits = max(1, math.ceil(math.log2(max(self.size, 2)) / 2))
+        self._shift = np.uint64(half_bits)
+        self._mask = np.uint64((1 << half_bits) - 1)
+        self._keys = np.random.SeedSequence([int(k) for k in key]).generate_state(_FEISTEL_ROUNDS, np.uint64)
+
+    def _feistel(self, x):
+        left, right = x >> self._shift, x & self._mask
+        for key in self._keys:
+            left, right = right, left ^ (_mix(right ^ key) & self._mask)
+        return (left << self._shift) | right
+
+    def __call__(self, positions):
+        """Permuted values of an integer array of positions in range(size)."""
+        with np.errstate(over='ignore'):
+            values = self._feistel(np.asarray(positions, dtype=np.uint64))
+            outside = values >= self.size
+            while outside.any():
+                values[outside] = self._feistel(values[outside])
+                outside = values >= self.size
+        return values.astype(np.int64)
+
+# ============================================================================
+# 2. BALANCED SAMPLER
+# ============================================================================
+
+class BalancedSampler:
+    """
+    Batches of (class ids, within-class indices) in fixed class proportions.
+
+    Class c makes floor(step * batch_size * weight_c) draws before `step`
+    (the class with the largest weight takes the remainder), and its m-th
+    draw is position m % size_c of pass m // size_c through that class.
+    """
+
+    def __init__(self, class_sizes, batch_size, weights=None, seed=None):
+        """
+        Args:
+            class_sizes (list): Number of items in each class
+            batch_size (int): Items per batch
+            weights (list): Share of each batch per class (normalized;
+                equal by default). Empty classes get no share.
+            seed (int): Seed for the permutations (random if None)
+
+        Raises:
+            ValueError: if every class is empty or the proportions cannot
+                be met with this batch size
+        """
+        self.class_sizes = np.asarray(class_sizes, dtype=np.int64)
+        self.batch_size = int(batch_size)
+        weights = np.ones(len(self.class_sizes)) if weights is None else np.asarray(weights, dtype=np.float64)
+        weights = np.where(self.class_sizes > 0, weights, 0.0)
+        if weights.sum() <= 0:
+            raise ValueError("BalancedSampler needs at least one non-empty class with a positive weight")
+        self.weights = weights / weights.sum()
+        self.seed = int(np.random.default_rng().integers(2 ** 63)) if seed is None else int(seed)
+
+        self._filler = int(np.argmax(self.weights))
+        others = np.delete(np.arange(len(self.weights)), self._filler)
+        if np.ceil(self.batch_size * self.weights[others]).sum() > self.batch_size:
+            raise ValueError(f"Batch size {batch_size} is too small for class weights {self.weights.round(3).tolist()}")
+        self._permutations = {}
+
+    def drawn_before(self, step):
+        """Draws each class has made before `step` (int64 array)."""
+        drawn = np.floor(step * self.batch_size * self.weights).astype(np.int64)
+        drawn[self._filler] = step * self.batch_size - (drawn.sum() - drawn[self._filler])
+        return drawn
+
+    @property
+    def steps_per_epoch(self):
+        """Steps after which every item of every class has been drawn at least once."""
+        active = self.weights > 0
+        steps = int(np.max(np.ceil(self.class_sizes[active] / (self.batch_size * self.weights[active]))))
+        while np.any(self.drawn_before(steps)[active] < self.class_sizes[active]):
+            steps += 1
+        return steps
+
+    def _permutation(self, label, epoch):
+        key = (label, epoch)
+        permutation = self._permutations.get(key)
+        if permutation is None:
+            # Batches move forward, so only the current pass of each class is kept
+            self._permutations = {k: v for k, v in self._permutations.items() if k[0] != label}
+            permutation = self._permutations[key] = Permutation(self.class_sizes[label], (self.seed, label, epoch))
+        return permutation
+
+    def batch(self, step):
+        """
+        The batch at a step.
+
+        Returns:
+            tuple: (class ids, within-class indices), int64 arrays of
+                length batch_size, grouped by class
+        """
+        start, end = self.drawn_before(step), self.drawn_before(step + 1)
+        classes, indices = [], []
+        for label in np.flatnonzero(end > start):
+            size = self.class_sizes[label]
+            draws = np.arange(start[label], end[label])
+            epochs, positions = np.divmod(draws, size)
+            for epoch in np.unique(epochs):
+                in_epoch = epochs == epoch
+                indices.append(self._permutation(label, int(epoch))(positions[in_epoch]))
+                classes.append(np.full(int(in_epoch.sum()), label, dtype=np.int64))
+        return np.concatenate(classes), np.concatenate(indices)
+
+    def batches(self, start=0):
+        """Yield batch(step) for step = start, start + 1, ..."""
+        step = start
+        while True:
+            yield self.batch(step)
+            step += 1
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Shadow and A/B routing across detector backends
+Serves every request from a primary backend and returns its answer at once.
+A sampled fraction of requests is also handed, with the same image bytes,
+to shadow backends that run on a small background pool. Their answers are
+compared with the primary's and logged (agreement and latency per backend)
+but never returned. The pool's queue is bounded and shadow jobs are dropped
+rather than queued without limit, and shadow threads run at a lower CPU
+priority, so shadow work does not hold up or slow down primary responses.
+
+For an A/B test the primary itself can be a weighted split between
+backends; each client (X-Client-Id, else remote address) is assigned to one
+arm and stays there.
+
+Backends are detector_service's (heuristic, huggingface, google, cascade,
+deploy_model), except that "cnn" is still deploy_model's CNN as it was
+before the service existed, not the service's ml_model_example detector.
+Only the configured ones are loaded.
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from flask import Flask, g, request, jsonify
+
+from admission import AdmissionController, client_key
+from response_codec import install_codec
+from deadline import Deadline, DeadlineExceeded, deadline_stats
+from detector_service import BACKEND_CLASSES, BackendUnavailable, DeployModelBackend
+from image_probe import fetch_image_bytes, images_from_request, ImageRejected
+
+app = install_codec(Flask(__name__))
+
+# Mostly upstream-bound (downloads, HF); CNN requests are short
+admission = AdmissionController.from_env('shadow_router', max_in_flight=16)
+
+# ============================================================================
+# 1. CONFIGURATION
+# ============================================================================
+
+DEFAULT_ROUTER_CONFIG = {
+    # A backend name, or {"name": weight, ...} for an A/B split of clients
+    "primary": "cnn",
+    # Shadow backend -> fraction of requests it also runs on
+    "shadows": {
+        "heuristic": 1.0,
+        "huggingface": 0.05
+    },
+    "shadow_workers": 2,
+    "shadow_queue": 32,        # jobs waiting; beyond this they are dropped
+    "shadow_timeout": 20.0,    # seconds a shadow call may take
+    "shadow_nice": 10,         # CPU priority offset for shadow threads (Linux)
+    "log_path": "shadow_log.jsonl"
+}
+
+
+def load_router_config(path=None):
+    """
+    Load router configuration, overlaying a JSON file on the defaults.
+
+    Args:
+        path (str): Path to a JSON config file (defaults to $SHADOW_CONFIG)
+
+    Returns:
+        dict: Router configuration
+    """
+    config = json.loads(json.dumps(DEFAULT_ROUTER_CONFIG))
+    path = path or os.getenv('SHADOW_CONFIG')
+    if not path:
+        return config
+
+    with open(path) as f:
+        config.update(json.load(f))
+    return config
+
+# Router configs written before detector_service keep their meaning: their
+# "cnn" (trained_model.h5 via deploy_model) was a different model from the
+# service's "cnn" (best_model.h5 via ml_model_example)
+ROUTER_BACKENDS = dict(BACKEND_CLASSES, cnn=DeployModelBackend)
+
+# ============================================================================
+# 2. ROUTER
+# ============================================================================
+
+def _lower_thread_priority(nice):
+    # On Linux a thread id works as a pid for setpriority, so only this
+    # thread is deprioritized; elsewhere shadows run at normal priority
+    if nice and hasattr(os, 'setpriority') and hasattr(threading, 'get_native_id'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+        except OSError:
+            pass
+
+
+class _BackendStats:
+    """Latency and agreement counters for one backend (guarded by the router lock)."""
+
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.compared = 0
+        self.agreed = 0
+        self.latencies_ms = deque(maxlen=1000)
+
+    def snapshot(self):
+        latencies = np.array(self.latencies_ms) if self.latencies_ms else None
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "compared": self.compared,
+            "agreement": round(self.agreed / self.compared, 4) if self.compared else None,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 1) if latencies is not None else None,
+            "p95_ms": round(float(np.percentile(latencies, 95)), 1) if latencies is not None else None,
+        }
+
+
+class ShadowRouter:
+    """
+    Answers from the primary backend and mirrors sampled traffic to shadows.
+
+    Shadow jobs go to a thread pool through a bounded slot count: submit()
+    never waits, it drops the job when every slot is taken.
+    """
+
+    def __init__(self, backends, primary, shadows, workers=2, max_queue=32, timeout=20.0,
+                 nice=10, log_path=None):
+        """
+        Args:
+            backends (dict): name -> detector_service.Backend
+            primary (str or dict): Backend name, or {name: weight} for A/B arms
+            shadows (dict): Shadow backend name -> sampling fraction (0..1)
+            workers (int): Shadow threads
+            max_queue (int): Shadow jobs allowed to wait for a thread
+            timeout (float): Deadline for each shadow call
+            nice (int): Priority offset for shadow threads
+            log_path (str): JSONL file for per-comparison records (None: off)
+        """
+        self.backends = backends
+        self.arms = primary if isinstance(primary, dict) else {primary: 1.0}
+        self.shadows = shadows
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shadow',
+                                            initializer=_lower_thread_priority, initargs=(nice,))
+        self._lock = threading.Lock()
+        self._stats = {name: _BackendStats() for name in backends}
+        self._counters = {"requests": 0, "shadow_submitted": 0, "shadow_dropped": 0}
+        self._log = open(log_path, 'a', buffering=1) if log_path else None
+        self._log_lock = threading.Lock()
+
+        weights = np.array(list(self.arms.values()), dtype=np.float64)
+        self._arm_names = list(self.arms)
+        self._arm_bounds = np.cumsum(weights / weights.sum())
+
+    @classmethod
+    def from_config(cls, config=None):
+        config = config or load_router_config()
+        primary = config["primary"]
+        names = set(primary if isinstance(primary, dict) else [primary]) | set(config["shadows"])
+        unknown = names - set(ROUTER_BACKENDS)
+        if unknown:
+            raise ValueError(f"Unknown backends: {', '.join(sorted(unknown))}")
+        backends, shadows = {}, dict(config["shadows"])
+        for name in sorted(names):
+            try:
+                backends[name] = ROUTER_BACKENDS[name]()
+            except BackendUnavailable as e:
+                if name not in shadows or name in (primary if isinstance(primary, dict) else [primary]):
+                    raise
+                # A shadow that cannot run here is left out, not fatal
+                print(f"Shadow {name} disabled: {e}")
+                del shadows[name]
+        return cls(backends, primary, shadows, config["shadow_workers"], config["shadow_queue"],
+                   config["shadow_timeout"], config["shadow_nice"], config.get("log_path"))
+
+    def assign(self, client):
+        """The primary arm for a client: a stable hash, so each client stays in one arm."""
+        if len(self._arm_names) == 1:
+            return self._arm_names[0]
+        point = int(hashlib.sha256(client.encode()).hexdigest()[:8], 16) / 2 ** 32
+        index = int(np.searchsorted(self._arm_bounds, point, side='right'))
+        return self._arm_names[min(index, len(self._arm_names) - 1)]
+
+    def _run(self, name, image_bytes, info, deadline):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = self.backends[name].classify(image_bytes, info, deadline)
+            failed = bool(result.get("error"))
+            return result, (time.perf_counter() - start) * 1000
+        finally:
+            with self._lock:
+                stats = self._stats[name]
+                stats.runs += 1
+                stats.errors += int(failed)
+                stats.latencies_ms.append((time.perf_counter() - start) * 1000)
+
+    def classify(self, image_bytes, info, client, deadline=None):
+        """
+        Classify with the client's primary backend and queue sampled shadows.
+
+        Returns:
+            dict: The primary's result, with "backend" naming it
+
+        Raises:
+            DeadlineExceeded: if the primary ran out of time
+        """
+        primary = self.assign(client)
+        result, primary_ms = self._run(primary, image_bytes, info, deadline)
+        with self._lock:
+            self._counters["requests"] += 1
+
+        for name, rate in self.shadows.items():
+            if name != primary and random.random() < rate:
+                self._submit(name, primary, result, primary_ms, image_bytes, info)
+        return dict(result, backend=primary)
+
+    def _submit(self, name, primary, primary_result, primary_ms, image_bytes, info):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counters["shadow_dropped"] += 1
+            return
+        with self._lock:
+            self._counters["shadow_submitted"] += 1
+        future = self._executor.submit(self._shadow, name, primary, primary_result, primary_ms, image_bytes, info)
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def _shadow(self, name, primary, primary_result, primary_ms, image_bytes, info):
+        start = time.perf_counter()
+        try:
+            result, elapsed_ms = self._run(name, image_bytes, info, Deadline(self.timeout))
+        except Exception as e:
+            result, elapsed_ms = {"error": str(e) or type(e).__name__}, (time.perf_counter() - start) * 1000
+        comparable = not result.get("error") and not primary_result.get("error")
+        agree = comparable and result.get("label") == primary_result.get("label")
+        if comparable:
+            with self._lock:
+                self._stats[name].compared += 1
+                self._stats[name].agreed += int(agree)
+        if self._log is not None:
+            record = {
+                "ts": time.time(),
+                "primary": primary,
+                "primary_label": primary_result.get("label"),
+                "primary_confidence": primary_result.get("confidence"),
+                "primary_ms": round(primary_ms, 1),
+                "shadow": name,
+                "label": result.get("label"),
+                "confidence": result.get("confidence"),
+                "shadow_ms": round(elapsed_ms, 1),
+                "agree": agree if comparable else None,
+                "error": result.get("error") or primary_result.get("error"),
+            }
+            with self._log_lock:
+                self._log.write(json.dumps(record) + '\n')
+
+    def stats(self):
+        """Per-backend latency and agreement with the primary, for /health."""
+        with self._lock:
+            return dict(self._counters,
+                        primary=self.arms,
+                        shadows=self.shadows,
+                        backends={name: stats.snapshot() for name, stats in self._stats.items()})
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        if self._log is not None:
+            self._log.close()
+
+# ============================================================================
+# 3. FLASK API SERVER
+# ============================================================================
+
+router = None
+
+@app.route('/classify', methods=['POST'])
+@admission.limit
+def classify_image():
+    """Flask endpoint: the primary backend's result, with "backend" naming it"""
+    try:
+        uploads = images_from_request(request)
+        if uploads is not None:
+            if len(uploads) != 1:
+                return jsonify({"error": "exactly one image required"}), 400
+            image_bytes, info = uploads[0]
+        else:
+            data = request.get_json()
+            image_url = data.get('imageUrl')
+
+            if not image_url:
+                return jsonify({"error": "imageUrl required"}), 400
+
+            # Fetched once; shadows reuse the same bytes
+            image_bytes, info = fetch_image_bytes(image_url, timeout=10, deadline=g.deadline)
+
+        result = router.classify(image_bytes, info, client_key(request), g.deadline)
+        if result.get('error'):
+            return jsonify(result), 502
+        return jsonify(result)
+
+    except ImageRejected as e:
+        return jsonify({"error": str(e), "rejected": e.reason}), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint, includes per-backend agreement and latency"""
+    return jsonify({
+        "status": "healthy",
+        "router": router.stats() if router is not None else None,
+        "admission": admission.snapshot(),
+        "deadlines": deadline_stats()
+    })
+
+if __name__ == '__main__':
+    router = ShadowRouter.from_config()
+    print(f"Primary: {router.arms}, shadows: {router.shadows}")
+    print("Starting shadow-routing AI Detection API on http://localhost:5003")
+    app.run(port=5003, host='0.0.0.0', threaded=True)
@@ -6,26 +6,33 @@ This version uses a more reliable approach for AI detection
 
 import requests
 import json
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, g, request, jsonify, make_response
 import os
-from PIL import Image
-import io
 import base64
-import re
-import time
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
 
-app = Flask(__name__)
+from image_probe import fetch_image_bytes, images_from_request, ImageRejected, MAX_UPLOAD_IMAGES
+from admission import AdmissionController
+from response_codec import install_codec
+from deadline import DeadlineExceeded, deadline_stats
+
+app = install_codec(Flask(__name__))
+
+# Bounded concurrency with fair queuing; mostly waiting on Hugging Face
+admission = AdmissionController.from_env('simple', max_in_flight=16)
 
 # --- CORS helpers ---
 ALLOWED_ORIGINS = "*"
-ALLOWED_HEADERS = "Content-Type, Authorization"
+ALLOWED_HEADERS = "Content-Type, Authorization, X-Request-Timeout-Ms, X-Client-Id"
 ALLOWED_METHODS = "GET, POST, OPTIONS"
 
 def add_cors(resp):
     resp.headers["Access-Control-Allow-Origin"] = ALLOWED_ORIGINS
     resp.headers["Access-Control-Allow-Headers"] = ALLOWED_HEADERS
     resp.headers["Access-Control-Allow-Methods"] = ALLOWED_METHODS
+    resp.headers["Access-Control-Expose-Headers"] = "Retry-After"
     return resp
 
 @app.after_request
@@ -33,96 +40,180 @@ def apply_cors(response):
     return add_cors(response)
 
 @app.route('/classify', methods=['OPTIONS'])
+@app.route('/classify/batch', methods=['OPTIONS'])
+@app.route('/classify/stream', methods=['OPTIONS'])
 @app.route('/health', methods=['OPTIONS'])
 @app.route('/', methods=['OPTIONS'])
 def cors_preflight():
     return add_cors(make_response("", 204))
 
 
-def _resize_and_encode_jpeg(image_bytes: bytes, max_dim: int = 512, quality: int = 85) -> str:
-    """Downscale to max_dim and return base64 JPEG data URI string."""
-    with Image.open(io.BytesIO(image_bytes)) as img:
-        img = img.convert('RGB')
-        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG', quality=quality, optimize=True)
-        encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return f"data:image/jpeg;base64,{encoded}"
-
-
 # Simple in-memory cache for recent results
 _RESULT_CACHE: OrderedDict[str, dict] = OrderedDict()
 _CACHE_MAX_SIZE = 500
+_CACHE_LOCK = threading.Lock()
 
 
 def _cache_get(key: str):
-    if key in _RESULT_CACHE:
-        _RESULT_CACHE.move_to_end(key)
-        return _RESULT_CACHE[key]
+    with _CACHE_LOCK:
+        if key in _RESULT_CACHE:
+            _RESULT_CACHE.move_to_end(key)
+            return _RESULT_CACHE[key]
     return None
 
 
 def _cache_set(key: str, value: dict):
-    _RESULT_CACHE[key] = value
-    _RESULT_CACHE.move_to_end(key)
-    while len(_RESULT_CACHE) > _CACHE_MAX_SIZE:
-        _RESULT_CACHE.popitem(last=False)
+    with _CACHE_LOCK:
+        _RESULT_CACHE[key] = value
+        _RESULT_CACHE.move_to_end(key)
+        while len(_RESULT_CACHE) > _CACHE_MAX_SIZE:
+            _RESULT_CACHE.popitem(last=False)
 
 
-def detect_ai_zero_shot_clip(image_url, api_key):
-    """Use image analysis to determine if image is AI-generated or real."""
+# Streaming: URLs are classified concurrently on a shared pool, at most
+# MAX_STREAM_IMAGES per request
+MAX_STREAM_IMAGES = 100
+_STREAM_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('STREAM_WORKERS', '8')),
+                                      thread_name_prefix='stream')
+
+
+def analyze_image_bytes(image_bytes, info):
+    """
+    Heuristic classification of an image that is already in memory.
+    
+    Args:
+        image_bytes (bytes): Encoded image
+        info (dict): Header info from image_probe (format, width, height)
+    """
+    # Analyze image characteristics (the header is all this heuristic needs,
+    # so the pixels are never decoded)
+    width, height = info["width"], info["height"]
+    
+    # Simple heuristic analysis (placeholder for real ML)
+    # In a real implementation, this would use proper ML models
+    import hashlib
+    
+    # Create a deterministic but varied response based on image characteristics
+    img_hash = hashlib.md5(image_bytes).hexdigest()
+    hash_int = int(img_hash[:8], 16)
+    
+    # Use image characteristics for realistic classification
+    aspect_ratio = width / height if height > 0 else 1
+    total_pixels = width * height
+    
+    # Heuristic: square-ish images with high resolution tend to be real photos
+    # This is just a demo heuristic - not real ML analysis
+    if total_pixels > 800000 and 0.5 < aspect_ratio < 2.0:
+        label = "real"
+        confidence = 0.75 + (hash_int % 20) / 100  # 0.75-0.95
+    elif total_pixels > 400000:
+        label = "real" if hash_int % 3 == 0 else "ai"
+        confidence = 0.65 + (hash_int % 25) / 100  # 0.65-0.90
+    else:
+        label = "ai" if hash_int % 2 == 0 else "real"
+        confidence = 0.60 + (hash_int % 30) / 100  # 0.60-0.90
+        
+    return {
+        "label": label,
+        "confidence": confidence,
+        "source": "image_analysis_heuristic",
+        "analysis": f"Size: {width}x{height} ({total_pixels:,}px), Aspect: {aspect_ratio:.2f}"
+    }
+
+
+def detect_ai_zero_shot_clip(image_url, api_key, deadline=None):
+    """
+    Use image analysis to determine if image is AI-generated or real.
+    
+    The download is bounded by the request deadline as well as its own
+    8 s timeout; DeadlineExceeded propagates.
+    """
     try:
         cached = _cache_get(image_url)
         if cached:
             return cached
 
-        resp = requests.get(image_url, timeout=8)
-        resp.raise_for_status()
-
-        # Analyze image characteristics
-        img = Image.open(io.BytesIO(resp.content))
-        width, height = img.size
-        
-        # Convert to RGB if needed
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Simple heuristic analysis (placeholder for real ML)
-        # In a real implementation, this would use proper ML models
-        import hashlib
-        
-        # Create a deterministic but varied response based on image characteristics
-        img_hash = hashlib.md5(resp.content).hexdigest()
-        hash_int = int(img_hash[:8], 16)
-        
-        # Use image characteristics for realistic classification
-        aspect_ratio = width / height if height > 0 else 1
-        total_pixels = width * height
-        
-        # Heuristic: square-ish images with high resolution tend to be real photos
-        # This is just a demo heuristic - not real ML analysis
-        if total_pixels > 800000 and 0.5 < aspect_ratio < 2.0:
-            label = "real"
-            confidence = 0.75 + (hash_int % 20) / 100  # 0.75-0.95
-        elif total_pixels > 400000:
-            label = "real" if hash_int % 3 == 0 else "ai"
-            confidence = 0.65 + (hash_int % 25) / 100  # 0.65-0.90
-        else:
-            label = "ai" if hash_int % 2 == 0 else "real"
-            confidence = 0.60 + (hash_int % 30) / 100  # 0.60-0.90
-            
-        out = {
-            "label": label,
-            "confidence": confidence,
-            "source": "image_analysis_heuristic",
-            "analysis": f"Size: {width}x{height} ({total_pixels:,}px), Aspect: {aspect_ratio:.2f}"
-        }
+        # Limits are checked on the header, before the body is downloaded
+        image_bytes, info = fetch_image_bytes(image_url, timeout=8, deadline=deadline)
+
+        out = analyze_image_bytes(image_bytes, info)
         _cache_set(image_url, out)
         return out
+    except ImageRejected as e:
+        return {"error": str(e), "rejected": e.reason}
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
 
+def _result_status(result):
+    """HTTP status for a detection result dict."""
+    # Images rejected by the header probe are a client problem, not an upstream one
+    if isinstance(result, dict) and result.get('rejected'):
+        return 400
+    # If upstream model errored, surface a non-200 so the extension falls back cleanly
+    if isinstance(result, dict) and result.get('error'):
+        return 502
+    return 200
+
+
+def _stream_event(result, sse):
+    """One result as an NDJSON line or an SSE event."""
+    line = json.dumps(result)
+    return f"event: result\ndata: {line}\n\n" if sse else line + "\n"
+
+
+def stream_detections(image_urls, api_key, deadline=None, sse=False):
+    """
+    Yield one event per image as soon as it is classified.
+    
+    Cached results are sent first, without waiting on anything; the rest are
+    classified concurrently and sent in completion order, so one slow URL
+    delays only its own result. Every event carries the URL and its index
+    in the request. Images still unfinished when the deadline passes get a
+    deadline_exceeded error event. With sse, a final "done" event follows.
+    
+    Args:
+        image_urls (list): Image URLs
+        api_key (str): Hugging Face API key
+        deadline (Deadline): Request deadline
+        sse (bool): Server-sent events instead of NDJSON
+    """
+    pending = {}
+    try:
+        for index, url in enumerate(image_urls):
+            cached = _cache_get(url)
+            if cached:
+                yield _stream_event(dict(cached, url=url, index=index, cached=True), sse)
+            else:
+                future = _STREAM_EXECUTOR.submit(detect_ai_zero_shot_clip, url, api_key, deadline)
+                pending[future] = (index, url)
+        
+        timeout = max(0.0, deadline.remaining()) if deadline is not None else None
+        try:
+            for future in as_completed(list(pending), timeout=timeout):
+                index, url = pending.pop(future)
+                try:
+                    result = future.result()
+                except DeadlineExceeded as e:
+                    result = {"error": str(e), "deadline_exceeded": True, "stage": e.stage}
+                except Exception as e:
+                    result = {"error": str(e)}
+                yield _stream_event(dict(result, url=url, index=index), sse)
+        except FutureTimeout:
+            for index, url in sorted(pending.values()):
+                yield _stream_event({"error": "Request deadline exceeded", "deadline_exceeded": True,
+                                     "url": url, "index": index}, sse)
+        
+        if sse:
+            yield f"event: done\ndata: {json.dumps({'count': len(image_urls)})}\n\n"
+    finally:
+        # Client went away or the deadline passed: drop work not yet started
+        for future in pending:
+            future.cancel()
+
+
 def warmup_model(api_key):
     """Warm up Hugging Face model to reduce cold-start latency."""
     try:
@@ -144,12 +235,27 @@ def warmup_model(api_key):
         pass
 
 @app.route('/classify', methods=['POST'])
+@admission.limit
 def classify_image():
-    """Flask endpoint for image classification"""
+    """
+    Flask endpoint for image classification
+    
+    Accepts a JSON body with imageUrl, or the image bytes themselves (see
+    image_probe.images_from_request) so the server does not refetch an image
+    the client already has.
+    """
     try:
+        api_key = os.getenv('HF_API_KEY')
+        uploads = images_from_request(request)
+        
+        if uploads is not None:
+            if len(uploads) != 1:
+                return add_cors(jsonify({"error": "exactly one image required"})), 400
+            result = analyze_image_bytes(*uploads[0])
+            return add_cors(jsonify(result))
+        
         data = request.get_json()
         image_url = data.get('imageUrl')
-        api_key = os.getenv('HF_API_KEY')
         
         if not image_url:
             return add_cors(jsonify({"error": "imageUrl required"})), 400
@@ -157,11 +263,71 @@ def classify_image():
         if not api_key:
             return add_cors(jsonify({"error": "HF_API_KEY environment variable required"})), 500
             
-        result = detect_ai_zero_shot_clip(image_url, api_key)
-        # If upstream model errored, surface a non-200 so the extension falls back cleanly
-        if isinstance(result, dict) and result.get('error'):
-            return add_cors(jsonify(result)), 502
-        return add_cors(jsonify(result))
+        result = detect_ai_zero_shot_clip(image_url, api_key, g.deadline)
+        return add_cors(jsonify(result)), _result_status(result)
+        
+    except ImageRejected as e:
+        return add_cors(jsonify({"error": str(e), "rejected": e.reason})), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
+    except Exception as e:
+        return add_cors(jsonify({"error": str(e)})), 500
+
+@app.route('/classify/batch', methods=['POST'])
+@admission.limit
+def classify_batch():
+    """Flask endpoint for several images, as uploads or a JSON list of imageUrls"""
+    try:
+        api_key = os.getenv('HF_API_KEY')
+        uploads = images_from_request(request)
+        
+        if uploads is not None:
+            return add_cors(jsonify({"results": [analyze_image_bytes(*upload) for upload in uploads]}))
+        
+        data = request.get_json()
+        image_urls = data.get('imageUrls')
+        
+        if not image_urls or not isinstance(image_urls, list):
+            return add_cors(jsonify({"error": "imageUrls must be a non-empty list"})), 400
+        
+        if len(image_urls) > MAX_UPLOAD_IMAGES:
+            return add_cors(jsonify({"error": f"at most {MAX_UPLOAD_IMAGES} imageUrls per batch"})), 400
+        
+        results = [dict(detect_ai_zero_shot_clip(url, api_key, g.deadline), url=url) for url in image_urls]
+        return add_cors(jsonify({"results": results}))
+        
+    except ImageRejected as e:
+        return add_cors(jsonify({"error": str(e), "rejected": e.reason})), 400
+    except DeadlineExceeded:
+        raise  # admission.limit answers 504
+    except Exception as e:
+        return add_cors(jsonify({"error": str(e)})), 500
+
+@app.route('/classify/stream', methods=['POST'])
+@admission.limit
+def classify_stream():
+    """
+    Flask endpoint that streams one result per imageUrl as it is ready
+    
+    Responds with NDJSON (application/x-ndjson), or server-sent events when
+    the client sends Accept: text/event-stream or ?format=sse.
+    """
+    try:
+        api_key = os.getenv('HF_API_KEY')
+        data = request.get_json(silent=True) or {}
+        image_urls = data.get('imageUrls')
+        
+        if not image_urls or not isinstance(image_urls, list):
+            return add_cors(jsonify({"error": "imageUrls must be a non-empty list"})), 400
+        
+        if len(image_urls) > MAX_STREAM_IMAGES:
+            return add_cors(jsonify({"error": f"at most {MAX_STREAM_IMAGES} imageUrls per stream"})), 400
+        
+        sse = (request.args.get('format') == 'sse'
+               or 'text/event-stream' in request.headers.get('Accept', ''))
+        mimetype = 'text/event-stream' if sse else 'application/x-ndjson'
+        return Response(stream_detections(image_urls, api_key, g.deadline, sse), mimetype=mimetype,
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
         
     except Exception as e:
         return add_cors(jsonify({"error": str(e)})), 500
@@ -173,7 +339,9 @@ def health_check():
     return add_cors(jsonify({
         "status": "healthy", 
         "api_key_configured": bool(api_key),
-        "api_key_length": len(api_key) if api_key else 0
+        "api_key_length": len(api_key) if api_key else 0,
+        "admission": admission.snapshot(),
+        "deadlines": deadline_stats()
     }))
 
 if __name__ == '__main__':
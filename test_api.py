@@ -40,6 +40,28 @@ def test_classification():
         print(f"Classification test failed: {e}")
         return False
 
+def test_stream():
+    """Test the streaming endpoint: one NDJSON line per image, as each is ready"""
+    try:
+        payload = {
+            "imageUrls": [
+                "https://images.unsplash.com/photo-1506905925346-21bda4d32df4",
+                "https://picsum.photos/600"
+            ]
+        }
+        
+        with requests.post('http://localhost:5001/classify/stream', json=payload, stream=True) as response:
+            print(f"Stream status: {response.status_code}")
+            lines = 0
+            for line in response.iter_lines():
+                if line:
+                    print(f"Result: {json.loads(line)}")
+                    lines += 1
+        return response.status_code == 200 and lines == len(payload["imageUrls"])
+    except Exception as e:
+        print(f"Stream test failed: {e}")
+        return False
+
 if __name__ == "__main__":
     print("Testing Hugging Face AI Detection API...")
     
@@ -51,7 +73,11 @@ if __name__ == "__main__":
     print("\n2. Testing classification endpoint...")
     classification_ok = test_classification()
     
-    if health_ok and classification_ok:
+    # Test streaming endpoint
+    print("\n3. Testing streaming endpoint...")
+    stream_ok = test_stream()
+    
+    if health_ok and classification_ok and stream_ok:
         print("\n✅ API is working correctly!")
     else:
         print("\n❌ API has issues. Check the server logs.")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Tests for the on-disk embedding index
+"""
+
+import threading
+
+import numpy as np
+
+from embedding_index import EmbeddingIndex
+
+
+def _vectors(count, seed):
+    return np.random.default_rng(seed).standard_normal((count, 16)).astype(np.float32)
+
+
+def _add(index, vectors, prefix):
+    keys = [f"{prefix}{i}" for i in range(len(vectors))]
+    index.add(vectors, ['ai'] * len(vectors), np.full(len(vectors), 0.9), keys, 'v1')
+
+
+def test_reopen_after_offline_train(tmp_path):
+    """Rows a serving process adds while another process trains are assigned to lists on reopen."""
+    path = str(tmp_path / 'embeddings')
+    serving = EmbeddingIndex(path, dim=16)
+    _add(serving, _vectors(500, 0), 'a')
+    serving.flush()
+
+    EmbeddingIndex(path).train(8)
+
+    # The serving process has no centroids, so these rows are written unlisted
+    late = _vectors(10, 1)
+    _add(serving, late, 'b')
+    serving.flush()
+
+    reopened = EmbeddingIndex(path)
+    assert len(reopened) == 510
+    assert (reopened._list_ids.array[:510] >= 0).all()
+    ids, similarities = reopened.search(late, k=1, nprobe=8)
+    assert ids[:, 0].tolist() == list(range(500, 510))
+    assert np.allclose(similarities[:, 0], 1.0, atol=1e-3)
+
+
+def test_flat_and_ivf_search_agree(tmp_path):
+    index = EmbeddingIndex(str(tmp_path / 'embeddings'), dim=16)
+    vectors = _vectors(2000, 2)
+    _add(index, vectors, 'a')
+    flat, _ = index.search(vectors[:20], k=1)
+    index.train(16)
+    ivf, _ = index.search(vectors[:20], k=1, nprobe=16)
+    assert flat[:, 0].tolist() == ivf[:, 0].tolist() == list(range(20))
+    assert index.entries([3, -1])[0]["key"] == 'a3'
+    assert index.entries([3, -1])[1] is None
+
+
+def test_lists_rebuilt_in_background(tmp_path):
+    index = EmbeddingIndex(str(tmp_path / 'embeddings'), dim=16, merge_every=100)
+    vectors = _vectors(400, 3)
+    _add(index, vectors[:200], 'a')
+    index.train(4)
+    _add(index, vectors[200:], 'b')
+    for thread in threading.enumerate():
+        if thread.name == 'embedding-merge':
+            thread.join()
+    assert index._n_listed == 400
+    ids, _ = index.search(vectors[200:210], k=1, nprobe=4)
+    assert ids[:, 0].tolist() == list(range(200, 210))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Tests for the Hugging Face client against a local mock Inference API
+"""
+
+import base64
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from hf_client import HuggingFaceClient, HuggingFaceError
+from image_probe import ImageRejected
+
+
+class _MockInferenceAPI(BaseHTTPRequestHandler):
+    """Answers 503 "loading" for the first `loading` calls, then one score per input."""
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server.payloads.append(payload)
+        if len(server.payloads) <= server.loading:
+            self._reply(503, {"error": "Model is loading", "estimated_time": 0.01})
+            return
+        inputs = payload["inputs"]
+        if isinstance(inputs, list):
+            self._reply(200, [[{"label": "artificial", "score": 0.9}] for _ in inputs])
+        else:
+            self._reply(200, [{"label": "artificial", "score": 0.9}])
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mock_api():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _MockInferenceAPI)
+    server.payloads = []
+    server.loading = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server, **options):
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/models/"
+    return HuggingFaceClient('test-key', model_name='mock', base_url=base_url, backoff_base=0.01, **options)
+
+
+def _jpeg(size=(800, 600)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (120, 30, 200)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def test_retries_while_model_loads(mock_api):
+    mock_api.loading = 2
+    client = _client(mock_api)
+    assert client.classify(_jpeg())[0]["label"] == "artificial"
+    assert len(mock_api.payloads) == 3
+
+
+def test_gives_up_after_max_retries(mock_api):
+    mock_api.loading = 10
+    with pytest.raises(HuggingFaceError) as error:
+        _client(mock_api, max_retries=2).classify(_jpeg())
+    assert error.value.status_code == 503
+    assert len(mock_api.payloads) == 3
+
+
+def test_uploads_are_downscaled(mock_api):
+    _client(mock_api, max_dim=256).classify(_jpeg((2000, 1000)))
+    prefix, encoded = mock_api.payloads[0]["inputs"].split(',', 1)
+    assert prefix == "data:image/jpeg;base64"
+    assert Image.open(io.BytesIO(base64.b64decode(encoded))).size == (256, 128)
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_undecodable_image_does_not_fail_the_batch(mock_api, batch_size):
+    images = [_jpeg(), b'not an image', _jpeg(), _jpeg()]
+    results = _client(mock_api, batch_size=batch_size).classify_batch(images)
+    assert isinstance(results[1], ImageRejected)
+    assert results[1].reason == "undecodable"
+    assert all(result[0]["label"] == "artificial" for i, result in enumerate(results) if i != 1)
+    # Three images reach the mock: one call each, or two batched calls
+    assert len(mock_api.payloads) == (3 if batch_size == 1 else 2)
@@ -19,6 +19,10 @@ from ml_model_example import (
     create_cnn_model,
     create_data_generator
 )
+from augmentation import DEFAULT_AUGMENTATION, augmented
+from evaluate import evaluate
+from sampling import BalancedSampler
+from training_checkpoint import AsyncCheckpointer, fit_resumable
 
 def create_sample_dataset():
     """
@@ -91,35 +95,30 @@ def download_and_save_sample_images():
         except Exception as e:
             print(f"Error downloading AI image {i}: {e}")
 
-def create_local_data_generator(batch_size=2):
+def create_local_data_generator(batch_size=2, seed=None, start=0):
     """
     Create a data generator using local images.
+    
+    Batches are half real, half AI, each class read in a new seeded
+    shuffle per pass (see sampling.py). The batch order depends only on
+    seed; start jumps that many batches ahead without loading them, so a
+    resumed run continues the same sequence.
     """
     real_dir = 'data/real'
     ai_dir = 'data/ai'
     
-    real_files = [f for f in os.listdir(real_dir) if f.endswith('.jpg')]
-    ai_files = [f for f in os.listdir(ai_dir) if f.endswith('.jpg')]
+    real_files = sorted(f for f in os.listdir(real_dir) if f.endswith('.jpg'))
+    ai_files = sorted(f for f in os.listdir(ai_dir) if f.endswith('.jpg'))
+    sources = ((real_dir, real_files), (ai_dir, ai_files))  # label 0: real, 1: AI
+    sampler = BalancedSampler([len(real_files), len(ai_files)], batch_size, seed=seed)
     
-    while True:
+    for labels, indices in sampler.batches(start):
         batch_images = []
         batch_labels = []
         
-        for _ in range(batch_size):
-            # Randomly choose real or AI
-            if np.random.random() < 0.5 and real_files:
-                # Real image
-                filename = np.random.choice(real_files)
-                image_path = os.path.join(real_dir, filename)
-                label = 0
-            elif ai_files:
-                # AI image
-                filename = np.random.choice(ai_files)
-                image_path = os.path.join(ai_dir, filename)
-                label = 1
-            else:
-                continue
-            
+        for label, index in zip(labels, indices):
+            directory, files = sources[label]
+            image_path = os.path.join(directory, files[index])
             try:
                 # Load and preprocess image
                 image = Image.open(image_path)
@@ -137,18 +136,27 @@ def create_local_data_generator(batch_size=2):
         if len(batch_images) > 0:
             yield np.array(batch_images), np.array(batch_labels)
 
-def train_simple_model():
+def train_simple_model(checkpoint_dir='checkpoints', seed=None, augmentation=None):
     """
     Train a simple model with the sample data.
+    
+    Checkpoints are written in the background to checkpoint_dir; running
+    again after a crash resumes from the latest one. The best model is
+    exported to best_model.h5.
+    
+    augmentation is a dict of settings for augmentation.py (None trains on
+    the images as they are); batches are augmented in the input pipeline.
     """
     print("Training model...")
     
     # Create model
     model = create_cnn_model()
     
-    # Create data generators
-    train_generator = create_local_data_generator(batch_size=2)
-    val_generator = create_local_data_generator(batch_size=2)
+    # Validate on the same fixed batches every epoch (and after a resume)
+    val_generator = create_local_data_generator(batch_size=2, seed=1)
+    val_batches = [next(val_generator) for _ in range(2)]
+    validation_data = (np.concatenate([x for x, _ in val_batches]),
+                       np.concatenate([y for _, y in val_batches]))
     
     # Training callbacks
     callbacks = [
@@ -156,69 +164,48 @@ def train_simple_model():
             monitor='val_loss',
             patience=5,
             restore_best_weights=True
-        ),
-        tf.keras.callbacks.ModelCheckpoint(
-            'best_model.h5',
-            monitor='val_accuracy',
-            save_best_only=True
         )
     ]
     
+    train_batches = lambda seed, start: create_local_data_generator(batch_size=2, seed=seed, start=start)
+    if augmentation is not None:
+        train_batches = augmented(train_batches, augmentation)
+    
     # Train model
-    history = model.fit(
-        train_generator,
-        validation_data=val_generator,
+    history = fit_resumable(
+        model,
+        train_batches,
         epochs=10,  # Small number for demo
         steps_per_epoch=5,
-        validation_steps=2,
+        checkpointer=AsyncCheckpointer(checkpoint_dir),
+        seed=seed,
+        validation_data=validation_data,
         callbacks=callbacks,
+        save_every=5,
+        export_best='best_model.h5',
+        monitor='val_accuracy',
         verbose=1
     )
     
     print("Training completed!")
     return model, history
 
-def test_model(model):
+def test_model(model, data_dir='data'):
     """
-    Test the trained model on sample images.
+    Evaluate the trained model on the local dataset with the batched
+    evaluation harness (see evaluate.py for larger sets and JSON reports).
     """
     print("\nTesting model...")
     
-    # Test on a few sample images
-    test_images = [
-        ('data/real/real_0.jpg', 'Real'),
-        ('data/ai/ai_0.jpg', 'AI')
-    ]
+    report = evaluate(model, data_dir)
+    metrics, throughput = report['metrics'], report['throughput']
     
-    for image_path, expected in test_images:
-        try:
-            # Load and preprocess
-            image = Image.open(image_path)
-            image = image.convert('RGB')
-            image = image.resize((224, 224))
-            image_array = np.array(image) / 255.0
-            image_input = np.expand_dims(image_array, axis=0)
-            
-            # Predict
-            prediction = model.predict(image_input)
-            ai_probability = prediction[0][1]
-            
-            # Determine result
-            if ai_probability > 0.5:
-                result = 'AI'
-                confidence = ai_probability
-            else:
-                result = 'Real'
-                confidence = 1 - ai_probability
-            
-            print(f"Image: {image_path}")
-            print(f"Expected: {expected}, Predicted: {result}")
-            print(f"Confidence: {confidence:.2f}")
-            print(f"AI Probability: {ai_probability:.2f}")
-            print("-" * 40)
-            
-        except Exception as e:
-            print(f"Error testing {image_path}: {e}")
+    print(f"Images: {metrics['count']} ({throughput['failed']} failed to load)")
+    print(f"Accuracy: {metrics['accuracy']:.2f}, ROC-AUC: {metrics['roc_auc']}")
+    print(f"Calibration error: {metrics['ece']:.3f}")
+    print(f"Throughput: {throughput['images_per_second']} images/s")
+    print("-" * 40)
+    return report
 
 def main():
     """
@@ -232,7 +219,7 @@ def main():
     
     # Step 2: Train model
     print("\n2. Training model...")
-    model, history = train_simple_model()
+    model, history = train_simple_model(augmentation=DEFAULT_AUGMENTATION)
     
     # Step 3: Test model
     print("\n3. Testing model...")
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+Asynchronous, exactly resumable training checkpoints
+A checkpoint holds the model weights (including BatchNorm statistics and
+dropout seed state), the optimizer slots and iteration count, the global
+step, the data-pipeline seed and position, and the state of stopping and
+LR-schedule callbacks (including EarlyStopping's best weights). The training thread only copies those arrays; writing
+them to disk, rotating old checkpoints out and exporting the best model for
+serving happen on a background thread, so save time stays out of step time.
+
+Data pipelines take part by being a factory, train_batches(seed, start),
+that returns a generator positioned after `start` batches. fit_resumable
+restarts such a generator at the saved step (with the saved seed) and
+finishes an interrupted epoch before continuing, so a resumed run sees the
+same batches and updates as an uninterrupted one.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+CHECKPOINT_PREFIX = 'ckpt-'
+
+# Callback attributes that carry progress between epochs (EarlyStopping,
+# ReduceLROnPlateau); Keras resets them in on_train_begin
+_CALLBACK_STATE = ('wait', 'best', 'cooldown_counter', 'stopped_epoch', 'best_epoch')
+
+# ============================================================================
+# 1. SNAPSHOT / RESTORE
+# ============================================================================
+
+def snapshot_model(model):
+    """
+    Copy everything needed to continue training from this point.
+
+    Returns:
+        tuple: (weights, optimizer_variables) as lists of numpy arrays that
+        no longer alias the live variables
+    """
+    # model.variables, unlike get_weights(), includes the dropout seed state
+    weights = [np.array(v.numpy(), copy=True) for v in model.variables]
+    optimizer = [np.array(v.numpy(), copy=True) for v in model.optimizer.variables]
+    return weights, optimizer
+
+
+def restore_model(model, weights, optimizer_variables):
+    """Load a snapshot back into a compiled model, building the optimizer slots first."""
+    for variable, value in zip(model.variables, weights):
+        variable.assign(value)
+    optimizer = model.optimizer
+    if len(optimizer.variables) != len(optimizer_variables):
+        optimizer.build(model.trainable_variables)
+    for variable, value in zip(optimizer.variables, optimizer_variables):
+        variable.assign(value)
+
+
+def _callback_state(callbacks):
+    state = {}
+    for i, callback in enumerate(callbacks):
+        values = {name: getattr(callback, name) for name in _CALLBACK_STATE if hasattr(callback, name)}
+        if values:
+            state[f'{i}:{type(callback).__name__}'] = {
+                name: float(value) if isinstance(value, (np.floating, float)) else value
+                for name, value in values.items()
+            }
+    return state
+
+
+def _restore_callback_state(callbacks, state):
+    for i, callback in enumerate(callbacks):
+        for name, value in state.get(f'{i}:{type(callback).__name__}', {}).items():
+            setattr(callback, name, value)
+
+
+def _callback_weights(callbacks):
+    """best_weights of callbacks that keep them (EarlyStopping(restore_best_weights=True))."""
+    return {f'{i}:{type(callback).__name__}': callback.best_weights
+            for i, callback in enumerate(callbacks) if getattr(callback, 'best_weights', None) is not None}
+
+
+def _restore_callback_weights(callbacks, weights):
+    for i, callback in enumerate(callbacks):
+        values = weights.get(f'{i}:{type(callback).__name__}')
+        if values is not None:
+            callback.best_weights = list(values)
+
+# ============================================================================
+# 2. BACKGROUND WRITER
+# ============================================================================
+
+class AsyncCheckpointer:
+    """
+    Writes checkpoints to directory/ckpt-<step>/ on a background thread and
+    keeps the newest `keep` of them.
+
+    Each checkpoint is written under a temporary name and renamed into
+    place, so a crash mid-write never leaves a partial checkpoint behind. If
+    a save is requested while the previous one is still being written, the
+    newer snapshot replaces any that is still waiting (training never waits
+    on the disk).
+    """
+
+    def __init__(self, directory='checkpoints', keep=3):
+        """
+        Args:
+            directory (str): Where checkpoints are kept
+            keep (int): How many of the newest checkpoints to retain
+        """
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._pending = {}  # kind -> write function, newest wins
+        self._busy = False
+        self._closed = False
+        self.stats = {"saves": 0, "written": 0, "superseded": 0, "failed": 0,
+                      "snapshot_ms": 0.0, "write_ms": 0.0}
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    # -- writer thread -------------------------------------------------------
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                kind = next(iter(self._pending))
+                job = self._pending.pop(kind)
+                self._busy = True
+
+            start = time.perf_counter()
+            try:
+                job()
+                self.stats["written"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Checkpoint {kind} failed: {e}")
+            self.stats["write_ms"] += (time.perf_counter() - start) * 1000
+
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _submit(self, kind, job):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Checkpointer is closed")
+            if kind in self._pending:
+                self.stats["superseded"] += 1
+            self._pending[kind] = job
+            self._cond.notify_all()
+
+    def _write(self, step, weights, optimizer, meta, callback_weights=None):
+        final = os.path.join(self.directory, f'{CHECKPOINT_PREFIX}{step:09d}')
+        tmp = os.path.join(self.directory, f'.{CHECKPOINT_PREFIX}{step:09d}.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        np.savez(os.path.join(tmp, 'weights.npz'), *weights)
+        np.savez(os.path.join(tmp, 'optimizer.npz'), *optimizer)
+        with open(os.path.join(tmp, 'state.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        names = ['weights.npz', 'optimizer.npz', 'state.json']
+        if callback_weights:
+            np.savez(os.path.join(tmp, 'callbacks.npz'), **{
+                f'{key}|{j}': array for key, arrays in callback_weights.items() for j, array in enumerate(arrays)})
+            names.append('callbacks.npz')
+        for name in names:
+            with open(os.path.join(tmp, name), 'rb') as f:
+                os.fsync(f.fileno())
+
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(tmp, final)
+        _fsync_dir(self.directory)
+
+        for old in self.checkpoints()[:-self.keep]:
+            shutil.rmtree(old, ignore_errors=True)
+
+    # -- training thread -----------------------------------------------------
+
+    def save(self, model, step, meta, callback_weights=None):
+        """
+        Snapshot the model now and write it in the background.
+
+        Args:
+            model: Compiled Keras model
+            step (int): Global training step (batches trained)
+            meta (dict): JSON-serializable progress (epoch, seed, callbacks...)
+            callback_weights (dict): Lists of arrays kept by callbacks
+                (EarlyStopping best weights), by callback key
+        """
+        start = time.perf_counter()
+        weights, optimizer = snapshot_model(model)
+        self.stats["snapshot_ms"] += (time.perf_counter() - start) * 1000
+        self.stats["saves"] += 1
+        meta = dict(meta, step=step, saved_at=time.time())
+        self._submit('checkpoint', lambda: self._write(step, weights, optimizer, meta, callback_weights))
+
+    def export(self, model, path, shadow):
+        """
+        Save model for serving (e.g. best_model.h5) in the background.
+
+        shadow is a clone of model used only by the writer thread: it gets
+        the snapshotted weights and is saved, so the live model is never
+        touched off the training thread.
+        """
+        weights = [np.array(w, copy=True) for w in model.get_weights()]
+
+        def write():
+            shadow.set_weights(weights)
+            root, ext = os.path.splitext(path)
+            tmp = f'{root}.tmp{ext}'
+            shadow.save(tmp)
+            os.replace(tmp, path)
+        self._submit(f'export:{path}', write)
+
+    def wait(self):
+        """Block until every submitted write has finished."""
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+
+    def close(self):
+        """Finish outstanding writes and stop the writer thread."""
+        self.wait()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    # -- reading -------------------------------------------------------------
+
+    def checkpoints(self):
+        """Complete checkpoint directories, oldest first."""
+        names = sorted(name for name in os.listdir(self.directory) if name.startswith(CHECKPOINT_PREFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def restore(self, model, path=None):
+        """
+        Load the latest (or given) checkpoint into model.
+
+        Returns:
+            dict: The checkpoint's meta (step, epoch, seed, ...), or None when
+            there is nothing to resume from. Callback best weights, if any,
+            are under 'callback_weights'.
+        """
+        path = path or self.latest()
+        if path is None:
+            return None
+        with np.load(os.path.join(path, 'weights.npz')) as data:
+            weights = [data[f'arr_{i}'] for i in range(len(data.files))]
+        with np.load(os.path.join(path, 'optimizer.npz')) as data:
+            optimizer = [data[f'arr_{i}'] for i in range(len(data.files))]
+        with open(os.path.join(path, 'state.json')) as f:
+            meta = json.load(f)
+        callbacks_path = os.path.join(path, 'callbacks.npz')
+        if os.path.exists(callbacks_path):
+            callback_weights = {}
+            with np.load(callbacks_path) as data:
+                # Keys are '<callback>|<index>'; keep each callback's arrays in order
+                for name in sorted(data.files, key=lambda n: (n.rsplit('|', 1)[0], int(n.rsplit('|', 1)[1]))):
+                    callback_weights.setdefault(name.rsplit('|', 1)[0], []).append(data[name])
+            meta['callback_weights'] = callback_weights
+        restore_model(model, weights, optimizer)
+        return meta
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# ============================================================================
+# 3. KERAS INTEGRATION
+# ============================================================================
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    """
+    Saves a checkpoint every `save_every` steps and at the end of each epoch,
+    and exports the best model (replacing ModelCheckpoint(save_best_only)).
+
+    Must come after the callbacks whose state it saves, so that restoring
+    that state happens after they reset themselves in on_train_begin.
+    """
+
+    def __init__(self, checkpointer, seed, save_every=100, callbacks=(), initial_step=0,
+                 restored=None, export_best=None, monitor='val_accuracy', mode='max'):
+        """
+        Args:
+            checkpointer (AsyncCheckpointer): Where to save
+            seed (int): Data-pipeline seed, recorded for resume
+            save_every (int): Steps between mid-epoch checkpoints (0: epoch ends only)
+            callbacks (list): Other callbacks whose progress is checkpointed
+            initial_step (int): Global step training starts (or resumes) at
+            restored (dict): Meta of the checkpoint being resumed, if any
+            export_best (str): Path to save the model to when `monitor` improves
+            monitor (str): Metric for export_best
+            mode (str): 'max' or 'min'
+        """
+        super().__init__()
+        self.checkpointer = checkpointer
+        self.seed = seed
+        self.save_every = save_every
+        self.tracked_callbacks = list(callbacks)
+        self.step = initial_step
+        self.epochs_completed = (restored or {}).get('epochs_completed', 0)
+        self.export_best = export_best
+        self.monitor = monitor
+        self.mode = mode
+        self.best = (restored or {}).get('best')
+        self._restored_callbacks = (restored or {}).get('callbacks')
+        self._restored_weights = (restored or {}).get('callback_weights')
+        self._shadow = None
+
+    def _meta(self):
+        return {
+            "epochs_completed": self.epochs_completed,
+            "seed": self.seed,
+            "best": self.best,
+            "stopped": bool(self.model.stop_training),
+            "callbacks": _callback_state(self.tracked_callbacks)
+        }
+
+    def _save(self):
+        self.checkpointer.save(self.model, self.step, self._meta(), _callback_weights(self.tracked_callbacks))
+
+    def on_train_begin(self, logs=None):
+        if self._restored_callbacks:
+            _restore_callback_state(self.tracked_callbacks, self._restored_callbacks)
+        if self._restored_weights:
+            _restore_callback_weights(self.tracked_callbacks, self._restored_weights)
+        if self.export_best and self._shadow is None:
+            self._shadow = tf.keras.models.clone_model(self.model)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        # The last step of an epoch is saved by on_epoch_end, with its metrics
+        last_in_epoch = batch + 1 >= (self.params.get('steps') or float('inf'))
+        if self.save_every and self.step % self.save_every == 0 and not last_in_epoch:
+            self._save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epochs_completed = epoch + 1
+        value = (logs or {}).get(self.monitor)
+        if self.export_best and value is not None:
+            improved = self.best is None or (value > self.best if self.mode == 'max' else value < self.best)
+            if improved:
+                self.best = float(value)
+                self.checkpointer.export(self.model, self.export_best, self._shadow)
+        # fit_resumable runs a second fit after finishing an interrupted
+        # epoch; its on_train_begin must restore this epoch's state, not the
+        # checkpoint's
+        self._restored_callbacks = _callback_state(self.tracked_callbacks)
+        self._restored_weights = _callback_weights(self.tracked_callbacks)
+        self._save()
+
+
+def fit_resumable(model, train_batches, epochs, steps_per_epoch, checkpointer, seed=None,
+                  validation_data=None, validation_steps=None, callbacks=(), save_every=100,
+                  export_best=None, monitor='val_accuracy', verbose=1):
+    """
+    model.fit that resumes exactly from the latest checkpoint in checkpointer.
+
+    Args:
+        model: Compiled Keras model
+        train_batches (callable): (seed, start) -> generator of (x, y) batches
+            positioned after `start` batches
+        epochs (int): Total epochs, counting those already done
+        steps_per_epoch (int): Batches per epoch
+        checkpointer (AsyncCheckpointer): Checkpoint store
+        seed (int): Data seed for a fresh run (a resumed run keeps its own;
+            drawn at random when None)
+        validation_data: As for model.fit
+        validation_steps (int): As for model.fit
+        callbacks (list): Other callbacks (their progress is checkpointed)
+        save_every (int): Steps between mid-epoch checkpoints
+        export_best (str): Path for the best model, as ModelCheckpoint(save_best_only)
+        monitor (str): Metric for export_best
+
+    Returns:
+        tf.keras.callbacks.History: History of the epochs run by this call
+    """
+    restored = checkpointer.restore(model)
+    step = restored['step'] if restored else 0
+    if restored and restored.get('stopped'):
+        print(f"Training already stopped early at step {step} ({checkpointer.latest()})")
+        return None
+    if restored:
+        seed = restored['seed']
+        print(f"Resuming from step {step} (epoch {step // steps_per_epoch + 1}) of {checkpointer.latest()}")
+    elif seed is None:
+        seed = int(np.random.default_rng().integers(2 ** 31))
+
+    checkpoint = CheckpointCallback(checkpointer, seed, save_every, callbacks, step, restored,
+                                    export_best, monitor)
+    all_callbacks = list(callbacks) + [checkpoint]
+    epoch, done_in_epoch = divmod(step, steps_per_epoch)
+
+    history = None
+    try:
+        if done_in_epoch and epoch < epochs:
+            # Finish the interrupted epoch with the steps it had left
+            history = model.fit(train_batches(seed, step), initial_epoch=epoch, epochs=epoch + 1,
+                                steps_per_epoch=steps_per_epoch - done_in_epoch,
+                                validation_data=validation_data, validation_steps=validation_steps,
+                                callbacks=all_callbacks, verbose=verbose)
+            epoch += 1
+            if model.stop_training:
+                return history
+
+        if epoch < epochs:
+            rest = model.fit(train_batches(seed, epoch * steps_per_epoch), initial_epoch=epoch, epochs=epochs,
+                             steps_per_epoch=steps_per_epoch,
+                             validation_data=validation_data, validation_steps=validation_steps,
+                             callbacks=all_callbacks, verbose=verbose)
+            if history is not None:
+                for key, values in rest.history.items():
+                    history.history.setdefault(key, []).extend(values)
+                history.epoch.extend(rest.epoch)
+            else:
+                history = rest
+    finally:
+        checkpointer.wait()
+
+    stats = checkpointer.stats
+    if stats["saves"]:
+        print(f"Checkpoints: {stats['saves']} saves, "
+              f"{stats['snapshot_ms'] / stats['saves']:.1f} ms blocking per save, "
+              f"{stats['write_ms'] / max(stats['written'], 1):.1f} ms writing in the background")
+    return history
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+Directory watch mode for images that land in a shared folder
+Watches a directory tree and classifies new or changed image files with
+AIImageDetector.predict_batch, recording results in a sidecar index next
+to the images. Files whose content hash is already in the index are not
+scored again, whether they were touched, copied or renamed, unless the
+stored result came from another model version. On Linux the tree is
+watched with inotify, so the process sleeps in the kernel until something
+changes; elsewhere (or when inotify is unavailable) it falls back to
+polling file stats at a fixed interval.
+
+    python watch_folder.py /srv/uploads --model best_model.h5
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import select
+import signal
+import struct
+import sys
+import time
+
+from bulk_score import load_detector
+from image_probe import DEFAULT_LIMITS
+from model_serving import apply_thread_config, load_thread_config
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+INDEX_NAME = '.ai_detector_index.jsonl'
+
+# Event kinds reported by the watchers
+CHANGED = "changed"
+DELETED = "deleted"
+RESCAN = "rescan"
+
+
+def is_image_file(name):
+    """Image by extension; hidden files and editors' temporaries are ignored."""
+    return not name.startswith('.') and name.lower().endswith(IMAGE_EXTENSIONS)
+
+# ============================================================================
+# 1. SIDECAR INDEX
+# ============================================================================
+
+class SidecarIndex:
+    """
+    Results per file, keyed by path relative to the watched root.
+
+    Stored as append-only JSONL: each scored file adds a row and a deletion
+    adds a {"path", "deleted": true} row, the latest row for a path wins.
+    Superseded rows are compacted away when the index is opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._by_hash = {}
+        self._file = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        rows = 0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    break  # torn last line from a killed run
+                rows += 1
+                if row.get('deleted'):
+                    self._entries.pop(row['path'], None)
+                else:
+                    self._entries[row['path']] = row
+
+        for entry in self._entries.values():
+            if entry.get('sha256'):
+                self._by_hash[entry['sha256']] = entry
+        if rows != len(self._entries):
+            self._compact()
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _append(self, row):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(row) + '\n')
+
+    def get(self, path):
+        return self._entries.get(path)
+
+    def by_hash(self, sha256):
+        """Any entry with this content hash (the same image under another name)."""
+        return self._by_hash.get(sha256)
+
+    def paths(self):
+        return list(self._entries)
+
+    def put(self, entry):
+        self._entries[entry['path']] = entry
+        if entry.get('sha256'):
+            self._by_hash[entry['sha256']] = entry
+        self._append(entry)
+
+    def remove(self, path):
+        if self._entries.pop(path, None) is not None:
+            self._append({"path": path, "deleted": True})
+
+    def commit(self):
+        """Make the rows written so far durable."""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.commit()
+            self._file.close()
+            self._file = None
+
+# ============================================================================
+# 2. WATCHERS
+# ============================================================================
+#
+# Both watchers implement read(timeout) -> list of (kind, absolute path):
+# block until something changes (or timeout seconds, None = forever) and
+# report CHANGED / DELETED files, or RESCAN for the path when the watcher
+# lost track of a subtree (new directory, inotify queue overflow).
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+               IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+
+class InotifyWatcher:
+    """Linux inotify over every directory in the tree, through libc."""
+
+    def __init__(self, root):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or not libc_name:
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self._dirs = {}  # watch descriptor -> directory
+        self._watch_tree(root)
+
+    def _watch_tree(self, top):
+        for directory, subdirs, _ in os.walk(top):
+            subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+            if wd < 0:
+                # Usually fs.inotify.max_user_watches; let the caller fall back to polling
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+            self._dirs[wd] = directory
+
+    def read(self, timeout=None):
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self._fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                events.append((RESCAN, self.root))
+                continue
+            directory = self._dirs.get(wd)
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith('.'):
+                    # Files may have landed before the watch was added
+                    self._watch_tree(path)
+                    events.append((RESCAN, path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    events.append((RESCAN, path))
+            elif is_image_file(name):
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    events.append((CHANGED, path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    events.append((DELETED, path))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """Fallback: compare (size, mtime) of every image file every interval seconds."""
+
+    def __init__(self, root, interval=5.0):
+        self.root = root
+        self.interval = interval
+        self._stats = snapshot(root)
+
+    def read(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+
+            current = snapshot(self.root)
+            events = [(CHANGED, path) for path, stat in current.items() if self._stats.get(path) != stat]
+            events += [(DELETED, path) for path in self._stats if path not in current]
+            self._stats = current
+            if events or (deadline is not None and time.monotonic() >= deadline):
+                return events
+
+    def close(self):
+        pass
+
+
+def snapshot(root):
+    """{absolute path: (size, mtime_ns)} for every image file under root."""
+    stats = {}
+    for directory, subdirs, files in os.walk(root):
+        subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+        for name in files:
+            if is_image_file(name):
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (st.st_size, st.st_mtime_ns)
+    return stats
+
+
+def open_watcher(root, poll_interval=5.0, force_polling=False):
+    """inotify where available, otherwise polling."""
+    if not force_polling:
+        try:
+            return InotifyWatcher(root)
+        except OSError as e:
+            print(f"inotify unavailable ({e}), polling every {poll_interval}s")
+    return PollingWatcher(root, poll_interval)
+
+# ============================================================================
+# 3. CLASSIFICATION
+# ============================================================================
+
+class FolderClassifier:
+    """Keeps the sidecar index in step with the image files under root."""
+
+    def __init__(self, root, detector, index, batch_size=32, settle=0.5, multi_crop=False, limits=None):
+        """
+        Args:
+            root (str): Watched directory
+            detector (AIImageDetector): Model used for scoring
+            index (SidecarIndex): Results store
+            batch_size (int): Images per predict_batch call
+            settle (float): Quiet seconds to wait for a burst of changes to
+                finish before scoring it
+            multi_crop (bool): Score native-resolution patches
+            limits (dict): image_probe limits (max_bytes is checked before reading)
+        """
+        self.root = os.path.abspath(root)
+        self.detector = detector
+        self.index = index
+        self.batch_size = batch_size
+        self.settle = settle
+        self.multi_crop = multi_crop
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.counters = {"scored": 0, "unchanged": 0, "duplicates": 0, "deleted": 0, "errors": 0}
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.root)
+
+    def _score(self, pending):
+        """Classify (rel_path, sha256, stat, bytes) tuples in batches."""
+        for start in range(0, len(pending), self.batch_size):
+            chunk = pending[start:start + self.batch_size]
+            try:
+                results = self.detector.predict_batch([image_bytes for _, _, _, image_bytes in chunk],
+                                                      multi_crop=self.multi_crop)
+            except Exception as e:
+                # Not indexed, so these files are tried again on the next change or rescan
+                print(f"[watch] Batch of {len(chunk)} failed: {e}", flush=True)
+                self.counters["errors"] += len(chunk)
+                continue
+            for (rel, sha256, st, _), result in zip(chunk, results):
+                self.index.put({"path": rel, "sha256": sha256, "size": st.st_size,
+                                "mtime_ns": st.st_mtime_ns, "scored_at": time.time(),
+                                "model_version": result.get('model_version', self.detector.model_version),
+                                "result": result})
+                self.counters["errors" if result.get('error') else "scored"] += 1
+            self.index.commit()
+
+    def update(self, paths):
+        """
+        Score the given files unless their content is already indexed for this model version.
+
+        Files are read and scored batch_size at a time, so a first scan of a
+        large tree never holds more than one batch of images in memory.
+        """
+        version = self.detector.model_version
+        pending = []
+        queued = set()
+        copies = []  # identical to an image already pending in this batch
+
+        def flush():
+            self._score(pending)
+            for rel, sha256, st in copies:
+                known = self.index.by_hash(sha256)
+                if known is None or known.get('model_version') != version:
+                    # Its twin's batch failed; both are tried again on the next change or rescan
+                    self.counters["errors"] += 1
+                    continue
+                self.index.put(dict(known, path=rel, size=st.st_size, mtime_ns=st.st_mtime_ns))
+                self.counters["duplicates"] += 1
+            pending.clear()
+            queued.clear()
+            copies.clear()
+
+        for path in sorted(set(paths)):
+            rel = self._relative(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.remove([path])
+                continue
+
+            entry = self.index.get(rel)
+            if entry and entry.get('model_version') != version:
+                entry = None  # scored by another model version: score again
+            if entry and (entry['size'], entry['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+                self.counters["unchanged"] += 1
+                continue
+            if st.st_size > self.limits['max_bytes']:
+                self.index.put({"path": rel, "sha256": None, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                "scored_at": time.time(), "model_version": version,
+                                "result": {"error": f"File exceeds {self.limits['max_bytes']:,} bytes",
+                                           "rejected": "too_large"}})
+                self.counters["errors"] += 1
+                continue
+
+            try:
+                with open(path, 'rb') as f:
+                    image_bytes = f.read()
+            except OSError:
+                continue
+            sha256 = hashlib.sha256(image_bytes).hexdigest()
+
+            # Same content as before (touched, rewritten) or as another file (copied, renamed)
+            known = entry if entry and entry['sha256'] == sha256 else self.index.by_hash(sha256)
+            if known is not None and known.get('model_version') == version:
+                self.index.put(dict(known, path=rel, size=st.st_size, mtime_ns=st.st_mtime_ns))
+                self.counters["unchanged" if known is entry else "duplicates"] += 1
+                continue
+            if sha256 in queued:
+                copies.append((rel, sha256, st))
+                continue
+            queued.add(sha256)
+            pending.append((rel, sha256, st, image_bytes))
+            if len(pending) >= self.batch_size:
+                flush()
+
+        flush()
+        self.index.commit()
+
+    def remove(self, paths):
+        for path in paths:
+            rel = self._relative(path)
+            if self.index.get(rel) is not None:
+                self.index.remove(rel)
+                self.counters["deleted"] += 1
+        self.index.commit()
+
+    def rescan(self, top=None):
+        """Reconcile the index with the files under top (default: the whole root)."""
+        top = os.path.abspath(top or self.root)
+        current = snapshot(top) if os.path.isdir(top) else {}
+        prefix = self._relative(top)
+        gone = [os.path.join(self.root, rel) for rel in self.index.paths()
+                if (prefix == '.' or rel == prefix or rel.startswith(prefix + os.sep))
+                and os.path.join(self.root, rel) not in current]
+        self.remove(gone)
+        self.update(current)
+
+    def watch(self, watcher):
+        """Process changes until interrupted; blocks (idle) while nothing happens."""
+        while True:
+            events = watcher.read(timeout=None)
+            # Let a burst of copies finish, in bounded chunks
+            while len(events) < self.batch_size * 8:
+                more = watcher.read(timeout=self.settle)
+                if not more:
+                    break
+                events.extend(more)
+
+            changed, deleted, rescans = set(), set(), set()
+            for kind, path in events:
+                if kind == RESCAN:
+                    rescans.add(path)
+                elif kind == DELETED:
+                    deleted.add(path)
+                    changed.discard(path)
+                else:
+                    changed.add(path)
+                    deleted.discard(path)
+
+            self.remove(deleted)
+            self.update(changed)
+            for path in rescans:
+                self.rescan(path)
+            print(f"[watch] {json.dumps(self.counters)}", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Classify images as they land in a directory tree")
+    parser.add_argument('root', help="Directory to watch")
+    parser.add_argument('--index', help=f"Sidecar index file (default: <root>/{INDEX_NAME})")
+    parser.add_argument('--model', help="Keras weights (.h5) or .tflite model (default: best_model.h5)")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--cpu-workers', type=int, default=0,
+                        help="Decode in this many worker processes (cpu_pool)")
+    parser.add_argument('--multi-crop', action='store_true', help="Score native-resolution patches")
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help="Quiet seconds before a burst of changes is scored")
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help="Seconds between scans when inotify is unavailable")
+    parser.add_argument('--poll', action='store_true', help="Poll even where inotify is available")
+    parser.add_argument('--once', action='store_true', help="Reconcile the index once and exit")
+    args = parser.parse_args()
+
+    thread_config = apply_thread_config(load_thread_config())
+    detector = load_detector(args.model, args.cpu_workers, thread_config['intra_op'])
+    index = SidecarIndex(args.index or os.path.join(args.root, INDEX_NAME))
+    classifier = FolderClassifier(args.root, detector, index, batch_size=args.batch_size,
+                                  settle=args.settle, multi_crop=args.multi_crop)
+
+    # Stop cleanly under a service manager too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # Start watching before the initial scan so nothing slips in between
+        watcher = None if args.once else open_watcher(args.root, args.poll_interval, args.poll)
+        classifier.rescan()
+        print(f"[watch] Initial scan: {json.dumps(classifier.counters)}", flush=True)
+        if watcher is not None:
+            print(f"[watch] Watching {classifier.root} ({type(watcher).__name__})", flush=True)
+            classifier.watch(watcher)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        index.close()
+        if detector.cpu_pool is not None:
+            detector.cpu_pool.close()